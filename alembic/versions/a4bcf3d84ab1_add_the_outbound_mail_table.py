@@ -0,0 +1,32 @@
+"""
+Add the outbound_mail table, which holds the mail outbox.
+
+Revision ID: a4bcf3d84ab1
+Revises: fc6b0169c596
+Create Date: 2017-04-18 10:21:34.618203
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a4bcf3d84ab1'
+down_revision = 'fc6b0169c596'
+
+
+def upgrade():
+    """Create the outbound_mail table."""
+    op.create_table(
+        'outbound_mail',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('from_addr', sa.UnicodeText(), nullable=False),
+        sa.Column('to_addr', sa.UnicodeText(), nullable=False),
+        sa.Column('message', sa.UnicodeText(), nullable=False),
+        sa.Column('date_queued', sa.DateTime(), nullable=False),
+        sa.Column('date_claimed', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    """Drop the outbound_mail table, and the messages that were still in it."""
+    op.drop_table('outbound_mail')
@@ -12,7 +12,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import logging
+import threading
+import time
 import xmlrpclib
 
 from bunch import Bunch
@@ -33,6 +38,27 @@ class BugTracker(object):
 
     getbug = update_details = modified = on_qa = close = update_details = _
 
+    def getbugs(self, bug_ids):
+        """
+        Return the given bugs.
+
+        Args:
+            bug_ids (list): The IDs of the bugs to fetch.
+        Returns:
+            dict: The bugs that could be fetched, keyed by their IDs.
+        """
+        return dict((bug_id, self.getbug(bug_id)) for bug_id in bug_ids)
+
+    @contextmanager
+    def cached_bugs(self, bugs):
+        """
+        Have the calls made from this thread use the given bugs instead of fetching them again.
+
+        Args:
+            bugs (dict): Bugs fetched with getbugs(), keyed by their IDs.
+        """
+        yield
+
 
 class FakeBugTracker(BugTracker):
 
@@ -56,6 +82,8 @@ class Bugzilla(BugTracker):
 
     def __init__(self):
         self._bz = None
+        # The bugs that were fetched in advance for the calls made from each thread
+        self._local = threading.local()
 
     def _connect(self):
         user = config.get('bodhi_email')
@@ -82,15 +110,75 @@ class Bugzilla(BugTracker):
     def getbug(self, bug_id):
         return self.bz.getbug(bug_id)
 
+    def getbugs(self, bug_ids):
+        """
+        Return the given bugs, fetched with getbugs() calls of at most bugzilla_chunk_size bugs.
+
+        Args:
+            bug_ids (list): The IDs of the bugs to fetch.
+        Returns:
+            dict: The bugs that could be fetched, keyed by their IDs. The others are left out.
+        """
+        bug_ids = list(bug_ids)
+        chunk_size = int(config.get('bugzilla_chunk_size', 100))
+        bugs = {}
+        for i in range(0, len(bug_ids), chunk_size):
+            chunk = bug_ids[i:i + chunk_size]
+            try:
+                fetched = self.bz.getbugs(chunk)
+            except Exception:
+                log.exception("Unable to fetch bugs %r" % chunk)
+                continue
+            for bug_id, bug in zip(chunk, fetched):
+                if bug is not None:
+                    bugs[bug_id] = bug
+        return bugs
+
+    @contextmanager
+    def cached_bugs(self, bugs):
+        """
+        Have the calls made from this thread use the given bugs instead of fetching them again.
+
+        Args:
+            bugs (dict): Bugs fetched with getbugs(), keyed by their IDs.
+        """
+        self._local.bugs = bugs
+        try:
+            yield
+        finally:
+            self._local.bugs = None
+
+    def _getbug(self, bug_id):
+        """Return the given bug from the bugs cached for this thread, or else from Bugzilla."""
+        bugs = getattr(self._local, 'bugs', None)
+        if bugs and bug_id in bugs:
+            return bugs[bug_id]
+        return self.bz.getbug(bug_id)
+
+    def _retry(self, func, *args, **kwargs):
+        """
+        Call the given function, trying again up to bugzilla_retries times, with a growing delay,
+        if Bugzilla cannot be reached.
+        """
+        retries = int(config.get('bugzilla_retries', 3))
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except (IOError, xmlrpclib.ProtocolError):
+                if attempt == retries:
+                    raise
+                log.warning('Unable to reach Bugzilla, trying again', exc_info=True)
+                time.sleep(2 ** attempt)
+
     def comment(self, bug_id, comment):
         try:
             if len(comment) > 65535:
                 raise InvalidComment("Comment is too long: %s" % comment)
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             attempts = 0
             while attempts < 5:
                 try:
-                    bug.addcomment(comment)
+                    self._retry(bug.addcomment, comment)
                     break
                 except xmlrpclib.Fault as e:
                     attempts += 1
@@ -110,8 +198,10 @@ class Bugzilla(BugTracker):
         """
         log.debug("Setting Bug #%d to ON_QA" % bug_id)
         try:
-            bug = self.bz.getbug(bug_id)
-            bug.setstatus('ON_QA', comment=comment)
+            bug = self._getbug(bug_id)
+            self._retry(bug.setstatus, 'ON_QA', comment=comment)
+            # The bug may have been fetched in advance, and be used again by the next change
+            bug.bug_status = 'ON_QA'
         except:
             log.exception("Unable to alter bug #%d" % bug_id)
 
@@ -122,7 +212,7 @@ class Bugzilla(BugTracker):
         """
         args = {'comment': comment}
         try:
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             # If this bug is for one of these builds...
             if bug.component in versions:
                 version = versions[bug.component]
@@ -140,7 +230,11 @@ class Bugzilla(BugTracker):
                 # - space-separated if there's more than one.
                 args['fixedin'] = " ".join(fixedin)
 
-            bug.close('ERRATA', **args)
+            self._retry(bug.close, 'ERRATA', **args)
+            bug.bug_status = 'CLOSED'
+            bug.resolution = 'ERRATA'
+            if 'fixedin' in args:
+                bug.fixed_in = args['fixedin']
         except xmlrpclib.Fault:
             log.exception("Unable to close bug #%d" % bug_id)
 
@@ -166,17 +260,122 @@ class Bugzilla(BugTracker):
 
     def modified(self, bug_id):
         try:
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             if bug.product not in config.get('bz_products', '').split(','):
                 log.info("Skipping %r bug" % bug.product)
                 return
             if bug.bug_status not in ('MODIFIED', 'VERIFIED', 'CLOSED'):
                 log.info('Setting bug #%d status to MODIFIED' % bug_id)
-                bug.setstatus('MODIFIED')
+                self._retry(bug.setstatus, 'MODIFIED')
+                bug.bug_status = 'MODIFIED'
         except:
             log.exception("Unable to alter bug #%d" % bug_id)
 
 
+class RateLimiter(object):
+    """
+    Space out the calls made from any number of threads to at most the given rate.
+
+    Args:
+        rate (float): The maximum number of calls per second, or 0 for no limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        """Block until the calling thread may make its call."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BugSync(object):
+    """
+    Gather the changes to a batch of bugs, and then make them all at once.
+
+    A BugSync has the comment(), on_qa(), close() and modified() methods of the bug trackers, and
+    can be given to the methods of the Bug model in their place. Nothing is sent to the bug tracker
+    until apply() is called.
+
+    Args:
+        tracker (BugTracker or None): The bug tracker to make the changes with, or None to use the
+            configured one.
+    """
+    def __init__(self, tracker=None):
+        self.tracker = tracker if tracker is not None else bugtracker
+        # The changes to make, in order, keyed by bug ID
+        self.changes = OrderedDict()
+
+    def _queue(self, method, bug_id, *args, **kwargs):
+        self.changes.setdefault(bug_id, []).append((method, args, kwargs))
+
+    def comment(self, bug_id, comment):
+        self._queue('comment', bug_id, comment)
+
+    def on_qa(self, bug_id, comment):
+        self._queue('on_qa', bug_id, comment)
+
+    def close(self, bug_id, versions, comment):
+        self._queue('close', bug_id, versions=versions, comment=comment)
+
+    def modified(self, bug_id):
+        self._queue('modified', bug_id)
+
+    def apply(self, bugs=None, done=None):
+        """
+        Make the queued changes.
+
+        All of the bugs are fetched with a few getbugs() calls first, unless they are given. The
+        changes are then made on a pool of bugzilla_threads threads, at most bugzilla_rate_limit of
+        them per second. The changes to each bug are made in order, from a single thread. A
+        failure is logged, and stops the remaining changes to that bug, but not to the others.
+
+        Args:
+            bugs (dict or None): The bugs, as returned by the bug tracker's getbugs(), if they were
+                already fetched.
+            done (callable or None): Called from the pool's threads with the ID of each bug, as
+                soon as all of the changes to that bug have been made.
+        Returns:
+            list: The IDs of the bugs whose changes failed.
+        """
+        if not self.changes:
+            return []
+        if bugs is None:
+            bugs = self.tracker.getbugs(list(self.changes))
+        limiter = RateLimiter(float(config.get('bugzilla_rate_limit', 10)))
+
+        def apply_changes(bug_id):
+            try:
+                with self.tracker.cached_bugs(bugs):
+                    for method, args, kwargs in self.changes[bug_id]:
+                        limiter.wait()
+                        getattr(self.tracker, method)(bug_id, *args, **kwargs)
+                if done is not None:
+                    done(bug_id)
+            except Exception:
+                log.exception('Unable to make the changes to bug #%d' % bug_id)
+                return bug_id
+
+        log.info('Making %d changes to %d bugs' % (
+            sum(len(changes) for changes in self.changes.values()), len(self.changes)))
+        pool = ThreadPool(min(int(config.get('bugzilla_threads', 4)), len(self.changes)))
+        try:
+            failed = [bug_id for bug_id in pool.map(apply_changes, list(self.changes))
+                      if bug_id is not None]
+        finally:
+            pool.close()
+            pool.join()
+        self.changes.clear()
+        return failed
+
+
 def set_bugtracker():
     """
     Set the module-level bugtracker attribute to the correct bugtracker, based on the config.
@@ -12,6 +12,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from multiprocessing.pool import ThreadPool
 from threading import Lock
 import logging
 import time
@@ -23,9 +24,11 @@ log = logging.getLogger('bodhi')
 _buildsystem = None
 # URL of the koji hub
 _koji_hub = None
+# The pool of authenticated koji sessions, when using the koji buildsystem
+_session_pool = None
 
 
-class Buildsystem:
+class Buildsystem(object):
     """
     The parent for our buildsystem.  Not only does this help us keep track of
     the functionality that we expect from our buildsystem, but it also alows
@@ -79,6 +82,8 @@ class DevBuildsys(Buildsystem):
     __tagged__ = {}
     __rpms__ = []
 
+    multicall = False
+
     @classmethod
     def clear(cls):
         cls.__untag__ = []
@@ -87,8 +92,24 @@ class DevBuildsys(Buildsystem):
         cls.__tagged__ = {}
         cls.__rpms__ = []
 
-    def multiCall(self):
-        return []
+    def __getattribute__(self, name):
+        """
+        Mimic koji's multicall mode by collecting the results of the calls made while the multicall
+        attribute is True, so that multiCall() can hand them back like koji would.
+        """
+        attr = object.__getattribute__(self, name)
+        if (name.startswith('_') or name in ('multiCall', 'clear') or not callable(attr) or
+                not object.__getattribute__(self, 'multicall')):
+            return attr
+
+        def queue(*args, **kw):
+            self.__dict__.setdefault('_multicall_results', []).append([attr(*args, **kw)])
+        return queue
+
+    def multiCall(self, strict=False):
+        results = self.__dict__.pop('_multicall_results', [])
+        self.multicall = False
+        return results
 
     def moveBuild(self, from_tag, to_tag, build, *args, **kw):
         log.debug("moveBuild(%s, %s, %s)" % (from_tag, to_tag, build))
@@ -319,23 +340,244 @@ def get_krb_conf(config):
     return args
 
 
+class PooledSession(object):
+    """
+    A thin proxy around a koji.ClientSession that was checked out of a KojiSessionPool.
+
+    Attribute access and assignment (such as toggling ``multicall``) are passed through to the
+    wrapped session. The session is checked back into its pool when the proxy is garbage
+    collected, so callers of get_session() don't need to return it explicitly. Calls that fail
+    because the Kerberos ticket or the hub session expired are retried once after logging in again.
+    """
+    def __init__(self, pool, session):
+        self.__dict__['_pool'] = pool
+        self.__dict__['_session'] = session
+
+    def __getattr__(self, name):
+        if name in ('_pool', '_session'):
+            # The session has already been checked back in.
+            raise AttributeError(name)
+        attr = getattr(self._session, name)
+        if name.startswith('_') or not callable(attr) or self._session.multicall:
+            return attr
+
+        def call(*args, **kw):
+            try:
+                return attr(*args, **kw)
+            except koji.AuthExpired:
+                log.info('Koji session expired during %s(), logging in again' % name)
+                self._pool.relogin(self._session)
+                return getattr(self._session, name)(*args, **kw)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._session, name, value)
+
+    def __del__(self):
+        self.checkin()
+
+    def checkin(self):
+        """Return the wrapped session to its pool. This is safe to call more than once."""
+        session = self.__dict__.pop('_session', None)
+        if session is not None:
+            self._pool.checkin(session)
+
+
+class KojiSessionPool(object):
+    """
+    A thread-safe pool of authenticated koji sessions.
+
+    Logging in to koji means a full Kerberos handshake, so instead of creating a new session for
+    every call to get_session() we keep a handful of logged in sessions around and hand them out
+    again. Sessions that have sat idle for longer than ``max_idle_age`` seconds are logged out and
+    dropped, and sessions that have been idle for longer than ``health_check_interval`` seconds are
+    checked with the hub before being reused, logging in again if the ticket has expired.
+
+    The ``hits`` and ``misses`` counters record how many checkouts were served from the pool and
+    how many needed a new login.
+    """
+    def __init__(self, factory, login, size=10, max_idle_age=900, health_check_interval=60):
+        """
+        Args:
+            factory (callable): Called with no arguments to create a new, logged in session.
+            login (callable): Called with an existing session to log it in again.
+            size (int): The maximum number of idle sessions that are kept around.
+            max_idle_age (int): Idle sessions older than this many seconds are discarded.
+            health_check_interval (int): Idle sessions older than this many seconds are checked
+                with the hub before they are handed out.
+        """
+        self.factory = factory
+        self.login = login
+        self.size = size
+        self.max_idle_age = max_idle_age
+        self.health_check_interval = health_check_interval
+        self._idle = []
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.relogins = 0
+        self.discarded = 0
+
+    def checkout(self):
+        """
+        Return a logged in session wrapped in a PooledSession.
+
+        Returns:
+            PooledSession: A proxy for a session that is not in use by anybody else.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                session, last_used = self._idle.pop()
+            idle_time = time.time() - last_used
+            if idle_time > self.max_idle_age:
+                log.debug('Discarding koji session idle for %d seconds' % idle_time)
+                self._discard(session)
+                continue
+            if idle_time > self.health_check_interval and not self._healthy(session):
+                continue
+            with self._lock:
+                self.hits += 1
+            return PooledSession(self, session)
+
+        session = self.factory()
+        with self._lock:
+            self.misses += 1
+        return PooledSession(self, session)
+
+    def checkin(self, session):
+        """
+        Put a session back into the pool, or log it out if the pool is already full.
+
+        Args:
+            session (koji.ClientSession): The session to return to the pool.
+        """
+        # Don't let a half-built multicall leak to the next user of this session.
+        session.multicall = False
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((session, time.time()))
+                return
+        self._discard(session)
+
+    def relogin(self, session):
+        """
+        Log an existing session in again, for example after its ticket expired.
+
+        Args:
+            session (koji.ClientSession): The session to log in.
+        """
+        try:
+            session.logout()
+        except Exception:
+            log.debug('Unable to log out of expired koji session', exc_info=True)
+        self.login(session)
+        with self._lock:
+            self.relogins += 1
+
+    def clear(self):
+        """Log out and forget all of the idle sessions."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, last_used in idle:
+            self._discard(session)
+
+    def stats(self):
+        """
+        Return the pool counters.
+
+        Returns:
+            dict: The number of hits, misses, relogins, discarded and idle sessions.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'relogins': self.relogins,
+                    'discarded': self.discarded, 'idle': len(self._idle)}
+
+    def _healthy(self, session):
+        """
+        Make sure that the given session is still logged in, logging in again if it is not.
+
+        Returns:
+            bool: True if the session can be used, False if it was discarded.
+        """
+        try:
+            if session.getLoggedInUser():
+                return True
+        except koji.AuthError:
+            pass
+        except Exception:
+            log.exception('Koji session failed its health check')
+            self._discard(session)
+            return False
+
+        try:
+            self.relogin(session)
+        except Exception:
+            log.exception('Unable to log in to koji again')
+            self._discard(session)
+            return False
+        return True
+
+    def _discard(self, session):
+        with self._lock:
+            self.discarded += 1
+        try:
+            session.logout()
+        except Exception:
+            log.debug('Unable to log out of discarded koji session', exc_info=True)
+
+
 def get_session():
-    """ Get a new buildsystem instance """
+    """
+    Get a buildsystem instance.
+
+    With the koji buildsystem, sessions come from a KojiSessionPool that is shared by every thread
+    of the process. Each call checks out a logged in session that nobody else is using, and that
+    goes back to the pool, to be handed out again, once the returned PooledSession is garbage
+    collected or its checkin() method is called. Callers should therefore hold on to the session
+    only for as long as they use it, and must not keep it past teardown_buildsystem(), which logs
+    out the pooled sessions. With the dev buildsystem, a new DevBuildsys is returned every time.
+
+    Returns:
+        PooledSession or DevBuildsys: A buildsystem instance that is not in use by anybody else.
+    Raises:
+        RuntimeError: If setup_buildsystem() has not been called.
+    """
     global _buildsystem, _buildsystem_login_lock
     if _buildsystem is None:
         raise RuntimeError('Buildsys needs to be setup')
+    if _session_pool is not None:
+        # The pool has its own lock, and logs new sessions in outside of it, so that threads don't
+        # wait for each other's logins and health checks.
+        return _session_pool.checkout()
     with _buildsystem_login_lock:
         return _buildsystem()
 
 
+def get_pool_stats():
+    """
+    Return the koji session pool counters.
+
+    Returns:
+        dict or None: The counters from KojiSessionPool.stats(), or None if sessions are not pooled.
+    """
+    if _session_pool is None:
+        return None
+    return _session_pool.stats()
+
+
 def teardown_buildsystem():
-    global _buildsystem
+    global _buildsystem, _session_pool
     _buildsystem = None
+    if _session_pool is not None:
+        _session_pool.clear()
+        _session_pool = None
     DevBuildsys.clear()
 
 
 def setup_buildsystem(settings):
-    global _buildsystem, _koji_hub, _buildsystem_login_lock
+    global _buildsystem, _koji_hub, _buildsystem_login_lock, _session_pool
     if _buildsystem:
         return
 
@@ -350,7 +592,17 @@ def setup_buildsystem(settings):
             """Call koji_login with settings and return the result."""
             return koji_login(config=settings)
 
-        _buildsystem = get_koji_login
+        def relogin(session):
+            """Log an existing koji session in again."""
+            if not session.krb_login(**get_krb_conf(settings)):
+                raise koji.AuthError('Koji krb_login failed')
+
+        _session_pool = KojiSessionPool(
+            get_koji_login, relogin,
+            size=int(settings.get('koji_session_pool_size', 10)),
+            max_idle_age=int(settings.get('koji_session_max_idle_age', 900)),
+            health_check_interval=int(settings.get('koji_session_health_check_interval', 60)))
+        _buildsystem = _session_pool.checkout
     elif buildsys in ('dev', 'dummy', None):
         log.debug('Using DevBuildsys')
         _buildsystem = DevBuildsys
@@ -358,24 +610,149 @@ def setup_buildsystem(settings):
         raise ValueError('Buildsys %s not known' % buildsys)
 
 
+def _multicall(session, method, args_list):
+    """
+    Call the given koji method once for each item in args_list, in a single multicall.
+
+    Args:
+        session (koji.ClientSession): The koji session to send the multicall with.
+        method (basestring): The name of the koji method to call.
+        args_list (list): A list of argument tuples, one for each call.
+    Returns:
+        list: The result of each call, in the same order as args_list.
+    Raises:
+        koji.GenericError: If any of the calls returned a fault.
+    """
+    session.multicall = True
+    for args in args_list:
+        getattr(session, method)(*args)
+    results = []
+    for result in session.multiCall():
+        if isinstance(result, dict):
+            raise koji.GenericError('%s failed: %s' % (method, result.get('faultString')))
+        results.append(result[0])
+    return results
+
+
+def multicall(method, args_list, chunk_size=500, threads=1):
+    """
+    Call the given koji method once for each item in args_list, using koji multicalls.
+
+    The calls are split into chunks of at most chunk_size calls, so that a single XML-RPC request
+    doesn't grow without bound. If threads is greater than 1 the chunks are sent concurrently, each
+    from its own koji session.
+
+    Args:
+        method (basestring): The name of the koji method to call, e.g. 'listBuildRPMs'.
+        args_list (list): A list of argument tuples, one for each call.
+        chunk_size (int): The maximum number of calls in a single multicall.
+        threads (int): The maximum number of multicalls that are sent at the same time.
+    Returns:
+        list: The result of each call, in the same order as args_list.
+    Raises:
+        koji.GenericError: If any of the calls returned a fault.
+    """
+    chunk_size = max(int(chunk_size), 1)
+    chunks = [args_list[i:i + chunk_size] for i in range(0, len(args_list), chunk_size)]
+
+    def call_chunk(chunk):
+        return _multicall(get_session(), method, chunk)
+
+    threads = min(int(threads), len(chunks))
+    if threads > 1:
+        log.debug('Sending %d %s multicalls from %d threads' % (len(chunks), method, threads))
+        thread_pool = ThreadPool(threads)
+        try:
+            results = thread_pool.map(call_chunk, chunks)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+    else:
+        results = [call_chunk(chunk) for chunk in chunks]
+
+    return [result for chunk in results for result in chunk]
+
+
+def get_tags(nvrs, session=None, cache=None, chunk_size=500, strict=True):
+    """
+    Return the names of the koji tags of each of the given builds.
+
+    The tags of the builds that are not in the cache yet are fetched with listTags multicalls of
+    at most chunk_size calls, and are added to the cache.
+
+    Args:
+        nvrs (iterable): The NVRs of the builds.
+        session (koji.ClientSession or None): The koji session to use, or None to get one.
+        cache (dict or None): A dictionary mapping NVRs to their tags, which is used to avoid
+            fetching the tags of the same build twice. It is updated with the fetched tags.
+        chunk_size (int): The maximum number of calls in a single multicall.
+        strict (bool): If False, the builds whose tags could not be fetched are left out of the
+            result instead of raising an Exception.
+    Returns:
+        dict: A dictionary mapping the NVR of each build to a list of its tag names.
+    Raises:
+        koji.GenericError: If strict is True and the tags of a build could not be fetched.
+    """
+    if cache is None:
+        cache = {}
+    nvrs = list(nvrs)
+    missing = sorted(set(nvr for nvr in nvrs if nvr not in cache))
+    if missing:
+        if not session:
+            session = get_session()
+        chunk_size = max(int(chunk_size), 1)
+        log.debug('Fetching the koji tags of %d builds' % len(missing))
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            session.multicall = True
+            for nvr in chunk:
+                session.listTags(nvr)
+            for nvr, result in zip(chunk, session.multiCall()):
+                if isinstance(result, dict):
+                    if strict:
+                        raise koji.GenericError('Unable to get the tags of %s: %s' % (
+                            nvr, result.get('faultString')))
+                    log.warn('Unable to get the tags of %s: %s' % (nvr, result.get('faultString')))
+                    continue
+                cache[nvr] = [tag['name'] for tag in result[0]]
+    return dict((nvr, cache[nvr]) for nvr in nvrs if nvr in cache)
+
+
 def wait_for_tasks(tasks, session=None, sleep=300):
     """
-    Wait for a list of koji tasks to complete.  Return the first task number
-    to fail, otherwise zero.
+    Wait for a list of koji tasks to complete.
+
+    All of the unfinished tasks are checked with a single taskFinished multicall per poll. The
+    delay between polls starts at one second and doubles after every poll, up to sleep seconds.
+
+    Args:
+        tasks (list): The IDs of the koji tasks to wait for. Empty IDs are skipped.
+        session (koji.ClientSession or None): The koji session to use, or None to get one.
+        sleep (int): The longest delay between two polls, in seconds.
+    Returns:
+        list: The IDs of the tasks that did not close successfully.
     """
     log.debug("Waiting for %d tasks to complete: %s" % (len(tasks), tasks))
     failed_tasks = []
     if not session:
         session = get_session()
-    for task in tasks:
-        if not task:
-            log.debug("Skipping task: %s" % task)
-            continue
-        while not session.taskFinished(task):
-            time.sleep(sleep)
-        task_info = session.getTaskInfo(task)
-        if task_info['state'] != koji.TASK_STATES['CLOSED']:
-            log.error("Koji task %d failed" % task)
-            failed_tasks.append(task)
+    pending = [task for task in tasks if task]
+    if len(pending) != len(tasks):
+        log.debug("Skipping %d empty tasks" % (len(tasks) - len(pending)))
+    delay = min(1, sleep)
+    while pending:
+        finished = _multicall(session, 'taskFinished', [(task,) for task in pending])
+        done = [task for task, is_finished in zip(pending, finished) if is_finished]
+        if done:
+            task_infos = _multicall(session, 'getTaskInfo', [(task,) for task in done])
+            for task, task_info in zip(done, task_infos):
+                if task_info['state'] != koji.TASK_STATES['CLOSED']:
+                    log.error("Koji task %d failed" % task)
+                    failed_tasks.append(task)
+            pending = [task for task, is_finished in zip(pending, finished) if not is_finished]
+        if pending:
+            log.debug("%d koji tasks are still running" % len(pending))
+            time.sleep(delay)
+            delay = min(delay * 2, sleep)
     log.debug("Tasks completed successfully!")
     return failed_tasks
@@ -20,15 +20,18 @@ mashed.
 """
 
 import copy
+import cProfile
 import functools
 import hashlib
 import json
 import os
+import Queue
+import sys
 import threading
 import time
-import urllib2
 from collections import defaultdict
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from fedmsg_atomic_composer.composer import AtomicComposer
 from fedmsg_atomic_composer.config import config as atomic_config
@@ -38,10 +41,11 @@ import fedmsg.consumers
 
 from bodhi.server import bugs, log, buildsys, notifications, mail, util
 from bodhi.server.config import config
-from bodhi.server.exceptions import BodhiException
+from bodhi.server.exceptions import BodhiException, RepodataException
 from bodhi.server.metadata import ExtendedMetadata
-from bodhi.server.models import (Update, UpdateRequest, UpdateType, Release,
+from bodhi.server.models import (Build, Update, UpdateRequest, UpdateType, Release,
                                  UpdateStatus, ReleaseState, Base)
+from bodhi.server.sync import SyncWatcher
 from bodhi.server.util import sorted_updates, sanity_check_repodata, transactional_session_maker
 
 
@@ -58,8 +62,9 @@ def checkpoint(method):
             if retval is not None:
                 raise ValueError("checkpointed functions may not return stuff")
             # if it didn't raise an exception, mark the checkpoint
-            self.state[key] = True
-            self.save_state()
+            with self.state_lock:
+                self.state[key] = True
+                self.save_state()
         else:
             # cool!  we don't need to do anything, since we ran last time
             pass
@@ -68,6 +73,146 @@ def checkpoint(method):
     return wrapper
 
 
+class MashStep(object):
+    """
+    A step of a push, as run by MasherThread.run_steps().
+
+    Args:
+        name (basestring): The name of the step.
+        func (callable): The function that performs the step.
+        requires (list): The names of the steps that must finish before this one may start.
+        db (bool): Whether the step uses the database session. Such steps are run one at a time on
+            the MasherThread itself, while the others are run on a pool of threads.
+        items (callable): If given, called after the step succeeds to count the items (updates,
+            builds, tags...) that it handled, for the push's profile.
+    """
+    def __init__(self, name, func, requires=(), db=True, items=None):
+        self.name = name
+        self.func = func
+        self.requires = requires
+        self.db = db
+        self.items = items
+
+    def __repr__(self):
+        return '<MashStep %s>' % self.name
+
+
+class CompsUpdater(object):
+    """
+    Refresh the comps git checkout once for all of the repos of a push.
+
+    The first MasherThread that needs comps pulls the latest changes and builds the comps-*.xml
+    files while the others wait for it, so that several make runs never share the checkout. make
+    is skipped if the checkout's HEAD is the one that was last built successfully, which is kept
+    in the bodhi-comps-head file of the checkout's .git directory.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updated = False
+
+    def update(self, log):
+        """
+        Update the comps checkout, unless it was already updated for this push.
+
+        Args:
+            log (logging.Logger): The logger of the MasherThread that needs comps.
+        """
+        with self.lock:
+            if self.updated:
+                log.info('Comps were already updated for this push')
+                return
+
+            log.info("Updating comps")
+            comps_dir = config.get('comps_dir')
+            comps_url = config.get('comps_url')
+            if not comps_url.startswith('https://'):
+                log.error('comps_url must start with https://')
+                return
+
+            if not os.path.exists(comps_dir):
+                util.cmd(['git', 'clone', comps_url, comps_dir], os.path.dirname(comps_dir))
+
+            util.cmd(['git', 'pull'], comps_dir)
+            head = util.cmd(['git', 'rev-parse', 'HEAD'], comps_dir)[0].strip()
+            built_head = os.path.join(comps_dir, '.git', 'bodhi-comps-head')
+            try:
+                with open(built_head) as f:
+                    up_to_date = head and f.read().strip() == head
+            except IOError:
+                up_to_date = False
+
+            if up_to_date:
+                log.info('Comps are already built for %s', head)
+            else:
+                returncode = util.cmd(['make'], comps_dir)[2]
+                if returncode != 0:
+                    # The next repo of this push tries again
+                    log.error('Unable to build comps: make returned %s', returncode)
+                    return
+                if head:
+                    with open(built_head, 'w') as f:
+                        f.write(head)
+            self.updated = True
+
+
+class PushJournal(object):
+    """
+    An append-only record of the actions of a push that have been carried out.
+
+    Each action is a tuple that is written to the journal file as a line of JSON as soon as it is
+    done, so that a resumed push can skip the koji tag actions, bug updates and emails that it
+    already performed before it failed.
+
+    Args:
+        path (basestring or None): The path of the journal file, or None to keep the entries in
+            memory only.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = set()
+
+    def __contains__(self, entry):
+        return tuple(entry) in self.entries
+
+    def load(self):
+        """Load the entries of the journal file, if there is one."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with file(self.path) as journal:
+            for line in journal:
+                try:
+                    self.entries.add(tuple(json.loads(line)))
+                except ValueError:
+                    # The last entry may have been cut short by the crash
+                    pass
+
+    def record(self, *entries):
+        """
+        Append the given entries to the journal, and sync it to disk.
+
+        Args:
+            entries (list): The tuples that describe the actions that were done.
+        """
+        if not entries:
+            return
+        with self.lock:
+            if self.path:
+                with file(self.path, 'a') as journal:
+                    for entry in entries:
+                        journal.write(json.dumps(entry) + '\n')
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            self.entries.update(tuple(entry) for entry in entries)
+
+    def remove(self):
+        """Remove the journal file, and forget its entries."""
+        with self.lock:
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+            self.entries.clear()
+
+
 class Masher(fedmsg.consumers.FedmsgConsumer):
     """The Bodhi Masher.
 
@@ -187,54 +332,90 @@ Once mash is done:
             releases = self.organize_updates(session, body)
             batches = self.prioritize_updates(releases)
 
-        results = []
-        # Important repos first, then normal
-        for batch in batches:
-            # Stable first, then testing
-            for req in ('stable', 'testing'):
-                threads = []
-                for release, request, updates in batch:
-                    if request == req:
-                        self.log.info('Starting thread for %s %s for %d updates',
-                                      release, request, len(updates))
-                        thread = MasherThread(release, request, updates, agent,
-                                              self.log, self.db_factory,
-                                              self.mash_dir, resume)
-                        threads.append(thread)
-                        thread.start()
-                for thread in threads:
-                    thread.join()
-                    for result in thread.results():
-                        results.append(result)
+        # All of the repos of this push are checked against the master mirror from one thread
+        sync_watcher = SyncWatcher.from_config()
+        results = self.run_threads(batches, agent, resume, sync_watcher)
 
         self.log.info('Push complete!  Summary follows:')
         for result in results:
             self.log.info(result)
 
+        pool_stats = buildsys.get_pool_stats()
+        if pool_stats:
+            self.log.info('Koji session pool: %(hits)d hits, %(misses)d misses, '
+                          '%(relogins)d relogins, %(discarded)d discarded' % pool_stats)
+
+    def run_threads(self, batches, agent, resume, sync_watcher):
+        """
+        Run a MasherThread for each of the repos in the given batches, and return their results.
+
+        The important repos are started before the normal ones, and the stable repos of each batch
+        before the testing ones. At most masher_max_concurrent_mashes threads run at once, and the
+        next repo is started as soon as one of them finishes.
+        """
+        queue = Queue.PriorityQueue()
+        for priority, batch in enumerate(batches):
+            for order, (release, request, updates) in enumerate(batch):
+                # Stable first, then testing
+                if request in ('stable', 'testing'):
+                    key = (priority, ('stable', 'testing').index(request), order)
+                    queue.put((key, release, request, updates))
+
+        max_threads = max(1, int(config.get('masher_max_concurrent_mashes', 4)))
+        finished = Queue.Queue()
+        comps_updater = CompsUpdater()
+        running = 0
+        results = []
+        while running or not queue.empty():
+            while running < max_threads and not queue.empty():
+                key, release, request, updates = queue.get()
+                self.log.info('Starting thread for %s %s for %d updates',
+                              release, request, len(updates))
+                thread = MasherThread(release, request, updates, agent,
+                                      self.log, self.db_factory,
+                                      self.mash_dir, resume, sync_watcher, finished,
+                                      comps_updater)
+                thread.start()
+                running += 1
+            thread = finished.get()
+            thread.join()
+            running -= 1
+            results.extend(thread.results())
+        return results
+
     def organize_updates(self, session, body):
         # {Release: {UpdateRequest: [Update,]}}
         releases = defaultdict(lambda: defaultdict(list))
+        updates = Update.get_by_titles(body['updates'], session)
+        found = set(update.title for update in updates)
         for title in body['updates']:
-            update = session.query(Update).filter_by(title=title).first()
-            if update:
-                if not update.request:
-                    self.log.info('%s request revoked' % update.title)
-                    continue
-                update.locked = True
-                update.date_locked = datetime.utcnow()
-                repo = releases[update.release.name][update.request.value]
-                repo.append(update)
-            else:
+            if title not in found:
                 self.log.warn('Cannot find update: %s' % title)
+        requested = []
+        for update in updates:
+            if not update.request:
+                self.log.info('%s request revoked' % update.title)
+                continue
+            requested.append(update)
+            repo = releases[update.release.name][update.request.value]
+            repo.append(update)
+        Update.lock_all(requested, session)
         return releases
 
 
 class MasherThread(threading.Thread):
 
     def __init__(self, release, request, updates, agent,
-                 log, db_factory, mash_dir, resume=False):
+                 log, db_factory, mash_dir, resume=False, sync_watcher=None, finished=None,
+                 comps_updater=None):
         super(MasherThread, self).__init__()
         self.db_factory = db_factory
+        # The queue that the thread puts itself on once it is done, if any
+        self.finished = finished
+        # Refreshes comps once for all of the repos of the push
+        self.comps_updater = comps_updater or CompsUpdater()
+        # The watcher that wait_for_sync() shares with the rest of the push
+        self.sync_watcher = sync_watcher
         self.log = log
         self.agent = agent
         self.mash_dir = mash_dir
@@ -246,7 +427,18 @@ class MasherThread(threading.Thread):
         self.move_tags_async = []
         self.add_tags_sync = []
         self.move_tags_sync = []
+        # The actions of the push that have been carried out, replaced by init_state()
+        self.journal = PushJournal(None)
+        # The koji tags of the builds in this push as they were before the tag actions, by NVR
+        self.build_tags = {}
         self.testing_digest = {}
+        self.mash_thread = None
+        self.uinfo = None
+        # When each step of the push started and ended, keyed by the step's name
+        self.step_times = {}
+        # Steps running on other threads may change and save the state at the same time. It is
+        # reentrant so that a change and the save_state() that follows it can hold it together.
+        self.state_lock = threading.RLock()
         self.state = {
             'updates': updates,
             'completed_repos': []
@@ -261,6 +453,9 @@ class MasherThread(threading.Thread):
                 self.db = None
         except:
             self.log.exception('MasherThread failed. Transaction rolled back.')
+        finally:
+            if self.finished is not None:
+                self.finished.put(self)
 
     def results(self):
         attrs = ['name', 'success']
@@ -287,6 +482,7 @@ class MasherThread(threading.Thread):
             self.skip_mash = True
 
         self.log.info('Running MasherThread(%s)' % self.id)
+        self.start_time = time.time()
         self.init_state()
         if not self.resume:
             self.init_path()
@@ -303,83 +499,231 @@ class MasherThread(threading.Thread):
             else:
                 self.save_state()
 
-            self.load_updates()
-            self.verify_updates()
+            self.run_step(MashStep('load_updates', self.load_updates, items=self._count_updates))
+            self.run_step(MashStep('verify_updates', self.verify_updates,
+                                   items=self._count_updates))
 
             if self.request is UpdateRequest.stable:
-                self.perform_gating()
+                self.run_step(MashStep('perform_gating', self.perform_gating,
+                                       items=self._count_updates))
 
-            self.determine_and_perform_tag_actions()
+            steps = self.get_steps()
+            if self.id in config.get('masher_cprofile_repos', '').split():
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(self.run_steps, steps)
+                finally:
+                    stats = os.path.join(self.path, 'profile.pstats')
+                    profiler.dump_stats(stats)
+                    self.log.info('cProfile stats saved to %s', stats)
+            else:
+                self.run_steps(steps)
 
-            self.update_security_bugs()
+            self.success = True
+            self.remove_state()
+            self.unlock_updates()
 
-            self.expire_buildroot_overrides()
-            self.remove_pending_tags()
-            self.update_comps()
+            self.check_all_karma_thresholds()
+            self.obsolete_older_updates()
 
-            if not self.skip_mash:
-                mash_thread = self.mash()
+        except:
+            self.log.exception('Exception in MasherThread(%s)' % self.id)
+            self.save_state()
+            raise
+        finally:
+            self.finish(self.success)
 
-            # Things we can do while we're mashing
-            self.complete_requests()
-            self.generate_testing_digest()
+    def get_steps(self):
+        """
+        Return the steps of the push, along with the steps that each of them depends on.
 
-            if not self.skip_mash:
-                uinfo = self.generate_updateinfo()
+        The steps that use the database session are run one at a time on this thread, in the order
+        they are listed here, while the others (git, mash, filesystem and mirror polling) are run
+        alongside them on a small pool of threads.
 
-                self.wait_for_mash(mash_thread)
+        Returns:
+            list: A list of MashStep objects.
+        """
+        updates = self._count_updates
+        steps = [
+            MashStep('determine_and_perform_tag_actions', self.determine_and_perform_tag_actions,
+                     items=self._count_tag_actions),
+            MashStep('update_comps', self.update_comps, db=False),
+            MashStep('expire_buildroot_overrides', self.expire_buildroot_overrides,
+                     requires=['determine_and_perform_tag_actions'], items=updates),
+            MashStep('remove_pending_tags', self.remove_pending_tags,
+                     requires=['determine_and_perform_tag_actions'], items=updates),
+            MashStep('update_security_bugs', self.update_security_bugs,
+                     requires=['determine_and_perform_tag_actions'], items=updates),
+        ]
+
+        if not self.skip_mash:
+            steps.append(MashStep('mash', self._start_mash,
+                                  requires=['determine_and_perform_tag_actions', 'update_comps']))
+
+        # Things we can do while we're mashing
+        steps.extend([
+            MashStep('complete_requests', self.complete_requests,
+                     requires=['expire_buildroot_overrides', 'remove_pending_tags'], items=updates),
+            MashStep('generate_testing_digest', self.generate_testing_digest,
+                     requires=['complete_requests'],
+                     items=lambda: sum(len(builds) for builds in self.testing_digest.values())),
+        ])
+
+        if not self.skip_mash:
+            steps.extend([
+                MashStep('generate_updateinfo', self._generate_updateinfo,
+                         requires=['complete_requests'], items=lambda: len(self.uinfo.updates)),
+                MashStep('wait_for_mash', self._wait_for_mash, requires=['mash'], db=False),
+                MashStep('insert_updateinfo', self._insert_updateinfo,
+                         requires=['generate_updateinfo', 'wait_for_mash'], db=False),
+            ])
+
+        # Compose OSTrees from our freshly mashed repos
+        if config.get('compose_atomic_trees'):
+            steps.append(MashStep('compose_atomic_trees', self.compose_atomic_trees,
+                                  requires=['insert_updateinfo', 'complete_requests'], db=False))
+
+        if not self.skip_mash:
+            steps.extend([
+                MashStep('sanity_check_repo', self.sanity_check_repo,
+                         requires=['insert_updateinfo'], db=False),
+                MashStep('stage_repo', self.stage_repo,
+                         requires=['sanity_check_repo', 'compose_atomic_trees'], db=False),
+                # Wait for the repo to hit the master mirror
+                MashStep('wait_for_sync', self.wait_for_sync, requires=['stage_repo'], db=False),
+            ])
 
-                uinfo.insert_updateinfo()
-                uinfo.insert_pkgtags()
-                uinfo.cache_repodata()
+        # Nothing is announced until everything above has finished, and the repo has hit the
+        # master mirror.
+        announce = [step.name for step in steps]
+        steps.extend([
+            # Send fedmsg notifications
+            MashStep('send_notifications', self.send_notifications, requires=announce,
+                     items=updates),
+            # Update bugzillas
+            MashStep('modify_bugs', self.modify_bugs, requires=announce, items=updates),
+            # Add comments to updates
+            MashStep('status_comments', self.status_comments, requires=announce, items=updates),
+            # Announce stable updates to the mailing list
+            MashStep('send_stable_announcements', self.send_stable_announcements,
+                     requires=announce, items=updates),
+            # Email updates-testing digest
+            MashStep('send_testing_digest', self.send_testing_digest, requires=announce,
+                     items=lambda: len(self.testing_digest)),
+        ])
+        return steps
 
-            # Compose OSTrees from our freshly mashed repos
-            if config.get('compose_atomic_trees'):
-                self.compose_atomic_trees()
+    def run_steps(self, steps):
+        """
+        Run the given steps, starting each one as soon as the steps it requires have finished.
 
-            if not self.skip_mash:
-                self.sanity_check_repo()
-                self.stage_repo()
+        Steps that use the database are run on this thread, since neither the session nor the
+        transaction it belongs to may be shared between threads. The other steps are run on a pool
+        of masher_step_threads threads. Requirements that are not among the given steps are
+        ignored. If a step fails, no further steps are started, and the exception is re-raised
+        once the steps that are already running have finished.
 
-                # Wait for the repo to hit the master mirror
-                self.wait_for_sync()
+        Args:
+            steps (list): A list of MashStep objects.
+        Raises:
+            ValueError: If the steps' requirements form a cycle.
+        """
+        names = set(step.name for step in steps)
+        pending = [(step, set(step.requires) & names) for step in steps]
+        done = set()
+        running = set()
+        finished = Queue.Queue()
+        failure = None
+        pool = ThreadPool(int(config.get('masher_step_threads', 4)))
+
+        def call(step):
+            try:
+                self.run_step(step)
+                return step.name, None
+            except:
+                return step.name, sys.exc_info()
 
-            # Send fedmsg notifications
-            self.send_notifications()
+        try:
+            while (pending and failure is None) or running:
+                ready = []
+                if failure is None:
+                    ready = [step for step, requires in pending if requires <= done]
+                    pending = [(step, requires) for step, requires in pending
+                               if step not in ready]
+
+                for step in ready:
+                    if not step.db:
+                        running.add(step.name)
+                        pool.apply_async(call, (step,), callback=finished.put)
+
+                inline = [step for step in ready if step.db]
+                if inline:
+                    # Run the first of them now, and put the rest back to be picked up next time
+                    pending = [(step, set()) for step in inline[1:]] + pending
+                    running.add(inline[0].name)
+                    finished.put(call(inline[0]))
+                elif not running:
+                    raise ValueError('The requirements of %s cannot be met' % (
+                        ', '.join(step.name for step, requires in pending)))
+
+                name, exc_info = finished.get()
+                running.remove(name)
+                if exc_info is None:
+                    done.add(name)
+                elif failure is None:
+                    failure = exc_info
+        finally:
+            pool.close()
+            pool.join()
 
-            # Update bugzillas
-            self.modify_bugs()
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
 
-            # Add comments to updates
-            self.status_comments()
+    def run_step(self, step):
+        """
+        Run a single step, recording when it started and ended, and how many items it handled, in
+        self.step_times.
 
-            # Announce stable updates to the mailing list
-            self.send_stable_announcements()
+        Args:
+            step (MashStep): The step to run.
+        """
+        record = {'start': time.time(), 'success': False, 'items': None}
+        self.step_times[step.name] = record
+        try:
+            step.func()
+            if step.items is not None:
+                record['items'] = step.items()
+            record['success'] = True
+        finally:
+            record['end'] = time.time()
+            record['duration'] = record['end'] - record['start']
+            self.log.info('%s took %.2f seconds', step.name, record['duration'])
 
-            # Email updates-testing digest
-            self.send_testing_digest()
+    def _count_updates(self):
+        return len(self.updates)
 
-            self.success = True
-            self.remove_state()
-            self.unlock_updates()
+    def _count_tag_actions(self):
+        return sum(len(actions) for actions in (self.add_tags_sync, self.move_tags_sync,
+                                                self.add_tags_async, self.move_tags_async))
 
-            self.check_all_karma_thresholds()
-            self.obsolete_older_updates()
+    def _start_mash(self):
+        self.mash_thread = self.mash()
 
-        except:
-            self.log.exception('Exception in MasherThread(%s)' % self.id)
-            self.save_state()
-            raise
-        finally:
-            self.finish(self.success)
+    def _wait_for_mash(self):
+        self.wait_for_mash(self.mash_thread)
+
+    def _generate_updateinfo(self):
+        self.uinfo = self.generate_updateinfo()
+
+    def _insert_updateinfo(self):
+        self.uinfo.insert_updateinfo()
+        self.uinfo.insert_pkgtags()
+        self.uinfo.cache_repodata()
 
     def load_updates(self):
         self.log.debug('Loading updates')
-        updates = []
-        for title in self.state['updates']:
-            update = self.db.query(Update).filter_by(title=title).first()
-            if update:
-                updates.append(update)
+        updates = Update.get_by_titles(self.state['updates'], self.db)
         if not updates:
             raise Exception('Unable to load updates: %r' %
                             self.state['updates'])
@@ -449,8 +793,9 @@ class MasherThread(threading.Thread):
             update.remove_tag(update.release.pending_testing_tag,
                               koji=buildsys.get_session())
         update.request = None
-        if update.title in self.state['updates']:
-            self.state['updates'].remove(update.title)
+        with self.state_lock:
+            if update.title in self.state['updates']:
+                self.state['updates'].remove(update.title)
         if update in self.updates:
             self.updates.remove(update)
         notifications.publish(
@@ -482,13 +827,18 @@ class MasherThread(threading.Thread):
             self.log.error('Trying to do a fresh push and masher lock already '
                            'exists: %s' % self.mash_lock)
             raise Exception
+        self.journal = PushJournal(os.path.join(self.mash_dir, 'JOURNAL-%s' % self.id))
+        if not self.resume:
+            # A journal left behind by a push that was never resumed must not be replayed
+            self.journal.remove()
 
     def save_state(self):
         """
         Save the state of this push so it can be resumed later if necessary
         """
-        with file(self.mash_lock, 'w') as lock:
-            json.dump(self.state, lock)
+        with self.state_lock:
+            with file(self.mash_lock, 'w') as lock:
+                json.dump(self.state, lock)
         self.log.info('Masher lock saved: %s', self.mash_lock)
 
     def load_state(self):
@@ -499,6 +849,9 @@ class MasherThread(threading.Thread):
             self.state = json.load(lock)
         self.log.info('Masher state loaded from %s', self.mash_lock)
         self.log.info(self.state)
+        self.journal.load()
+        self.log.info('Loaded %d completed actions from %s', len(self.journal.entries),
+                      self.journal.path)
         for path in self.state['completed_repos']:
             if self.id in path:
                 self.path = path
@@ -510,22 +863,64 @@ class MasherThread(threading.Thread):
     def remove_state(self):
         self.log.info('Removing state: %s', self.mash_lock)
         os.remove(self.mash_lock)
+        self.journal.remove()
 
     def finish(self, success):
         self.log.info('Thread(%s) finished.  Success: %r' % (self.id, success))
+        profile = self.write_profile(success)
         notifications.publish(
             topic="mashtask.complete",
-            msg=dict(success=success, repo=self.id, agent=self.agent),
+            msg=dict(success=success, repo=self.id, agent=self.agent, profile=dict(
+                duration=round(profile['duration'], 2),
+                steps=dict((step['name'], round(step['duration'], 2))
+                           for step in profile['steps']))),
             force=True,
         )
 
+    def write_profile(self, success):
+        """
+        Write a report of how long the push took, and how long each of its steps took, as
+        profile.json in the mash directory.
+
+        Args:
+            success (bool): Whether the push succeeded.
+        Returns:
+            dict: The report.
+        """
+        end = time.time()
+        steps = [dict(record, name=name) for name, record in self.step_times.items()]
+        steps.sort(key=lambda step: step['start'])
+        profile = {
+            'repo': self.id,
+            'request': self.request.value,
+            'success': success,
+            'start': self.start_time,
+            'end': end,
+            'duration': end - self.start_time,
+            'updates': len(self.state['updates']),
+            'steps': steps,
+        }
+
+        path = getattr(self, 'path', None)
+        if path and os.path.isdir(path):
+            report = os.path.join(path, 'profile.json')
+            try:
+                with file(report, 'w') as f:
+                    json.dump(profile, f, indent=2, sort_keys=True)
+                self.log.info('Push profile saved to %s', report)
+            except (IOError, OSError):
+                self.log.exception('Unable to save the push profile to %s', report)
+        return profile
+
     def update_security_bugs(self):
         """Update the bug titles for security updates"""
         self.log.info('Updating bug titles for security updates')
-        for update in self.updates:
-            if update.type is UpdateType.security:
-                for bug in update.bugs:
-                    bug.update_details()
+        security_bugs = [bug for update in self.updates if update.type is UpdateType.security
+                         for bug in update.bugs]
+        # Fetch all of the bugs with a few calls, rather than one at a time
+        fetched = bugs.bugtracker.getbugs(set(bug.bug_id for bug in security_bugs))
+        for bug in security_bugs:
+            bug.update_details(fetched.get(bug.bug_id))
 
     @checkpoint
     def determine_and_perform_tag_actions(self):
@@ -534,6 +929,9 @@ class MasherThread(threading.Thread):
 
     def _determine_tag_actions(self):
         tag_types, tag_rels = Release.get_tags(self.db)
+        # Look up the tags of every build in the push with a few multicalls
+        Build.get_tags_for([build for update in self.updates for build in update.builds],
+                           cache=self.build_tags)
         # sync & async tagging batches
         for i, batch in enumerate(sorted_updates(self.updates)):
             for update in batch:
@@ -546,8 +944,12 @@ class MasherThread(threading.Thread):
                     status = 'candidate'
 
                 for build in update.builds:
+                    if ('tag', build.nvr, update.requested_tag) in self.journal:
+                        self.log.info('%s was already tagged into %s' % (
+                            build.nvr, update.requested_tag))
+                        continue
                     from_tag = None
-                    tags = build.get_tags()
+                    tags = build.get_tags(cache=self.build_tags)
                     for tag in tags:
                         if tag in tag_types[status]:
                             from_tag = tag
@@ -572,30 +974,56 @@ class MasherThread(threading.Thread):
                         self.move_tags_async.extend(move_tags)
 
     def _perform_tag_actions(self):
+        """
+        Tag or move the builds of this push in koji.
+
+        The builds of different packages do not depend on each other, so they are tagged in
+        parallel multicalls. The builds of a package that has several builds in the push are
+        tagged one round at a time, in the order given by sorted_updates(), so that the highest
+        version is tagged last and becomes the latest build of the package in koji.
+        """
         koji = buildsys.get_session()
-        for i, batches in enumerate([(self.add_tags_sync, self.move_tags_sync),
-                                     (self.add_tags_async, self.move_tags_async)]):
-            add, move = batches
-            if i == 0:
-                koji.multicall = False
-            else:
-                koji.multicall = True
-            for action in add:
-                tag, build = action
+        chunk_size = int(config.get('koji_multicall_chunk_size', 500))
+        threads = int(config.get('masher_tag_threads', 4))
+
+        # The nth action of each package goes into the nth round
+        rounds = []
+        package_actions = defaultdict(int)
+        for method, actions in [('tagBuild', self.add_tags_sync),
+                                ('moveBuild', self.move_tags_sync),
+                                ('tagBuild', self.add_tags_async),
+                                ('moveBuild', self.move_tags_async)]:
+            for action in actions:
+                package = util.get_nvr(action[-1])[0]
+                if package_actions[package] == len(rounds):
+                    rounds.append({'tagBuild': [], 'moveBuild': []})
+                rounds[package_actions[package]][method].append(action)
+                package_actions[package] += 1
+
+        for i, round_actions in enumerate(rounds):
+            tasks = []
+            for tag, build in round_actions['tagBuild']:
                 self.log.info("Adding tag %s to %s" % (tag, build))
-                koji.tagBuild(tag, build, force=True)
-            for action in move:
-                from_tag, to_tag, build = action
-                self.log.info('Moving %s from %s to %s' % (
-                              build, from_tag, to_tag))
-                koji.moveBuild(from_tag, to_tag, build, force=True)
-
-            if i != 0:
-                results = koji.multiCall()
-                failed_tasks = buildsys.wait_for_tasks([task[0] for task in results],
-                                                       koji, sleep=15)
-                if failed_tasks:
-                    raise Exception("Failed to move builds: %s" % failed_tasks)
+            for from_tag, to_tag, build in round_actions['moveBuild']:
+                self.log.info('Moving %s from %s to %s' % (build, from_tag, to_tag))
+            for method in ('tagBuild', 'moveBuild'):
+                if round_actions[method]:
+                    # The last argument is force=True
+                    tasks.extend(buildsys.multicall(
+                        method, [tuple(action) + (True,) for action in round_actions[method]],
+                        chunk_size=chunk_size, threads=threads))
+
+            self.log.info('Waiting for %d koji tasks of tagging round %d of %d' % (
+                          len(tasks), i + 1, len(rounds)))
+            failed_tasks = buildsys.wait_for_tasks(tasks, koji, sleep=15)
+            # Journal the actions whose tasks succeeded, so that a resumed push skips them. The
+            # tasks are in the same order as the actions.
+            actions = round_actions['tagBuild'] + round_actions['moveBuild']
+            self.journal.record(*[('tag', action[-1], action[-2])
+                                  for action, task in zip(actions, tasks)
+                                  if task not in failed_tasks])
+            if failed_tasks:
+                raise Exception("Failed to move builds: %s" % failed_tasks)
 
     def expire_buildroot_overrides(self):
         """ Expire any buildroot overrides that are in this push """
@@ -629,18 +1057,7 @@ class MasherThread(threading.Thread):
         Update our comps git module and merge the latest translations so we can
         pass it to mash insert into the repodata.
         """
-        self.log.info("Updating comps")
-        comps_dir = config.get('comps_dir')
-        comps_url = config.get('comps_url')
-        if not comps_url.startswith('https://'):
-            self.log.error('comps_url must start with https://')
-            return
-
-        if not os.path.exists(comps_dir):
-            util.cmd(['git', 'clone', comps_url, comps_dir], os.path.dirname(comps_dir))
-
-        util.cmd(['git', 'pull'], comps_dir)
-        util.cmd(['make'], comps_dir)
+        self.comps_updater.update(self.log)
 
     def mash(self):
         if self.path in self.state['completed_repos']:
@@ -662,8 +1079,9 @@ class MasherThread(threading.Thread):
         self.log.debug('Waiting for mash thread to finish')
         mash_thread.join()
         if mash_thread.success:
-            self.state['completed_repos'].append(self.path)
-            self.save_state()
+            with self.state_lock:
+                self.state['completed_repos'].append(self.path)
+                self.save_state()
         else:
             raise Exception
 
@@ -675,23 +1093,28 @@ class MasherThread(threading.Thread):
             else:
                 self.log.warn('Update %s missing request', update.title)
 
-    def add_to_digest(self, update):
+    def add_to_digest(self, update, template_data=None):
         """Add an package to the digest dictionary.
 
         {'release-id': {'build nvr': body text for build, ...}}
+
+        template_data is the koji data of the update's builds, as returned by
+        mail.prefetch_template_data().
         """
         prefix = update.release.long_name
         if prefix not in self.testing_digest:
             self.testing_digest[prefix] = {}
         for i, subbody in enumerate(mail.get_template(
-                update, use_template='maillist_template')):
+                update, use_template='maillist_template', template_data=template_data)):
             self.testing_digest[prefix][update.builds[i].nvr] = subbody[1]
 
     def generate_testing_digest(self):
         self.log.info('Generating testing digest for %s' % self.release.name)
-        for update in self.updates:
-            if update.status is UpdateStatus.testing:
-                self.add_to_digest(update)
+        updates = [update for update in self.updates if update.status is UpdateStatus.testing]
+        # Fetch the RPM headers and latest builds of all of the updates at once
+        template_data = mail.prefetch_template_data(updates)
+        for update in updates:
+            self.add_to_digest(update, template_data)
         self.log.info('Testing digest generation for %s complete' % self.release.name)
 
     def generate_updateinfo(self):
@@ -706,30 +1129,57 @@ class MasherThread(threading.Thread):
 
             - make sure we didn't compose a repo full of symlinks
             - sanity check our repodata
+
+        The arches of the repo are checked in parallel, and how long each one took is logged.
         """
         mash_path = os.path.join(self.path, self.id)
         self.log.info("Running sanity checks on %s" % mash_path)
 
-        # sanity check our repodata
         arches = os.listdir(mash_path)
-        for arch in arches:
-            try:
-                repodata = os.path.join(mash_path, arch, 'repodata')
-                sanity_check_repodata(repodata)
-            except Exception, e:
-                self.log.error("Repodata sanity check failed!\n%s" % str(e))
-                raise
-
-        # make sure that mash didn't symlink our packages
-        for pkg in os.listdir(os.path.join(mash_path, arches[0])):
-            if pkg.endswith('.rpm'):
-                if os.path.islink(os.path.join(mash_path, arches[0], pkg)):
-                    self.log.error("Mashed repository full of symlinks!")
-                    raise Exception
-                break
+        if not arches:
+            raise RepodataException('%s does not contain any arches' % mash_path)
+
+        pool = ThreadPool(len(arches))
+        try:
+            results = pool.map(functools.partial(self.sanity_check_arch, mash_path), arches)
+        finally:
+            pool.close()
+            pool.join()
+
+        failures = [exception for arch, duration, exception in results if exception]
+        for arch, duration, exception in results:
+            self.log.info('Checked the %s repodata in %.2f seconds: %s', arch, duration,
+                          'failed' if exception else 'ok')
+        if failures:
+            raise failures[0]
 
         return True
 
+    def sanity_check_arch(self, mash_path, arch):
+        """
+        Sanity check the repodata and the packages of one arch of our repo.
+
+        Args:
+            mash_path (basestring): The path of the mashed repo.
+            arch (basestring): The arch to check.
+        Returns:
+            tuple: The arch, how many seconds the check took, and the exception it raised or None.
+        """
+        start = time.time()
+        try:
+            sanity_check_repodata(os.path.join(mash_path, arch, 'repodata'))
+
+            # make sure that mash didn't symlink our packages
+            for pkg in os.listdir(os.path.join(mash_path, arch)):
+                if pkg.endswith('.rpm'):
+                    if os.path.islink(os.path.join(mash_path, arch, pkg)):
+                        raise Exception("Mashed repository full of symlinks!")
+                    break
+        except Exception, e:
+            self.log.error("Repodata sanity check of %s failed!\n%s" % (arch, str(e)))
+            return arch, time.time() - start, e
+        return arch, time.time() - start, None
+
     def stage_repo(self):
         """Symlink our updates repository into the staging directory"""
         stage_dir = config.get('mash_stage_dir')
@@ -761,27 +1211,14 @@ class MasherThread(threading.Thread):
         master_repomd_url = self._get_master_repomd_url(arch)
 
         checksum = hashlib.sha1(file(repomd).read()).hexdigest()
-        while True:
-            try:
-                self.log.info('Polling %s' % master_repomd_url)
-                masterrepomd = urllib2.urlopen(master_repomd_url)
-            except (urllib2.URLError, urllib2.HTTPError):
-                self.log.exception('Error fetching repomd.xml')
-                time.sleep(200)
-                continue
-            newsum = hashlib.sha1(masterrepomd.read()).hexdigest()
-            if newsum == checksum:
-                self.log.info("master repomd.xml matches!")
-                notifications.publish(
-                    topic="mashtask.sync.done",
-                    msg=dict(repo=self.id, agent=self.agent),
-                    force=True,
-                )
-                return
-
-            self.log.debug("master repomd.xml doesn't match! %s != %s for %r",
-                           checksum, newsum, self.id)
-            time.sleep(200)
+        sync_watcher = self.sync_watcher or SyncWatcher.from_config()
+        if not sync_watcher.watch(master_repomd_url, checksum).wait():
+            raise Exception('Timed out waiting for %s to hit the master mirror' % self.id)
+        notifications.publish(
+            topic="mashtask.sync.done",
+            msg=dict(repo=self.id, agent=self.agent),
+            force=True,
+        )
 
     def send_notifications(self):
         self.log.info('Sending notifications')
@@ -800,9 +1237,37 @@ class MasherThread(threading.Thread):
     @checkpoint
     def modify_bugs(self):
         self.log.info('Updating bugs')
+        # The changes to the bugs of every update are gathered, and then made all at once. Each
+        # update is journaled as soon as the changes to all of its bugs are made, so that a resumed
+        # push only redoes the updates whose bugs were not all modified.
+        bug_sync = bugs.BugSync()
+        pending = {}
         for update in self.updates:
+            if ('modify_bugs', update.title) in self.journal:
+                self.log.debug('The bugs of %s were already modified', update.title)
+                continue
             self.log.debug('Modifying bugs for %s', update.title)
-            update.modify_bugs()
+            update.modify_bugs(tracker=bug_sync)
+            pending[update.title] = set(
+                bug.bug_id for bug in update.bugs if bug.bug_id in bug_sync.changes)
+        self.journal.record(*[('modify_bugs', title) for title, bug_ids in pending.items()
+                              if not bug_ids])
+        pending = dict((title, bug_ids) for title, bug_ids in pending.items() if bug_ids)
+        lock = threading.Lock()
+
+        def done(bug_id):
+            with lock:
+                for bug_ids in pending.values():
+                    bug_ids.discard(bug_id)
+                finished = [title for title, bug_ids in pending.items() if not bug_ids]
+                for title in finished:
+                    del pending[title]
+            self.journal.record(*[('modify_bugs', title) for title in finished])
+
+        failed = bug_sync.apply(done=done)
+        if failed:
+            raise Exception('Unable to modify bugs %s of %s' % (
+                ', '.join('#%d' % bug_id for bug_id in sorted(failed)), ', '.join(sorted(pending))))
 
     def status_comments(self):
         self.log.info('Commenting on updates')
@@ -812,9 +1277,15 @@ class MasherThread(threading.Thread):
     @checkpoint
     def send_stable_announcements(self):
         self.log.info('Sending stable update announcements')
-        for update in self.updates:
-            if update.status is UpdateStatus.stable:
-                update.send_update_notice()
+        updates = [update for update in self.updates if update.status is UpdateStatus.stable and
+                   ('announce', update.title) not in self.journal]
+        # Fetch the RPM headers and latest builds of all of the updates at once
+        template_data = mail.prefetch_template_data(updates)
+        for update in updates:
+            # Sent right away rather than through the outbox, since the journal records it as
+            # sent before this push's transaction commits.
+            update.send_update_notice(template_data)
+            self.journal.record(('announce', update.title))
 
     @checkpoint
     def send_testing_digest(self):
@@ -825,6 +1296,9 @@ class MasherThread(threading.Thread):
         testhead = u'The following builds have been pushed to %s updates-testing\n\n'
 
         for prefix, content in self.testing_digest.iteritems():
+            if ('testing_digest', prefix) in self.journal:
+                log.debug('The updates-testing digest for %s was already sent', prefix)
+                continue
             release = self.db.query(Release).filter_by(long_name=prefix).one()
             test_list_key = '%s_test_announce_list' % (
                 release.id_prefix.lower().replace('-', '_'))
@@ -865,8 +1339,10 @@ class MasherThread(threading.Thread):
             for nvr in updlist:
                 maildata += u"\n" + self.testing_digest[prefix][nvr]
 
+            # Sent right away, like the stable update announcements
             mail.send_mail(config.get('bodhi_email'), test_list,
                            '%s updates-testing report' % prefix, maildata)
+            self.journal.record(('testing_digest', prefix))
 
     def get_security_updates(self, release):
         release = self.db.query(Release).filter_by(long_name=release).one()
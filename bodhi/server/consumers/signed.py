@@ -20,10 +20,15 @@ from the pending-signing to pending-updates-testing tag by RoboSignatory.
 
 import logging
 import pprint
+import Queue
+import threading
+import time
 
+from sqlalchemy import and_, or_
 import fedmsg.consumers
 
-from bodhi.server.models import Build, get_db_factory
+from bodhi.server.config import config
+from bodhi.server.models import Build, Release, get_db_factory
 
 
 log = logging.getLogger('bodhi')
@@ -46,6 +51,19 @@ class SignedHandler(fedmsg.consumers.FedmsgConsumer):
             prefix + '.' + env + '.buildsys.tag'
         ]
 
+        # The builds tagged within batch_window seconds of each other, up to batch_size of them,
+        # are marked as signed together.
+        self.batch_window = float(config.get('signed_handler_batch_window', 1))
+        self.batch_size = int(config.get('signed_handler_batch_size', 500))
+        self.incoming_builds = Queue.Queue()
+        self.batch_thread = None
+        self.batch_thread_lock = threading.Lock()
+        # The IDs of the releases that use each pending_testing tag, reloaded at most every
+        # tag_cache_ttl seconds
+        self.tag_cache_ttl = float(config.get('signed_handler_tag_cache_ttl', 60))
+        self.pending_testing_tags = {}
+        self.pending_testing_tags_loaded = None
+
         super(SignedHandler, self).__init__(hub, *args, **kwargs)
         log.info('Bodhi signed handler listening on:\n'
                  '%s' % pprint.pformat(self.topic))
@@ -54,7 +72,8 @@ class SignedHandler(fedmsg.consumers.FedmsgConsumer):
         """
         The method called when a fedmsg arrives with the configured topic.
 
-        This marks a build as signed if it is assigned to the pending testing release tag.
+        This queues the build to be marked as signed if it was tagged into the pending testing tag
+        of a release. Messages about other tags are dropped without querying the database.
 
         Example message format::
             {
@@ -89,25 +108,93 @@ class SignedHandler(fedmsg.consumers.FedmsgConsumer):
         build_nvr = '%(name)s-%(version)s-%(release)s' % msg
         tag = msg['tag']
 
+        if tag not in self.get_pending_testing_tags():
+            log.debug("%s tagged into %s, which is not a pending_testing tag, skipping" % (
+                build_nvr, tag))
+            return
+
         log.info("%s tagged into %s" % (build_nvr, tag))
 
+        with self.batch_thread_lock:
+            if self.batch_thread is None or not self.batch_thread.is_alive():
+                self.batch_thread = threading.Thread(target=self.handle_batches,
+                                                     name='SignedHandlerBatches')
+                self.batch_thread.daemon = True
+                self.batch_thread.start()
+        self.incoming_builds.put((build_nvr, tag))
+
+    def get_pending_testing_tags(self):
+        """
+        Return the pending_testing tags of the releases, from the cache if it is recent enough.
+
+        Returns:
+            dict: The IDs of the releases that use each pending_testing tag, keyed by tag.
+        """
+        now = time.time()
+        if (self.pending_testing_tags_loaded is None or
+                now - self.pending_testing_tags_loaded > self.tag_cache_ttl):
+            tags = {}
+            with self.db_factory() as session:
+                for release_id, tag in session.query(Release.id, Release.pending_testing_tag):
+                    tags.setdefault(tag, []).append(release_id)
+            self.pending_testing_tags = tags
+            self.pending_testing_tags_loaded = now
+        return self.pending_testing_tags
+
+    def handle_batches(self):
+        """Mark the queued builds as signed, one batch after the other."""
+        while True:
+            batch = self.next_batch()
+            try:
+                self.mark_signed(batch)
+            except Exception:
+                log.exception('Unable to mark a batch of %d builds as signed' % len(batch))
+
+    def next_batch(self):
+        """
+        Wait for a build, and return it along with the builds that are tagged in the next
+        batch_window seconds, up to batch_size builds.
+
+        Returns:
+            list: (nvr, tag) tuples.
+        """
+        batch = [self.incoming_builds.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.incoming_builds.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def mark_signed(self, builds):
+        """
+        Mark the given builds as signed, with a single UPDATE.
+
+        The builds were moved into the pending_testing tag, which is done by RoboSignatory to
+        indicate that they have been correctly signed and written out. Only the builds that were
+        submitted to Bodhi, and whose release uses the tag they were moved into, are marked.
+
+        Args:
+            builds (list): (nvr, tag) tuples.
+        Returns:
+            int: The number of builds that were marked as signed.
+        """
+        tags = self.get_pending_testing_tags()
+        nvrs = {}
+        for nvr, tag in builds:
+            if tag in tags:
+                nvrs.setdefault(tag, set()).add(nvr)
+        if not nvrs:
+            return 0
+
         with self.db_factory() as session:
-            build = Build.get(build_nvr, session)
-            if not build:
-                log.info("Build was not submitted, skipping")
-                return
-
-            if not build.release:
-                log.info('Build is not assigned to release, skipping')
-                return
-
-            if build.release.pending_testing_tag != tag:
-                log.info("Tag is not pending_testing tag, skipping")
-                return
-
-            # This build was moved into the pending_testing tag for the applicable release, which
-            # is done by RoboSignatory to indicate that the build has been correctly signed and
-            # written out. Mark it as such.
-            log.info("Build has been signed, marking")
-            build.signed = True
-            log.info("Build %s has been marked as signed" % build_nvr)
+            count = session.query(Build).filter(
+                or_(*[and_(Build.nvr.in_(sorted(tag_nvrs)), Build.release_id.in_(tags[tag]))
+                      for tag, tag_nvrs in nvrs.items()]),
+                Build.signed == False).update({'signed': True}, synchronize_session=False)
+        log.info("Marked %d of %d tagged builds as signed" % (count, len(builds)))
+        return count
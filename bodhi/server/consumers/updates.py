@@ -30,8 +30,12 @@ message gets received here and triggers us to do all that network-laden heavy
 lifting.
 """
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import logging
 import pprint
+import Queue
+import threading
 import time
 
 import fedmsg.consumers
@@ -70,45 +74,153 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
         else:
             bug_module.set_bugtracker()
 
+        # Messages that arrive within batch_window seconds of each other are handled together, on a
+        # pool of up to max_threads threads.
+        self.batch_window = float(config.get('updates_handler_batch_window', 1))
+        self.batch_size = int(config.get('updates_handler_batch_size', 50))
+        self.max_threads = int(config.get('updates_handler_threads', 4))
+        # How many times, and after how long at first, to look for an update again if it is not
+        # in the database yet
+        self.retries = int(config.get('updates_handler_retries', 5))
+        self.retry_delay = float(config.get('updates_handler_retry_delay', 0.5))
+        self.incoming_messages = Queue.Queue()
+        self.batch_thread = None
+        self.batch_thread_lock = threading.Lock()
+        # The messages handled so far, and how long they waited to be handled
+        self.lag = {'batches': 0, 'messages': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+
         super(UpdatesHandler, self).__init__(hub, *args, **kwargs)
         log.info('Bodhi updates handler listening on:\n'
                  '%s' % pprint.pformat(self.topic))
 
     def consume(self, message):
+        """
+        Queue the given message, to be handled with the others that arrive around the same time.
+        """
+        with self.batch_thread_lock:
+            if self.batch_thread is None or not self.batch_thread.is_alive():
+                self.batch_thread = threading.Thread(target=self.handle_batches,
+                                                     name='UpdatesHandlerBatches')
+                self.batch_thread.daemon = True
+                self.batch_thread.start()
+        self.incoming_messages.put((time.time(), message))
+
+    def handle_batches(self):
+        """Handle the queued messages, one batch after the other."""
+        while True:
+            batch = self.next_batch()
+            try:
+                self.handle_batch(batch)
+            except Exception:
+                log.exception('Unable to handle a batch of %d messages' % len(batch))
+
+    def next_batch(self):
+        """
+        Wait for a message, and return it along with the messages that arrive in the next
+        batch_window seconds, up to batch_size messages.
+
+        Returns:
+            list: (arrival time, message) tuples.
+        """
+        batch = [self.incoming_messages.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.incoming_messages.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def handle_batch(self, batch):
+        """
+        Handle a batch of messages concurrently.
+
+        The messages about the same update are handled in order, by the same thread, so that they
+        don't race each other.
+
+        Args:
+            batch (list): (arrival time, message) tuples.
+        """
+        now = time.time()
+        # The lag of each message is counted from when it was published, if the message says so,
+        # or else from when it reached us.
+        lags = [now - message['body'].get('timestamp', arrived) for arrived, message in batch]
+        self.lag['batches'] += 1
+        self.lag['messages'] += len(batch)
+        self.lag['total_seconds'] += sum(lags)
+        self.lag['max_seconds'] = max([self.lag['max_seconds']] + lags)
+        log.info('Updates Handler handling a batch of %d messages, which waited %.2fs on average '
+                 'and %.2fs at most' % (len(batch), sum(lags) / len(batch), max(lags)))
+
+        groups = OrderedDict()
+        for arrived, message in batch:
+            alias = message['body']['msg']['update'].get('alias')
+            groups.setdefault(alias, []).append(message)
+
+        def handle_group(messages):
+            for message in messages:
+                try:
+                    self.handle(message)
+                except Exception:
+                    log.exception('Unable to handle %s' % message['topic'])
+
+        pool = ThreadPool(min(self.max_threads, len(groups)))
+        try:
+            pool.map(handle_group, groups.values())
+        finally:
+            pool.close()
+            pool.join()
+
+    def handle(self, message):
+        """
+        Update the bugs and the test cases of the update that the given message is about.
+
+        The update may not be committed yet when the message arrives, so it is looked for again a
+        few times, with a growing delay, before giving up.
+        https://github.com/fedora-infra/bodhi/issues/458
+        """
         msg = message['body']['msg']
         topic = message['topic']
         alias = msg['update'].get('alias')
 
         log.info("Updates Handler handling  %s, %s" % (alias, topic))
 
-        # Go to sleep for a second to try and avoid a race condition
-        # https://github.com/fedora-infra/bodhi/issues/458
-        time.sleep(1)
-
         if not alias:
             log.error("Update Handler got update with no "
                       "alias %s." % pprint.pformat(msg))
             return
 
-        with self.db_factory() as session:
-            update = Update.get(alias, session)
-            if not update:
+        for attempt in range(self.retries + 1):
+            with self.db_factory() as session:
+                update = Update.get(alias, session)
+                if update:
+                    self.work_on_update(session, update, topic, msg)
+                    break
+            if attempt == self.retries:
                 raise BodhiException("Couldn't find alias %r in DB" % alias)
+            delay = self.retry_delay * 2 ** attempt
+            log.info("Couldn't find alias %r in DB yet, trying again in %.1fs" % (alias, delay))
+            time.sleep(delay)
 
-            if topic.endswith('update.edit'):
-                bugs = [Bug.get(idx, session) for idx in msg['new_bugs']]
-                # Sanity check
-                for bug in bugs:
-                    assert bug in update.bugs
-            elif topic.endswith('update.request.testing'):
-                bugs = update.bugs
-            else:
-                raise NotImplementedError("Should never get here.")
+        log.info("Updates Handler done with %s, %s" % (alias, topic))
 
-            self.work_on_bugs(session, update, bugs)
-            self.fetch_test_cases(session, update)
+    def work_on_update(self, session, update, topic, msg):
+        """Update the bugs and the test cases of the given update, as the message asks."""
+        if topic.endswith('update.edit'):
+            bugs = [Bug.get(idx, session) for idx in msg['new_bugs']]
+            # Sanity check
+            for bug in bugs:
+                assert bug in update.bugs
+        elif topic.endswith('update.request.testing'):
+            bugs = update.bugs
+        else:
+            raise NotImplementedError("Should never get here.")
 
-        log.info("Updates Handler done with %s, %s" % (alias, topic))
+        self.work_on_bugs(session, update, bugs)
+        self.fetch_test_cases(session, update)
 
     def fetch_test_cases(self, session, update):
         """ Query the wiki for test cases for each package """
@@ -122,10 +234,18 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
             return
 
         log.info("Got %i bugs to sync for %r" % (len(bugs), update.alias))
+        # Fetch all of the bugs at once, and then make our changes to them all at once
+        try:
+            rhbz_bugs = bug_module.bugtracker.getbugs([bug.bug_id for bug in bugs])
+        except Exception:
+            # Each bug is fetched on its own below instead
+            log.warning('Error occured during fetching the bugs', exc_info=True)
+            rhbz_bugs = {}
+        bug_sync = bug_module.BugSync()
         for bug in bugs:
             log.info("Getting RHBZ bug %r" % bug.bug_id)
             try:
-                rhbz_bug = bug_module.bugtracker.getbug(bug.bug_id)
+                rhbz_bug = rhbz_bugs.get(bug.bug_id) or bug_module.bugtracker.getbug(bug.bug_id)
 
                 log.info("Updating our details for %r" % bug.bug_id)
                 bug.update_details(rhbz_bug)
@@ -142,9 +262,13 @@ class UpdatesHandler(fedmsg.consumers.FedmsgConsumer):
                 log.info("Commenting on %r" % bug.bug_id)
                 comment = config['initial_bug_msg'] % (
                     update.title, update.release.long_name, update.abs_url())
-                bug.add_comment(update, comment)
+                bug.add_comment(update, comment, tracker=bug_sync)
 
                 log.info("Modifying %r" % bug.bug_id)
-                bug.modified(update)
+                bug.modified(update, tracker=bug_sync)
             except Exception:
                 log.warning('Error occured during updating single bug', exc_info=True)
+        try:
+            bug_sync.apply(rhbz_bugs)
+        except Exception:
+            log.warning('Error occured during commenting on and modifying the bugs', exc_info=True)
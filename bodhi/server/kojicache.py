@@ -0,0 +1,195 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+"""
+A persistent cache for the koji responses that never change once a build exists.
+
+The RPM headers and the getBuild() data of an NVR are the same every time they are fetched, so
+they are kept in an sqlite database that the web app, the masher and the consumers share. Entries
+are keyed by a hash of the koji method and its arguments, and the oldest entries are evicted once
+the cache holds more than koji_cache_max_entries of them.
+
+Responses are stored with marshal rather than as JSON, so that the byte strings in RPM headers,
+which may not be valid UTF-8, come back out of the cache as the same str objects that koji
+returned. Unlike pickle, loading marshal data can't run code, so a tampered cache file can at worst
+produce wrong data.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import marshal
+import sqlite3
+import threading
+import time
+
+from bodhi.server import buildsys, log
+from bodhi.server.config import config
+
+
+# The marshal format version, which is the same across Python 2.5 to 2.7
+MARSHAL_VERSION = 2
+
+# The cache files whose schema this process already created, and the number of writes this process
+# made to each of them
+_schemas = set()
+_writes = collections.Counter()
+_lock = threading.Lock()
+
+
+class KojiCache(object):
+    """
+    An sqlite-backed store of immutable koji responses.
+
+    A new connection is used for every operation, so a KojiCache can be shared between threads,
+    and any number of processes can use the same file.
+
+    Args:
+        path (basestring or None): The path of the sqlite database, or None to disable the cache.
+        max_entries (int): The number of entries to keep. The oldest entries are evicted beyond
+            that.
+        eviction_interval (int): How many writes each process makes between two checks for
+            entries to evict, so the cache may briefly hold up to that many extra entries.
+    """
+    def __init__(self, path, max_entries=50000, eviction_interval=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+
+    @staticmethod
+    def key(method, *args):
+        """
+        Return the key under which the response to the given koji call is stored.
+
+        Args:
+            method (basestring): The name of the koji method.
+            args (list): The arguments of the call.
+        Returns:
+            basestring: The SHA1 hex digest of the call.
+        """
+        return hashlib.sha1(json.dumps([method] + list(args), sort_keys=True)).hexdigest()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Yield a connection to the database, creating the responses table the first time this
+        process uses the file.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            if self.path not in _schemas:
+                connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                   '(key TEXT PRIMARY KEY, value BLOB, stored REAL)')
+                with _lock:
+                    _schemas.add(self.path)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, method, *args):
+        """
+        Return the cached response to the given koji call.
+
+        Args:
+            method (basestring): The name of the koji method.
+            args (list): The arguments of the call.
+        Returns:
+            object or None: The response, or None if it is not in the cache.
+        """
+        if not self.path:
+            return None
+        try:
+            with self._connect() as connection:
+                row = connection.execute('SELECT value FROM responses WHERE key = ?',
+                                         (self.key(method, *args),)).fetchone()
+        except sqlite3.Error:
+            log.exception('Unable to read the koji cache %s' % self.path)
+            return None
+        if row is None:
+            return None
+        try:
+            return marshal.loads(str(row[0]))
+        except Exception:
+            log.exception('Unable to load %s%r from the koji cache %s' % (method, args, self.path))
+            return None
+
+    def set(self, method, *args, **kwargs):
+        """
+        Store the response to the given koji call.
+
+        Args:
+            method (basestring): The name of the koji method.
+            args (list): The arguments of the call.
+            value (object): The response to store, as a keyword argument.
+        """
+        if not self.path:
+            return
+        with _lock:
+            _writes[self.path] += 1
+            evict = (_writes[self.path] - 1) % self.eviction_interval == 0
+        try:
+            value = sqlite3.Binary(marshal.dumps(kwargs['value'], MARSHAL_VERSION))
+            with self._connect() as connection:
+                connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                                   (self.key(method, *args), value, time.time()))
+                if evict:
+                    self._evict(connection)
+        except (TypeError, ValueError, UnicodeError):
+            # The response is just not cached, the caller already has it.
+            log.exception('Unable to serialize %s%r for the koji cache' % (method, args))
+        except sqlite3.Error:
+            log.exception('Unable to write to the koji cache %s' % self.path)
+
+
+    def _evict(self, connection):
+        """Delete the oldest entries beyond max_entries."""
+        excess = connection.execute(
+            'SELECT COUNT(*) FROM responses').fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY stored LIMIT ?)', (excess,))
+
+
+def get_cache():
+    """
+    Return the KojiCache configured with the koji_cache_* settings.
+
+    Returns:
+        KojiCache: The cache. It does nothing if koji_cache_file is not set.
+    """
+    return KojiCache(config.get('koji_cache_file'),
+                     int(config.get('koji_cache_max_entries', 50000)))
+
+
+def get_build(nvr, session=None):
+    """
+    Return koji's getBuild() data for the given NVR, from the cache if possible.
+
+    Args:
+        nvr (basestring): The NVR of the build.
+        session (koji.ClientSession or None): The koji session to use, or None to get one.
+    Returns:
+        dict or None: The build, or None if koji does not know it.
+    """
+    cache = get_cache()
+    build = cache.get('getBuild', nvr)
+    if build is None:
+        if not session:
+            session = buildsys.get_session()
+        build = session.getBuild(nvr)
+        if build:
+            cache.set('getBuild', nvr, value=build)
+    return build
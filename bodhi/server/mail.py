@@ -12,15 +12,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
+from multiprocessing.pool import ThreadPool
 from textwrap import wrap
 import smtplib
 
 from kitchen.iterutils import iterate
 from kitchen.text.converters import to_unicode, to_bytes
+from pyramid.settings import asbool
 
-from bodhi.server import log
+from bodhi.server import kojicache, log
 from bodhi.server.config import config
-from bodhi.server.util import get_rpm_header
+from bodhi.server.util import build_evr, get_latest_build, get_nvr, get_rpm_header
 
 
 #
@@ -332,18 +334,81 @@ maillist_template = u"""\
 """
 
 
-def get_template(update, use_template='fedora_errata_template'):
+def _fetch_template_data(build):
+    """
+    Fetch the koji data that get_template() needs for a single build.
+
+    Only koji is used, so that this can be called from a thread pool.
+
+    Args:
+        build (tuple): The NVR and epoch of the build, the name of its package, and the tags to look
+            for the latest earlier build of the package in.
+    Returns:
+        tuple: The NVR of the build, and its data as described in prefetch_template_data().
+    """
+    nvr, epoch, package, tags = build
+    if epoch:
+        evr = (str(epoch),) + get_nvr(nvr)[1:]
+    else:
+        evr = build_evr(kojicache.get_build(nvr))
+    latest = get_latest_build(package, evr, tags)
+    return nvr, {'header': get_rpm_header(nvr), 'latest': latest,
+                 'latest_header': latest and get_rpm_header(latest) or None}
+
+
+def prefetch_template_data(updates):
+    """
+    Fetch the koji data that get_template() needs for all of the builds of the given updates.
+
+    The builds are looked up concurrently on a pool of mail_koji_threads threads, instead of one
+    after the other while the templates are rendered.
+
+    Args:
+        updates (iterable): The Updates whose notices are going to be built.
+    Returns:
+        dict: A dictionary mapping the NVR of each build to a dictionary with the build's RPM
+            'header', the NVR of the 'latest' earlier build of its package (or None), and the
+            RPM header of that build as 'latest_header'.
+    """
+    # The database is only used here, on the calling thread
+    builds = []
+    for update in updates:
+        tags = [update.release.stable_tag, update.release.dist_tag]
+        for build in update.builds:
+            builds.append((build.nvr, build.epoch, build.package.name, tags))
+    if not builds:
+        return {}
+
+    thread_pool = ThreadPool(min(int(config.get('mail_koji_threads', 4)), len(builds)))
+    try:
+        return dict(thread_pool.map(_fetch_template_data, builds))
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+
+def get_template(update, use_template='fedora_errata_template', template_data=None):
     """
     Build the update notice for a given update.
     @param use_template: the template to generate this notice with
+    @param template_data: the koji data of the update's builds, as returned by
+        prefetch_template_data(). Builds that are missing from it are looked up in koji.
     """
     from bodhi.server.models import UpdateStatus, UpdateType
     use_template = globals()[use_template]
     line = unicode('-' * 80) + '\n'
     templates = []
+    if template_data is None:
+        template_data = {}
 
     for build in update.builds:
-        h = get_rpm_header(build.nvr)
+        data = template_data.get(build.nvr)
+        if data is None:
+            # Find the most recent update for this package, other than this one
+            lastpkg = build.get_latest()
+            data = {'header': get_rpm_header(build.nvr), 'latest': lastpkg,
+                    'latest_header': lastpkg and get_rpm_header(lastpkg) or None}
+        h = data['header']
         info = {}
         info['date'] = str(update.date_pushed)
         info['name'] = h['name']
@@ -395,22 +460,18 @@ def get_template(update, use_template='fedora_errata_template'):
                 i += 1
             info['references'] += line
 
-        # Find the most recent update for this package, other than this one
-        lastpkg = build.get_latest()
-
-        # Grab the RPM header of the previous update, and generate a ChangeLog
+        # Use the RPM header of the previous update to generate a ChangeLog
         info['changelog'] = u""
-        if lastpkg:
-            oldh = get_rpm_header(lastpkg)
+        if data['latest']:
+            oldh = data['latest_header']
             oldtime = oldh['changelogtime']
             text = oldh['changelogtext']
-            del oldh
             if not text:
                 oldtime = 0
             elif len(text) != 1:
                 oldtime = oldtime[0]
             info['changelog'] = u"ChangeLog:\n\n%s%s" % \
-                (to_unicode(build.get_changelog(oldtime)), line)
+                (to_unicode(build.get_changelog(oldtime, rpm_header=h)), line)
 
         try:
             templates.append((info['subject'], use_template % info))
@@ -445,7 +506,14 @@ def _send_mail(from_addr, to_addr, body):
             smtp.quit()
 
 
-def send_mail(from_addr, to_addr, subject, body_text, headers=None):
+def send_mail(from_addr, to_addr, subject, body_text, headers=None, db=None):
+    """
+    Send an email.
+
+    If mail_outbox is enabled and a database session is given, the message is added to the outbox
+    in the session's transaction, and delivered in the background once that transaction commits.
+    Otherwise it is sent right away.
+    """
     if not from_addr:
         from_addr = config.get('bodhi_email')
     if not from_addr:
@@ -467,12 +535,21 @@ def send_mail(from_addr, to_addr, subject, body_text, headers=None):
     msg += ['Subject: %s' % subject, '', body_text]
     body = to_bytes('\r\n'.join(msg))
 
-    log.info('Sending mail to %s: %s', to_addr, subject)
-    _send_mail(from_addr, to_addr, body)
+    if db is not None and asbool(config.get('mail_outbox', False)):
+        # Imported here, since the outbox needs the models, which need this module
+        from bodhi.server import outbox
+        log.info('Queueing mail to %s: %s', to_addr, subject)
+        outbox.queue(db, from_addr, to_addr, body)
+    else:
+        log.info('Sending mail to %s: %s', to_addr, subject)
+        _send_mail(from_addr, to_addr, body)
 
 
-def send(to, msg_type, update, sender=None, agent=None):
-    """ Send an update notification email to a given recipient """
+def send(to, msg_type, update, sender=None, agent=None, db=None):
+    """
+    Send an update notification email to the given recipients, through the outbox if a database
+    session is given.
+    """
     assert agent, 'No agent given'
 
     critpath = getattr(update, 'critpath', False) and '[CRITPATH] ' or ''
@@ -505,7 +582,7 @@ def send(to, msg_type, update, sender=None, agent=None):
         subject = subject_template % (critpath, msg_type, update.title)
         fields = MESSAGES[msg_type]['fields'](agent, update)
         body = MESSAGES[msg_type]['body'] % fields
-        send_mail(sender, person, subject, body, headers=headers)
+        send_mail(sender, person, subject, body, headers=headers, db=db)
 
 
 def send_releng(subject, body):
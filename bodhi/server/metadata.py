@@ -15,14 +15,17 @@ import logging
 import os
 import shutil
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from kitchen.text.converters import to_bytes
+from sqlalchemy.orm import lazyload, subqueryload
 from urlgrabber.grabber import urlgrab
 import createrepo_c as cr
 
-from bodhi.server.buildsys import get_session
+from bodhi.server import buildsys
 from bodhi.server.config import config
-from bodhi.server.models import Build, UpdateStatus, UpdateRequest, UpdateSuggestion
+from bodhi.server.models import Build, Update, UpdateStatus, UpdateRequest, UpdateSuggestion
+from bodhi.server.util import chunks, link_or_copy
 
 
 __version__ = '2.0'
@@ -50,7 +53,13 @@ class ExtendedMetadata(object):
         self.db = db
         self.updates = set()
         self.builds = {}
+        # A mapping of build NVRs to the list of RPMs koji has for them
+        self.rpms = {}
         self.missing_ids = []
+        # How many notices were kept from the cached updateinfo, and how many had to be generated
+        # again for updates that the cache already knew about.
+        self.notices_reused = 0
+        self.notices_regenerated = 0
         self._from = config.get('bodhi_email')
         self._fetch_updates()
 
@@ -78,11 +87,15 @@ class ExtendedMetadata(object):
         else:
             log.info("Generating new updateinfo.xml")
             self.uinfo = cr.UpdateInfo()
+            new_updates = []
             for update in self.updates:
                 if update.alias:
-                    self.add_update(update)
+                    new_updates.append(update)
                 else:
                     self.missing_ids.append(update.title)
+            self._fetch_rpms(new_updates)
+            for update in new_updates:
+                self.add_update(update)
 
         if self.missing_ids:
             log.error("%d updates with missing ID: %r" % (
@@ -94,7 +107,6 @@ class ExtendedMetadata(object):
         """
         seen_ids = set()
         from_cache = set()
-        existing_ids = set()
 
         # Parse the updateinfo out of the repomd
         updateinfo = None
@@ -114,47 +126,58 @@ class ExtendedMetadata(object):
         log.info('Loading cached updateinfo: %s', updateinfo)
         uinfo = cr.UpdateInfo(updateinfo)
 
-        # Determine which updates are present in the cache
-        for update in uinfo.updates:
-            existing_ids.add(update.id)
-
-        # Generate metadata for any new builds
+        # createrepo_c builds a new list of notices every time uinfo.updates is accessed, so grab
+        # it once and index the notices that are present in the cache by ID and by title.
+        notices = uinfo.updates
+        notices_by_id = {}
+        notices_by_title = {}
+        for notice in notices:
+            notices_by_id[notice.id] = notice
+            notices_by_title[notice.title] = notice
+
+        # Determine which updates need new metadata
+        new_updates = []
         for update in self.updates:
             seen_ids.add(update.alias)
             if not update.alias:
                 self.missing_ids.append(update.title)
                 continue
-            if update.alias in existing_ids:
-                notice = None
-                for value in uinfo.updates:
-                    if value.title == update.title:
-                        notice = value
-                        break
+            if update.alias in notices_by_id:
+                notice = notices_by_title.get(update.title)
                 if not notice:
                     log.warn('%s ID in cache but notice cannot be found', update.title)
-                    self.add_update(update)
+                    self.notices_regenerated += 1
+                    new_updates.append(update)
                     continue
                 if notice.updated_date:
                     if notice.updated_date < update.date_modified:
                         log.debug('Update modified, generating new notice: %s' % update.title)
-                        self.add_update(update)
+                        self.notices_regenerated += 1
+                        new_updates.append(update)
                     else:
                         log.debug('Loading updated %s from cache' % update.title)
                         from_cache.add(update.alias)
                 elif update.date_modified:
                     log.debug('Update modified, generating new notice: %s' % update.title)
-                    self.add_update(update)
+                    self.notices_regenerated += 1
+                    new_updates.append(update)
                 else:
                     log.debug('Loading %s from cache' % update.title)
                     from_cache.add(update.alias)
             else:
                 log.debug('Adding new update notice: %s' % update.title)
-                self.add_update(update)
+                new_updates.append(update)
+
+        # Generate metadata for any new builds
+        self._fetch_rpms(new_updates)
+        for update in new_updates:
+            self.add_update(update)
 
         # Add all relevant notices from the cache to this document
-        for notice in uinfo.updates:
+        for notice in notices:
             if notice.id in from_cache:
                 log.debug('Keeping existing notice: %s', notice.title)
+                self.notices_reused += 1
                 self.uinfo.append(notice)
             else:
                 # Keep all security notices in the stable repo
@@ -163,6 +186,7 @@ class ExtendedMetadata(object):
                         if notice.id not in seen_ids:
                             log.debug('Keeping existing security notice: %s',
                                       notice.title)
+                            self.notices_reused += 1
                             self.uinfo.append(notice)
                         else:
                             log.debug('%s already added?', notice.title)
@@ -171,26 +195,73 @@ class ExtendedMetadata(object):
                 else:
                     log.debug('Purging cached testing update %s', notice.title)
 
+        log.info('Reused %d cached notices, regenerated %d and generated %d new ones',
+                 self.notices_reused, self.notices_regenerated,
+                 len(new_updates) - self.notices_regenerated)
+
     def _fetch_updates(self):
         """Based on our given koji tag, populate a list of Update objects"""
         log.debug("Fetching builds tagged with '%s'" % self.tag)
-        kojiBuilds = get_session().listTagged(self.tag, latest=True)
-        nonexistent = []
+        kojiBuilds = buildsys.get_session().listTagged(self.tag, latest=True)
         log.debug("%d builds found" % len(kojiBuilds))
         for build in kojiBuilds:
             self.builds[build['nvr']] = build
-            build_obj = self.db.query(Build).filter_by(nvr=unicode(build['nvr'])).first()
-            if build_obj:
-                if build_obj.update:
-                    self.updates.add(build_obj.update)
-                else:
-                    log.warn('%s does not have a corresponding update' % build['nvr'])
-            else:
+
+        # Resolve all of the tagged NVRs to their update IDs in a few bulk queries, rather than
+        # loading each Build (and everything it eagerly joins) one at a time.
+        chunk_size = int(config.get('updateinfo_db_chunk_size', 500))
+        update_ids = {}
+        for nvrs in chunks([unicode(build['nvr']) for build in kojiBuilds], chunk_size):
+            query = self.db.query(Build.nvr, Build.update_id).filter(Build.nvr.in_(nvrs))
+            update_ids.update(query.all())
+
+        nonexistent = []
+        for build in kojiBuilds:
+            if build['nvr'] not in update_ids:
                 nonexistent.append(build['nvr'])
+            elif update_ids[build['nvr']] is None:
+                log.warn('%s does not have a corresponding update' % build['nvr'])
+
+        # Load the updates with just the relationships that add_update() needs. The comments, and
+        # the packages and overrides of the builds, are left to be loaded lazily if ever needed.
+        ids = set(update_id for update_id in update_ids.values() if update_id is not None)
+        for id_chunk in chunks(ids, chunk_size):
+            query = self.db.query(Update).filter(Update.id.in_(id_chunk)).options(
+                lazyload(Update.comments), subqueryload(Update.builds).lazyload('*'),
+                subqueryload(Update.bugs), subqueryload(Update.cves))
+            self.updates.update(query.all())
+
         if nonexistent:
             log.warning("Couldn't find the following koji builds tagged as "
                         "%s in bodhi: %s" % (self.tag, nonexistent))
 
+    def _fetch_rpms(self, updates):
+        """
+        Fetch the RPMs of every build in the given updates from koji.
+
+        Rather than making a round trip to koji for each build, the build IDs are collected up front
+        and the RPM lists are fetched with chunked koji multicalls, optionally from a few threads.
+        The results are stored in self.rpms for add_update() to use.
+        """
+        chunk_size = int(config.get('koji_multicall_chunk_size', 500))
+        threads = int(config.get('updateinfo_koji_threads', 1))
+
+        nvrs = [build.nvr for update in updates for build in update.builds
+                if build.nvr not in self.rpms]
+        missing = [nvr for nvr in nvrs if nvr not in self.builds]
+        if missing:
+            log.debug('Fetching %d builds from koji' % len(missing))
+            kojiBuilds = buildsys.multicall('getBuild', [(nvr,) for nvr in missing],
+                                            chunk_size=chunk_size, threads=threads)
+            for nvr, kojiBuild in zip(missing, kojiBuilds):
+                self.builds[nvr] = kojiBuild
+
+        if nvrs:
+            log.debug('Fetching the RPMs of %d builds from koji' % len(nvrs))
+            rpms = buildsys.multicall('listBuildRPMs', [(self.builds[nvr]['id'],) for nvr in nvrs],
+                                      chunk_size=chunk_size, threads=threads)
+            self.rpms.update(zip(nvrs, rpms))
+
     def add_update(self, update):
         """Generate the extended metadata for a given update"""
         rec = cr.UpdateRecord()
@@ -215,15 +286,11 @@ class ExtendedMetadata(object):
         col.name = to_bytes(update.release.long_name)
         col.shortname = to_bytes(update.release.name)
 
-        koji = get_session()
         for build in update.builds:
-            try:
-                kojiBuild = self.builds[build.nvr]
-            except:
-                kojiBuild = koji.getBuild(build.nvr)
+            if build.nvr not in self.rpms:
+                self._fetch_rpms([update])
 
-            rpms = koji.listBuildRPMs(kojiBuild['id'])
-            for rpm in rpms:
+            for rpm in self.rpms[build.nvr]:
                 pkg = cr.UpdateCollectionPackage()
                 pkg.name = rpm['name']
                 pkg.version = rpm['version']
@@ -278,28 +345,71 @@ class ExtendedMetadata(object):
 
     def insert_updateinfo(self):
         fd, name = tempfile.mkstemp()
-        os.write(fd, self.uinfo.xml_dump().encode('utf-8'))
-        os.close(fd)
+        with os.fdopen(fd, 'w') as updateinfo:
+            self.dump_updateinfo(updateinfo)
         self.modifyrepo(name)
         os.unlink(name)
 
+    def dump_updateinfo(self, updateinfo):
+        """
+        Write the updateinfo XML to the given file one notice at a time.
+
+        Serializing the whole document with xml_dump() builds it as a single string, which runs to
+        hundreds of megabytes for the larger stable repositories. Writing each notice as soon as it
+        is serialized keeps the memory used flat no matter how many notices there are.
+
+        Args:
+            updateinfo (file): A file object opened for writing.
+        """
+        updateinfo.write('<?xml version="1.0" encoding="UTF-8"?>\n<updates>\n')
+        for notice in self.uinfo.updates:
+            updateinfo.write(to_bytes(cr.xml_dump_updaterecord(notice)))
+        updateinfo.write('</updates>\n')
+
     def modifyrepo(self, filename):
-        """Inject a file into the repodata for each architecture"""
-        for arch in os.listdir(self.repo_path):
-            repodata = os.path.join(self.repo_path, arch, 'repodata')
-            log.info('Inserting %s into %s', filename, repodata)
-            uinfo_xml = os.path.join(repodata, 'updateinfo.xml')
+        """
+        Inject a file into the repodata for each architecture.
+
+        The payload is identical for every architecture, so it is compressed and checksummed only
+        once, in a scratch directory next to the repository. The result is then hardlinked (or
+        copied, if that is not possible) into each architecture's repodata, and the repomd.xml files
+        are patched in parallel.
+
+        Args:
+            filename (basestring): The path of the file to inject.
+        """
+        arches = os.listdir(self.repo_path)
+        scratch = tempfile.mkdtemp(prefix='modifyrepo-', dir=self.repo)
+        try:
+            uinfo_xml = os.path.join(scratch, 'updateinfo.xml')
             shutil.copyfile(filename, uinfo_xml)
-            repomd_xml = os.path.join(repodata, 'repomd.xml')
-            repomd = cr.Repomd(repomd_xml)
             uinfo_rec = cr.RepomdRecord('updateinfo', uinfo_xml)
             uinfo_rec_comp = uinfo_rec.compress_and_fill(self.hash_type, self.comp_type)
             uinfo_rec_comp.rename_file()
             uinfo_rec_comp.type = 'updateinfo'
-            repomd.set_record(uinfo_rec_comp)
-            with file(repomd_xml, 'w') as repomd_file:
-                repomd_file.write(repomd.xml_dump())
-            os.unlink(uinfo_xml)
+
+            def inject(arch):
+                repodata = os.path.join(self.repo_path, arch, 'repodata')
+                log.info('Inserting %s into %s', filename, repodata)
+                link_or_copy(uinfo_rec_comp.location_real, os.path.join(
+                    repodata, os.path.basename(uinfo_rec_comp.location_real)))
+                repomd_xml = os.path.join(repodata, 'repomd.xml')
+                repomd = cr.Repomd(repomd_xml)
+                repomd.set_record(uinfo_rec_comp)
+                with file(repomd_xml, 'w') as repomd_file:
+                    repomd_file.write(repomd.xml_dump())
+
+            if len(arches) > 1:
+                pool = ThreadPool(len(arches))
+                try:
+                    pool.map(inject, arches)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                map(inject, arches)
+        finally:
+            shutil.rmtree(scratch)
 
     def insert_pkgtags(self):
         """Download and inject the pkgtags sqlite from fedora-tagger"""
@@ -317,13 +427,71 @@ class ExtendedMetadata(object):
                 shutil.rmtree(tempdir)
 
     def cache_repodata(self):
+        """
+        Keep a snapshot of the repodata of the first arch for the next push to load its updateinfo
+        from.
+
+        The files are hardlinked into the snapshot rather than copied. If that isn't possible, only
+        repomd.xml and the updateinfo it references are copied, since those are all that the next
+        push reads. The snapshot is written next to the cache and renamed into place, so a push
+        never sees a partially written cache. If a previous run died after moving the cache aside,
+        the cache is restored before its leftovers are removed.
+        """
         arch = os.listdir(self.repo_path)[0]  # Take the first arch
         repodata = os.path.join(self.repo_path, arch, 'repodata')
         if not os.path.isdir(repodata):
             log.warning('Cannot find repodata to cache: %s' % repodata)
             return
-        cache = self.cached_repodata
-        if os.path.isdir(cache):
-            shutil.rmtree(cache)
-        shutil.copytree(repodata, cache)
-        log.info('%s cached to %s' % (repodata, cache))
+
+        cache_dir = os.path.join(self.repo, '..', self.tag + '.repocache')
+        new_cache_dir = cache_dir + '.new'
+        old_cache_dir = cache_dir + '.old'
+        if not os.path.isdir(cache_dir) and os.path.isdir(old_cache_dir):
+            log.warning('Restoring the repodata cache from %s' % old_cache_dir)
+            os.rename(old_cache_dir, cache_dir)
+        for path in (new_cache_dir, old_cache_dir):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        snapshot = os.path.join(new_cache_dir, 'repodata')
+        os.makedirs(snapshot)
+
+        needed = None
+        for filename in os.listdir(repodata):
+            src = os.path.join(repodata, filename)
+            dst = os.path.join(snapshot, filename)
+            try:
+                os.link(src, dst)
+            except OSError:
+                if needed is None:
+                    needed = self._cached_filenames(repodata)
+                if filename in needed:
+                    shutil.copy2(src, dst)
+
+        if os.path.isdir(cache_dir):
+            os.rename(cache_dir, old_cache_dir)
+        try:
+            os.rename(new_cache_dir, cache_dir)
+        except OSError:
+            if os.path.isdir(old_cache_dir):
+                os.rename(old_cache_dir, cache_dir)
+            raise
+        shutil.rmtree(old_cache_dir, ignore_errors=True)
+        log.info('%s cached to %s' % (repodata, self.cached_repodata))
+
+    @staticmethod
+    def _cached_filenames(repodata):
+        """
+        Return the names of the files in the given repodata that _load_cached_updateinfo() reads.
+
+        Args:
+            repodata (basestring): The path of a repodata directory.
+        Returns:
+            set: The names of repomd.xml and of the updateinfo file it references.
+        """
+        repomd = cr.Repomd()
+        cr.xml_parse_repomd(os.path.join(repodata, 'repomd.xml'), repomd)
+        filenames = set(['repomd.xml'])
+        for record in repomd.records:
+            if record.type == 'updateinfo':
+                filenames.add(os.path.basename(record.location_href))
+        return filenames
@@ -38,7 +38,8 @@ from sqlalchemy import DateTime, engine_from_config
 from sqlalchemy import Table, Column, ForeignKey
 from sqlalchemy import and_, or_
 from sqlalchemy.sql import text
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, lazyload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.ext.declarative import declarative_base
@@ -46,10 +47,10 @@ from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.types import SchemaType, TypeDecorator, Enum
 from pyramid.settings import asbool
 
-from bodhi.server import bugs, buildsys, mail, notifications, log
+from bodhi.server import bugs, buildsys, kojicache, mail, notifications, log
 from bodhi.server.util import (
     header, build_evr, get_nvr, flash_log, get_age, get_critpath_pkgs,
-    get_rpm_header, get_age_in_days, avatar as get_avatar, tokenize,
+    get_latest_build, get_rpm_header, get_age_in_days, avatar as get_avatar, tokenize,
 )
 import bodhi.server.util
 from bodhi.server.exceptions import BodhiException, LockedUpdateException
@@ -643,15 +644,12 @@ class Build(Base):
             name, version, release = get_nvr(self.nvr)
             return (str(self.epoch), version, release)
         else:
-            koji_session = buildsys.get_session()
-            build = koji_session.getBuild(self.nvr)
+            build = kojicache.get_build(self.nvr)
             evr = build_evr(build)
             self.epoch = int(evr[0])
             return evr
 
     def get_latest(self):
-        koji_session = buildsys.get_session()
-
         # Grab a list of builds tagged with ``Release.stable_tag`` release
         # tags, and find the most recent update for this package, other than
         # this one.  If nothing is tagged for -updates, then grab the first
@@ -659,31 +657,21 @@ class Build(Base):
         # ``Release.candidate_tag`` first, because there could potentially be
         # packages that never make their way over stable, so we don't want to
         # generate ChangeLogs against those.
-        latest = None
-        evr = self.evr
-        for tag in [self.update.release.stable_tag, self.update.release.dist_tag]:
-            builds = koji_session.getLatestBuilds(
-                tag, package=self.package.name)
-
-            # Find the first build that is older than us
-            for build in builds:
-                new_evr = build_evr(build)
-                if rpm.labelCompare(evr, new_evr) < 0:
-                    latest = build['nvr']
-                    break
-            if latest:
-                break
-        return latest
+        return get_latest_build(self.package.name, self.evr,
+                                [self.update.release.stable_tag, self.update.release.dist_tag])
 
     def get_url(self):
         """ Return a the url to details about this build """
         return '/' + self.nvr
 
-    def get_changelog(self, timelimit=0):
+    def get_changelog(self, timelimit=0, rpm_header=None):
         """
         Retrieve the RPM changelog of this package since it's last update
+
+        The RPM header of the build is fetched from koji, unless it is given as rpm_header.
         """
-        rpm_header = get_rpm_header(self.nvr)
+        if rpm_header is None:
+            rpm_header = get_rpm_header(self.nvr)
         descrip = rpm_header['changelogtext']
         if not descrip:
             return ""
@@ -704,27 +692,42 @@ class Build(Base):
             i += 1
         return str
 
-    def get_tags(self, koji=None):
+    @staticmethod
+    def get_tags_for(builds, koji=None, cache=None):
+        """
+        Return the koji tags of each of the given builds, fetched in bulk.
+
+        Args:
+            builds (iterable): The Builds to get the tags of.
+            koji (koji.ClientSession or None): The koji session to use, or None to get one.
+            cache (dict or None): A dictionary mapping NVRs to their tags. The tags of the builds in
+                it are not fetched again, and it is updated with the fetched tags.
+        Returns:
+            dict: A dictionary mapping the NVR of each build to a list of its koji tags.
+        """
+        return buildsys.get_tags(
+            [build.nvr for build in builds], koji, cache=cache,
+            chunk_size=int(config.get('koji_multicall_chunk_size', 500)))
+
+    def get_tags(self, koji=None, cache=None):
         """ Return a list of koji tags for this build """
-        if not koji:
-            koji = buildsys.get_session()
-        return [tag['name'] for tag in koji.listTags(self.nvr)]
+        return Build.get_tags_for([self], koji, cache)[self.nvr]
 
-    def untag(self, koji, db):
+    def untag(self, koji, db, cache=None):
         """Remove all known tags from this build"""
         tag_types, tag_rels = Release.get_tags(db)
-        for tag in self.get_tags():
+        for tag in self.get_tags(koji, cache):
             if tag in tag_rels:
                 log.info('Removing %s tag from %s' % (tag, self.nvr))
                 koji.untagBuild(tag, self.nvr)
 
-    def unpush(self, koji):
+    def unpush(self, koji, cache=None):
         """
         Move this build back to the candidate tag and remove any pending tags.
         """
         log.info('Unpushing %s' % self.nvr)
         release = self.update.release
-        for tag in self.get_tags(koji):
+        for tag in self.get_tags(koji, cache):
             if tag == release.pending_signing_tag:
                 log.info('Removing %s tag from %s' % (tag, self.nvr))
                 koji.untagBuild(tag, self.nvr)
@@ -862,6 +865,48 @@ class Update(Base):
                 break
             yield comment
 
+    @classmethod
+    def get_by_titles(cls, titles, db):
+        """
+        Load the updates with the given titles in a few chunked queries.
+
+        The comments, and the packages and overrides of the builds, are not joined in. They are
+        left to be loaded lazily if they are ever needed, which is rarely the case for the updates
+        of a push.
+
+        Args:
+            titles (list): The titles of the updates to load.
+            db (sqlalchemy.orm.session.Session): The database session to use.
+        Returns:
+            list: The updates that were found, in the order of their titles.
+        """
+        chunk_size = int(config.get('updateinfo_db_chunk_size', 500))
+        updates = {}
+        for chunk in bodhi.server.util.chunks(set(titles), chunk_size):
+            query = db.query(cls).filter(cls.title.in_(chunk)).options(
+                lazyload(cls.comments), subqueryload(cls.builds).lazyload('*'))
+            updates.update((update.title, update) for update in query.all())
+        return [updates[title] for title in titles if title in updates]
+
+    @classmethod
+    def lock_all(cls, updates, db):
+        """
+        Lock the given updates with one UPDATE statement per chunk of them.
+
+        Args:
+            updates (list): The updates to lock.
+            db (sqlalchemy.orm.session.Session): The database session to use.
+        """
+        chunk_size = int(config.get('updateinfo_db_chunk_size', 500))
+        now = datetime.utcnow()
+        for chunk in bodhi.server.util.chunks(updates, chunk_size):
+            db.query(cls).filter(cls.id.in_([update.id for update in chunk])).update(
+                {'locked': True, 'date_locked': now}, synchronize_session=False)
+            # The rows are up to date, so the loaded updates only need to reflect them.
+            for update in chunk:
+                set_committed_value(update, 'locked', True)
+                set_committed_value(update, 'date_locked', now)
+
     @classmethod
     def new(cls, request, data):
         """ Create a new update """
@@ -964,6 +1009,11 @@ class Update(Base):
 
         # Determine which builds have been removed
         removed_builds = []
+        build_tags = {}
+        if not up.locked:
+            # Fetch the tags of all of the removed builds at once
+            Build.get_tags_for([b for b in up.builds if b.nvr not in data['builds']], koji,
+                               build_tags)
         for build in edited_builds:
             if build not in data['builds']:
                 if up.locked:
@@ -976,7 +1026,7 @@ class Update(Base):
                     if b.nvr == build:
                         break
 
-                b.unpush(koji=request.koji)
+                b.unpush(koji=request.koji, cache=build_tags)
                 up.builds.remove(b)
 
                 # Expire any associated buildroot override
@@ -1140,7 +1190,7 @@ class Update(Base):
 
     def get_tags(self):
         """ Return all koji tags for all builds on this update. """
-        return list(set(sum([b.get_tags() for b in self.builds], [])))
+        return list(set(sum(Build.get_tags_for(self.builds).values(), [])))
 
     def get_title(self, delim=' ', limit=None, after_limit='…'):
         all_nvrs = map(lambda x: x.nvr, self.builds)
@@ -1390,20 +1440,21 @@ class Update(Base):
         self.date_pushed = now
         self.pushed = True
 
-    def modify_bugs(self):
+    def modify_bugs(self, tracker=None):
         """ Comment on and close this updates bugs as necessary
 
-        This typically gets called by the Masher at the end.
+        This typically gets called by the Masher at the end, with a bugs.BugSync
+        as the tracker so that the bugs of the whole push are changed at once.
         """
         if self.status is UpdateStatus.testing:
             for bug in self.bugs:
                 log.debug('Adding testing comment to bugs for %s', self.title)
-                bug.testing(self)
+                bug.testing(self, tracker=tracker)
         elif self.status is UpdateStatus.stable:
             if not self.close_bugs:
                 for bug in self.bugs:
                     log.debug('Adding stable comment to bugs for %s', self.title)
-                    bug.add_comment(self)
+                    bug.add_comment(self, tracker=tracker)
             else:
                 if self.type is UpdateType.security:
                     # Only close the tracking bugs
@@ -1411,10 +1462,10 @@ class Update(Base):
                     for bug in self.bugs:
                         if not bug.parent:
                             log.debug("Closing tracker bug %d" % bug.bug_id)
-                            bug.close_bug(self)
+                            bug.close_bug(self, tracker=tracker)
                 else:
                     for bug in self.bugs:
-                        bug.close_bug(self)
+                        bug.close_bug(self, tracker=tracker)
 
     def status_comment(self, db):
         """
@@ -1429,7 +1480,14 @@ class Update(Base):
         elif self.status is UpdateStatus.obsolete:
             self.comment(db, u'This update has been obsoleted.', author=u'bodhi')
 
-    def send_update_notice(self):
+    def send_update_notice(self, template_data=None, db=None):
+        """
+        Announce this update on its release's mailing list.
+
+        template_data is the koji data of this update's builds, as returned by
+        mail.prefetch_template_data(). Builds that are missing from it are looked up in koji.
+        If a db session is given, the announcements go through the mail outbox.
+        """
         log.debug("Sending update notice for %s" % self.title)
         mailinglist = None
         sender = config.get('bodhi_email')
@@ -1452,8 +1510,8 @@ class Update(Base):
             templatetype = '%s_errata_template' % release_name
 
         if mailinglist:
-            for subject, body in mail.get_template(self, templatetype):
-                mail.send_mail(sender, mailinglist, subject, body)
+            for subject, body in mail.get_template(self, templatetype, template_data):
+                mail.send_mail(sender, mailinglist, subject, body, db=db)
                 notifications.publish(
                     topic='errata.publish',
                     msg=dict(subject=subject, body=body, update=self))
@@ -1724,7 +1782,7 @@ class Update(Base):
                 people.add(comment.user.email)
             else:
                 people.add(comment.user.name)
-        mail.send(people, 'comment', self, sender=None, agent=author)
+        mail.send(people, 'comment', self, sender=None, agent=author, db=session)
         return comment, caveats
 
     def unpush(self, db):
@@ -1778,8 +1836,9 @@ class Update(Base):
         log.info("Untagging %s" % self.title)
         koji = buildsys.get_session()
         tag_types, tag_rels = Release.get_tags(db)
+        build_tags = Build.get_tags_for(self.builds, koji)
         for build in self.builds:
-            for tag in build.get_tags():
+            for tag in build_tags[build.nvr]:
                 # Only remove tags that we know about
                 if tag in tag_rels:
                     koji.untagBuild(tag, build.nvr, force=True)
@@ -2245,7 +2304,7 @@ class Bug(Base):
             message += template % (config.get('base_address') + update.get_url())
         return message
 
-    def add_comment(self, update, comment=None):
+    def add_comment(self, update, comment=None, tracker=None):
         if (update.type is UpdateType.security and self.parent and
                 update.status is not UpdateStatus.stable):
             log.debug('Not commenting on parent security bug %s', self.bug_id)
@@ -2253,9 +2312,9 @@ class Bug(Base):
             if not comment:
                 comment = self.default_message(update)
             log.debug("Adding comment to Bug #%d: %s" % (self.bug_id, comment))
-            bugs.bugtracker.comment(self.bug_id, comment)
+            (tracker or bugs.bugtracker).comment(self.bug_id, comment)
 
-    def testing(self, update):
+    def testing(self, update, tracker=None):
         """
         Change the status of this bug to ON_QA, and comment on the bug with
         some details on how to test and provide feedback for this update.
@@ -2265,22 +2324,23 @@ class Bug(Base):
             log.debug('Not modifying on parent security bug %s', self.bug_id)
         else:
             comment = self.default_message(update)
-            bugs.bugtracker.on_qa(self.bug_id, comment)
+            (tracker or bugs.bugtracker).on_qa(self.bug_id, comment)
 
-    def close_bug(self, update):
+    def close_bug(self, update, tracker=None):
         # Build a mapping of package names to build versions
         # so that .close() can figure out which build version fixes which bug.
         versions = dict([
             (get_nvr(b.nvr)[0], b.nvr) for b in update.builds
         ])
-        bugs.bugtracker.close(self.bug_id, versions=versions, comment=self.default_message(update))
+        (tracker or bugs.bugtracker).close(self.bug_id, versions=versions,
+                                           comment=self.default_message(update))
 
-    def modified(self, update):
+    def modified(self, update, tracker=None):
         """ Change the status of this bug to MODIFIED """
         if update.type is UpdateType.security and self.parent:
             log.debug('Not modifying on parent security bug %s', self.bug_id)
         else:
-            bugs.bugtracker.modified(self.bug_id)
+            (tracker or bugs.bugtracker).modified(self.bug_id)
 
 
 user_group_table = Table('user_group_table', Base.metadata,
@@ -2472,6 +2532,23 @@ class Stack(Base):
     users = relationship("User", secondary=stack_user_table, backref='stacks')
 
 
+class OutboundMail(Base):
+    """
+    An email waiting in the outbox for bodhi.server.outbox to deliver it.
+
+    Messages are added in the same transaction as the changes that caused them, so they are only
+    delivered if that transaction is committed.
+    """
+    __tablename__ = 'outbound_mail'
+
+    from_addr = Column(UnicodeText, nullable=False)
+    to_addr = Column(UnicodeText, nullable=False)
+    message = Column(UnicodeText, nullable=False)
+    date_queued = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # When a worker took this message for delivery, or None while it is waiting for one.
+    date_claimed = Column(DateTime)
+
+
 def get_db_factory():
     """
     This function generates and returns a database factory that can be used for non-request
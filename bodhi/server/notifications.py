@@ -12,8 +12,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import atexit
 import copy
+import Queue
 import socket
+import threading
+import time
 
 import fedmsg
 import fedmsg.config
@@ -24,11 +28,18 @@ import bodhi.server
 import bodhi.server.config
 
 
+# The arguments of the last init() call, so that the publisher thread can initialize fedmsg the
+# same way for itself.
+_init_kwargs = {}
+
+
 def init(active=None, cert_prefix=None):
     if not bodhi.server.config.config.get('fedmsg_enabled'):
         bodhi.server.log.warn("fedmsg disabled.  not initializing.")
         return
 
+    _init_kwargs.update(active=active, cert_prefix=cert_prefix)
+
     fedmsg_config = fedmsg.config.load_config()
 
     # Only override config from disk if explicitly argued.
@@ -54,27 +65,233 @@ def publish(topic, msg, force=False):
     sqlalchemy transaction completes successfully and will not be published at
     all if it fails, aborts, or rolls back.
 
-    Specifying force=True to this function by-passes that -- messages are sent
-    immediately.
+    Specifying force=True to this function by-passes that -- messages are
+    handed to the publisher thread immediately.
+
+    Either way, the messages are serialized in the calling thread, and then
+    published from a background thread, so that the caller doesn't wait for
+    fedmsg.
     """
     if not bodhi.server.config.config.get('fedmsg_enabled'):
         bodhi.server.log.warn("fedmsg disabled.  not sending %r" % topic)
         return
 
-    # Initialize right before we try to publish, but only if we haven't
-    # initialized for this thread already.
-    if not fedmsg_is_initialized():
-        init()
-
     if force:
         bodhi.server.log.debug("fedmsg skipping transaction and sending %r" % topic)
-        fedmsg.publish(topic=topic, msg=msg)
+        get_publisher().enqueue(encode([(topic, msg)]))
     else:
         bodhi.server.log.debug("fedmsg enqueueing %r" % topic)
         manager = _managers_map.get_current_data_manager()
         manager.enqueue(topic, msg)
 
 
+def encode(messages):
+    """
+    Serialize the given messages into plain, JSON-able data.
+
+    The objects with a __json__() method, such as the models, are only serialized once, even if
+    several of the messages include them.
+
+    Args:
+        messages (list): (topic, msg) tuples.
+    Returns:
+        list: (topic, msg) tuples, where each msg only holds JSON-able data.
+    """
+    start = time.time()
+    # The serialized objects, keyed by their identity. The objects are kept along with their
+    # serialization, so that their ids cannot be reused while the memo is around.
+    memo = {}
+
+    def serialize(value):
+        if hasattr(value, '__json__'):
+            if id(value) not in memo:
+                memo[id(value)] = (value, serialize(value.__json__()))
+            return memo[id(value)][1]
+        return fedmsg.encoding.loads(fedmsg.encoding.dumps(value))
+
+    encoded = []
+    for topic, msg in messages:
+        if isinstance(msg, dict):
+            msg = dict((key, serialize(value)) for key, value in msg.items())
+        else:
+            msg = serialize(msg)
+        encoded.append((topic, msg))
+    stats.add_encode(time.time() - start)
+    return encoded
+
+
+class PublishStats(object):
+    """
+    Counters of the work done to publish fedmsg messages, to measure how long the messages take to
+    go out.
+
+    encode_seconds is the time spent serializing the messages, latency_seconds the time between
+    messages being handed to the publisher thread and being published, and publish_seconds the time
+    spent in fedmsg.publish().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all of the counters back to zero."""
+        with self.lock:
+            self.published = 0
+            self.failed = 0
+            self.batches = 0
+            self.encode_seconds = 0.0
+            self.publish_seconds = 0.0
+            self.latency_seconds = 0.0
+            self.max_latency_seconds = 0.0
+
+    def add_encode(self, duration):
+        with self.lock:
+            self.encode_seconds += duration
+
+    def add_publish(self, latency, duration, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.published += 1
+            self.publish_seconds += duration
+            self.latency_seconds += latency
+            self.max_latency_seconds = max(self.max_latency_seconds, latency)
+
+    def add_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def as_dict(self):
+        """Return the counters, and the mean latency of the published messages."""
+        with self.lock:
+            count = self.published + self.failed
+            return {
+                'published': self.published, 'failed': self.failed, 'batches': self.batches,
+                'encode_seconds': self.encode_seconds, 'publish_seconds': self.publish_seconds,
+                'latency_seconds': self.latency_seconds,
+                'max_latency_seconds': self.max_latency_seconds,
+                'mean_latency_seconds': self.latency_seconds / count if count else 0.0}
+
+
+stats = PublishStats()
+
+
+class FedmsgPublisher(threading.Thread):
+    """
+    A daemon thread that publishes serialized messages with fedmsg.
+
+    Everything that is waiting when the thread wakes up is published as one batch, so a burst of
+    messages only wakes it up once. The messages are published in the order they were enqueued.
+    """
+    def __init__(self):
+        super(FedmsgPublisher, self).__init__(name='FedmsgPublisher')
+        self.daemon = True
+        self.queue = Queue.Queue()
+
+    def enqueue(self, messages):
+        """
+        Hand the given messages to the thread.
+
+        Args:
+            messages (list): (topic, msg) tuples, as returned by encode().
+        """
+        self.queue.put((time.time(), messages))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.publish(batch)
+            except Exception:
+                bodhi.server.log.exception('Unable to publish %d fedmsg batches' % len(batch))
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    def publish(self, batch):
+        """
+        Publish the given batch of messages.
+
+        Args:
+            batch (list): (enqueued, messages) tuples, where enqueued is the time at which the
+                messages were handed to the thread.
+        """
+        # fedmsg contexts are per thread, so this thread initializes its own.
+        if not fedmsg_is_initialized():
+            init(**_init_kwargs)
+        stats.add_batch()
+        count = 0
+        for enqueued, messages in batch:
+            for topic, msg in messages:
+                start = time.time()
+                failed = False
+                try:
+                    bodhi.server.log.debug("fedmsg sending %r" % topic)
+                    fedmsg.publish(topic=topic, msg=msg)
+                except Exception:
+                    bodhi.server.log.exception('Unable to publish %r' % topic)
+                    failed = True
+                now = time.time()
+                stats.add_publish(now - enqueued, now - start, failed)
+                count += 1
+        bodhi.server.log.debug('Published a batch of %d fedmsg messages: %r' % (
+            count, stats.as_dict()))
+
+    def flush(self, timeout=10):
+        """
+        Wait for the thread to publish everything it was given, for up to timeout seconds.
+
+        The messages that are still waiting after that are dropped, and logged as errors with
+        their content, so that they can be sent again by hand.
+
+        Returns:
+            int: The number of messages that were dropped.
+        """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+        dropped = 0
+        while True:
+            try:
+                enqueued, messages = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            for topic, msg in messages:
+                bodhi.server.log.error('Dropping fedmsg message %r, which was not published in '
+                                       'time: %s' % (topic, fedmsg.encoding.dumps(msg)))
+                dropped += 1
+            self.queue.task_done()
+        return dropped
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return the FedmsgPublisher of this process, starting it if needed."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None or not _publisher.is_alive():
+            _publisher = FedmsgPublisher()
+            _publisher.start()
+    return _publisher
+
+
+@atexit.register
+def flush():
+    """Wait for the messages that are still queued to be published before exiting."""
+    if _publisher is not None and _publisher.is_alive():
+        _publisher.flush()
+
+
 def fedmsg_is_initialized():
     """ Return True or False if fedmsg is initialized or not. """
     local = getattr(fedmsg, '__local')
@@ -164,22 +381,16 @@ class FedmsgDataManager(object):
         # 2) that we convert them from sqlalchemy objects to dicts *before* the
         #    transaction enters its final phase, at which point our objects
         #    will be detached from their session.
-        self.uncommitted = [
-            (topic, fedmsg.encoding.loads(fedmsg.encoding.dumps(msg)))
-            for topic, msg in self.uncommitted
-        ]
-
-        # Ensure that fedmsg has already been initialized.
-        assert fedmsg_is_initialized(), "fedmsg is not initialized"
+        # Each object is only serialized once, however many of the messages include it.
+        self.uncommitted = encode(self.uncommitted)
 
     def tpc_abort(self, transaction):
         self.abort(transaction)
         self._finish('aborted')
 
     def tpc_finish(self, transaction):
-        for topic, msg in self.uncommitted:
-            bodhi.server.log.debug("fedmsg sending %r" % topic)
-            fedmsg.publish(topic=topic, msg=msg)
+        if self.uncommitted:
+            get_publisher().enqueue(self.uncommitted)
         self.committed = copy.copy(self.uncommitted)
         _managers_map.remove(self)
         self._finish('committed')
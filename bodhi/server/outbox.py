@@ -0,0 +1,242 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+"""
+A transactional outbox for the email that Bodhi sends.
+
+Messages are stored in the outbound_mail table in the same transaction as the changes that caused
+them, so nothing is sent if that transaction is rolled back. Once it commits, a background worker
+in the same process delivers the outbox over a single SMTP connection, and removes the messages it
+delivered. The worker also wakes up every mail_outbox_interval seconds, to pick up the messages
+that could not be delivered, or that were queued by a process that exited before delivering them.
+"""
+from datetime import datetime, timedelta
+import smtplib
+import threading
+
+from kitchen.text.converters import to_bytes, to_unicode
+from sqlalchemy import or_
+import transaction
+
+from bodhi.server import log
+from bodhi.server.config import config
+from bodhi.server.models import OutboundMail
+from bodhi.server.util import transactional_session_maker
+
+
+def queue(db, from_addr, to_addr, message):
+    """
+    Add a message to the outbox, to be delivered once the current transaction commits.
+
+    Args:
+        db (sqlalchemy.orm.session.Session): The session of the current transaction.
+        from_addr (basestring): The sender of the message.
+        to_addr (basestring): The recipient of the message.
+        message (basestring): The whole message, with its headers.
+    """
+    db.add(OutboundMail(from_addr=to_unicode(from_addr), to_addr=to_unicode(to_addr),
+                        message=to_unicode(message)))
+    current = transaction.get()
+    if not any(hook is _committed for hook, args, kws in current.getAfterCommitHooks()):
+        current.addAfterCommitHook(_committed, args=(db.get_bind(),))
+
+
+def _committed(success, engine):
+    """Wake the worker up once a transaction that queued messages has committed."""
+    if success:
+        wake(engine)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def wake(engine):
+    """
+    Have the outbox worker of this process deliver the outbox, starting it if needed.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database that the outbox is in.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = OutboxWorker(transactional_session_maker(engine))
+            _worker.start()
+    _worker.wake()
+
+
+class OutboxWorker(threading.Thread):
+    """
+    A daemon thread that delivers the outbox whenever it is woken up, and at least every
+    mail_outbox_interval seconds.
+
+    Args:
+        db_factory (bodhi.server.util.TransactionalSessionMaker): The factory of the sessions used
+            to read the outbox.
+    """
+    def __init__(self, db_factory):
+        super(OutboxWorker, self).__init__(name='OutboxWorker')
+        self.daemon = True
+        self.db_factory = db_factory
+        self.interval = float(config.get('mail_outbox_interval', 60))
+        self.event = threading.Event()
+
+    def wake(self):
+        """Have the worker deliver the outbox as soon as it can."""
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                deliver(self.db_factory)
+            except Exception:
+                log.exception('Unable to deliver the mail outbox')
+
+
+class SMTPConnection(object):
+    """
+    A connection to the SMTP server that is opened on first use, and then reused for every message
+    sent through it.
+
+    Args:
+        server (basestring): The SMTP server, as host or host:port.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.smtp = None
+
+    def sendmail(self, from_addr, to_addr, message):
+        """
+        Send a message, connecting to the server first if needed.
+
+        Args:
+            from_addr (basestring): The sender of the message.
+            to_addr (basestring): The recipient of the message.
+            message (basestring): The whole message, with its headers.
+        """
+        if self.smtp is None:
+            log.debug('Connecting to %s', self.server)
+            self.smtp = smtplib.SMTP(self.server)
+        self.smtp.sendmail(from_addr, [to_addr], message)
+
+    def close(self):
+        """Close the connection, if it is open."""
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, IOError):
+            log.debug('Unable to close the connection to %s', self.server, exc_info=True)
+        self.smtp = None
+
+
+def deliver(db_factory):
+    """
+    Deliver the messages in the outbox over a single SMTP connection.
+
+    Messages are claimed in batches of mail_outbox_batch_size, so that several processes can
+    deliver the same outbox without sending anything twice. Messages that the server refuses for
+    good are dropped, and the others are left in the outbox to be tried again later.
+
+    Args:
+        db_factory (bodhi.server.util.TransactionalSessionMaker): The factory of the sessions used
+            to read the outbox.
+    Returns:
+        int: The number of messages that were delivered.
+    """
+    smtp_server = config.get('smtp_server')
+    if not smtp_server:
+        log.info('Not delivering the mail outbox: No smtp_server defined')
+        return 0
+    batch_size = int(config.get('mail_outbox_batch_size', 100))
+    connection = SMTPConnection(smtp_server)
+    delivered = 0
+    try:
+        while True:
+            messages = _claim(db_factory, batch_size)
+            if not messages:
+                break
+            done, failed = [], []
+            for id, from_addr, to_addr, message in messages:
+                try:
+                    connection.sendmail(from_addr, to_addr, message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    log.warn('"recipient refused" for %r, %r' % (to_addr, e))
+                    done.append(id)
+                except smtplib.SMTPResponseException as e:
+                    if e.smtp_code < 500:
+                        log.warn('Unable to send mail to %r, trying again later: %r' % (to_addr, e))
+                        failed.append(id)
+                    else:
+                        log.exception('Unable to send mail to %r' % to_addr)
+                        done.append(id)
+                except Exception:
+                    log.exception('Unable to send mail to %r, trying again later' % to_addr)
+                    # The connection may be broken, so the next message gets a new one
+                    connection.close()
+                    failed.append(id)
+                else:
+                    done.append(id)
+                    delivered += 1
+            _finish(db_factory, done, failed)
+            if failed:
+                break
+    finally:
+        connection.close()
+    if delivered:
+        log.info('Delivered %d messages from the mail outbox' % delivered)
+    return delivered
+
+
+def _claim(db_factory, limit):
+    """
+    Claim up to limit messages from the outbox.
+
+    A message is claimed by setting its date_claimed, if no other worker did so since it was read.
+    Claims older than mail_outbox_claim_timeout seconds are assumed to belong to workers that died,
+    and are taken over.
+
+    Returns:
+        list: (id, from_addr, to_addr, message) tuples of the claimed messages.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=int(config.get('mail_outbox_claim_timeout', 600)))
+    claimed = []
+    with db_factory() as db:
+        waiting = db.query(OutboundMail).filter(or_(
+            OutboundMail.date_claimed.is_(None), OutboundMail.date_claimed < stale)).order_by(
+            OutboundMail.id).limit(limit).all()
+        for mail in waiting:
+            count = db.query(OutboundMail).filter(
+                OutboundMail.id == mail.id,
+                OutboundMail.date_claimed == mail.date_claimed).update(
+                {'date_claimed': now}, synchronize_session=False)
+            if count:
+                claimed.append((mail.id, to_bytes(mail.from_addr), to_bytes(mail.to_addr),
+                                to_bytes(mail.message)))
+    return claimed
+
+
+def _finish(db_factory, done, failed):
+    """Remove the messages that are done from the outbox, and release the ones that failed."""
+    with db_factory() as db:
+        if done:
+            db.query(OutboundMail).filter(OutboundMail.id.in_(done)).delete(
+                synchronize_session=False)
+        if failed:
+            db.query(OutboundMail).filter(OutboundMail.id.in_(failed)).update(
+                {'date_claimed': None}, synchronize_session=False)
@@ -15,7 +15,6 @@
 The CLI tool for triggering update pushes.
 """
 from collections import defaultdict
-from datetime import datetime
 import glob
 import json
 
@@ -67,9 +66,7 @@ def push(username, cert_prefix, **kwargs):
                 if not click.confirm('Resume {}?'.format(lockfile)):
                     continue
 
-                for update in lockfiles[lockfile]:
-                    update = session.query(Update).filter(Update.title == update).first()
-                    updates.append(update)
+                updates.extend(Update.get_by_titles(lockfiles[lockfile], session))
         else:
             # Accept both comma and space separated request list
             requests = kwargs['request'].replace(',', ' ').split(' ')
@@ -109,9 +106,7 @@ def push(username, cert_prefix, **kwargs):
         if updates:
             click.confirm('Push these {:d} updates?'.format(len(updates)), abort=True)
             click.echo('\nLocking updates...')
-            for update in updates:
-                update.locked = True
-                update.date_locked = datetime.utcnow()
+            Update.lock_all(updates, session)
         else:
             click.echo('\nThere are no updates to push.')
 
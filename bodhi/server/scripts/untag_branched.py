@@ -31,7 +31,7 @@ from sqlalchemy import engine_from_config
 from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.sqlalchemy import ZopeTransactionExtension
 
-from ..models import Release, ReleaseState, Update, UpdateStatus
+from ..models import Build, Release, ReleaseState, Update, UpdateStatus
 
 from bodhi.server import buildsys
 
@@ -65,12 +65,20 @@ def main(argv=sys.argv):
         for release in db.query(Release).filter_by(
                 state=ReleaseState.pending).all():
             log.info(release.name)
-            for update in db.query(Update).filter_by(
-                    release=release, status=UpdateStatus.stable).all():
+            updates = db.query(Update).filter_by(
+                release=release, status=UpdateStatus.stable).all()
+            # Look up the tags of all of the release's builds at once
+            build_tags = {}
+            Build.get_tags_for(
+                [build for update in updates
+                 if update.date_stable and now - update.date_stable > one_day
+                 for build in update.builds],
+                koji, build_tags)
+            for update in updates:
                 assert update.date_stable, update.title
                 if now - update.date_stable > one_day:
                     for build in update.builds:
-                        tags = build.get_tags()
+                        tags = build.get_tags(koji, build_tags)
                         stable_tag = release.dist_tag
                         testing_tag = release.testing_tag
                         pending_signing_tag = Release.pending_signing_tag
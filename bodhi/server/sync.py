@@ -0,0 +1,195 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+"""
+Watch the master mirror until the repositories of a push have been synchronized to it.
+
+A single SyncWatcher polls the master mirror's repomd.xml for every repository that is waiting on
+it, using conditional GETs and an exponential backoff for each of them.
+"""
+import hashlib
+import threading
+import time
+import urllib2
+
+from bodhi.server import log
+from bodhi.server.config import config
+
+
+class SyncRequest(object):
+    """
+    A repomd.xml that a SyncWatcher is waiting to see on the master mirror.
+
+    Args:
+        url (basestring): The URL of the repomd.xml on the master mirror.
+        checksum (basestring): The SHA1 hex digest of the repomd.xml that was pushed.
+        delay (float): How many seconds to wait before the second poll.
+        deadline (float or None): When to give up, in seconds since the epoch, or None to wait
+            forever.
+    """
+    def __init__(self, url, checksum, delay, deadline=None):
+        self.url = url
+        self.checksum = checksum
+        self.delay = delay
+        self.deadline = deadline
+        self.next_poll = 0
+        self.polls = 0
+        self.etag = None
+        self.last_modified = None
+        self.synced = False
+        self.done = threading.Event()
+
+    def wait(self):
+        """
+        Block until the repomd.xml has been found on the master mirror, or the deadline passed.
+
+        Returns:
+            bool: True if the repomd.xml was found on the master mirror, False if we timed out.
+        """
+        self.done.wait()
+        return self.synced
+
+
+class SyncWatcher(object):
+    """
+    Poll the master mirror for the repomd.xml files of any number of repositories from one thread.
+
+    The thread is started when a repository is first watched, and exits once none are left.
+
+    Args:
+        initial_delay (float): How many seconds to wait after the first poll of a repomd.xml that
+            does not match. The delay doubles after every poll after that.
+        max_delay (float): The longest delay between two polls of the same repomd.xml.
+        timeout (float or None): How many seconds to wait for each repomd.xml before giving up, or
+            None to wait forever.
+        request_timeout (float): The socket timeout of each poll, in seconds. All of the
+            repositories are polled from the same thread, so a hung connection would otherwise
+            hold up all of them.
+    """
+    def __init__(self, initial_delay=5, max_delay=200, timeout=None, request_timeout=30):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self.pending = []
+        self.thread = None
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls):
+        """
+        Return a SyncWatcher configured with the sync_* settings.
+
+        Returns:
+            SyncWatcher: A new watcher.
+        """
+        timeout = float(config.get('sync_timeout', 0))
+        return cls(initial_delay=float(config.get('sync_initial_delay', 5)),
+                   max_delay=float(config.get('sync_max_delay', 200)),
+                   timeout=timeout or None,
+                   request_timeout=float(config.get('sync_request_timeout', 30)))
+
+    def watch(self, url, checksum):
+        """
+        Start waiting for the given repomd.xml to appear on the master mirror.
+
+        Args:
+            url (basestring): The URL of the repomd.xml on the master mirror.
+            checksum (basestring): The SHA1 hex digest of the repomd.xml that was pushed.
+        Returns:
+            SyncRequest: An object that can be waited on.
+        """
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + self.timeout
+        request = SyncRequest(url, checksum, self.initial_delay, deadline)
+        with self.condition:
+            self.pending.append(request)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='SyncWatcher')
+                self.thread.daemon = True
+                self.thread.start()
+            else:
+                self.condition.notify()
+        return request
+
+    def _run(self):
+        """Poll the pending repomd.xml files as they come due, until none are left."""
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.thread = None
+                    return
+                now = time.time()
+                due = [request for request in self.pending if request.next_poll <= now]
+                if not due:
+                    self.condition.wait(min(r.next_poll for r in self.pending) - now)
+                    continue
+
+            for request in due:
+                self._poll(request)
+
+            with self.condition:
+                self.pending = [r for r in self.pending if not r.done.is_set()]
+
+    def _poll(self, request):
+        """
+        Fetch the repomd.xml for the given request, and compare it to the one that was pushed.
+
+        The ETag and Last-Modified headers of the last response are sent back to the mirror, so it
+        only needs to send the file again once it has changed.
+
+        Args:
+            request (SyncRequest): The repomd.xml to check.
+        """
+        request.polls += 1
+        headers = {}
+        if request.etag:
+            headers['If-None-Match'] = request.etag
+        if request.last_modified:
+            headers['If-Modified-Since'] = request.last_modified
+
+        try:
+            log.info('Polling %s' % request.url)
+            response = urllib2.urlopen(urllib2.Request(request.url, headers=headers),
+                                       timeout=self.request_timeout)
+            request.etag = response.info().getheader('ETag')
+            request.last_modified = response.info().getheader('Last-Modified')
+            checksum = hashlib.sha1(response.read()).hexdigest()
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                log.debug('%s has not changed', request.url)
+            else:
+                log.exception('Error fetching repomd.xml')
+        except Exception:
+            log.exception('Error fetching repomd.xml')
+        else:
+            if checksum == request.checksum:
+                log.info('master repomd.xml matches!')
+                request.synced = True
+                request.done.set()
+                return
+            log.debug("master repomd.xml doesn't match! %s != %s for %r",
+                      request.checksum, checksum, request.url)
+
+        now = time.time()
+        if request.deadline is not None and now >= request.deadline:
+            log.error('Gave up waiting for %s after %d polls', request.url, request.polls)
+            request.done.set()
+            return
+
+        request.next_poll = now + request.delay
+        if request.deadline is not None:
+            request.next_poll = min(request.next_poll, request.deadline)
+        request.delay = min(request.delay * 2, self.max_delay)
@@ -22,9 +22,11 @@ from datetime import datetime
 from os.path import join, dirname, basename, isfile
 import collections
 import functools
+import gzip
 import hashlib
 import os
 import pkg_resources
+import shutil
 import socket
 import subprocess
 import tempfile
@@ -42,7 +44,7 @@ import markdown
 import requests
 import transaction
 
-from bodhi.server import log, buildsys
+from bodhi.server import log, buildsys, kojicache
 from bodhi.server.config import config
 from bodhi.server.exceptions import RepodataException
 
@@ -68,7 +70,15 @@ def pluralize(val, name):
 
 
 def get_rpm_header(nvr, tries=0):
-    """ Get the rpm header for a given build """
+    """
+    Get the rpm header for a given build
+
+    The headers of an NVR never change, so they are kept in the koji cache once fetched.
+    """
+    cache = kojicache.get_cache()
+    result = cache.get('getRPMHeaders', nvr)
+    if result is not None:
+        return result
 
     tries += 1
     headers = [
@@ -90,11 +100,27 @@ def get_rpm_header(nvr, tries=0):
             raise
 
     if result:
+        cache.set('getRPMHeaders', nvr, value=result)
         return result
 
     raise ValueError("No rpm headers found in koji for %r" % nvr)
 
 
+def chunks(items, size):
+    """
+    Split the given items into lists of at most size items, e.g. for the IN clause of a query.
+
+    Args:
+        items (iterable): The items to split up.
+        size (int): The maximum number of items in each list.
+    Returns:
+        generator: Yields lists of items.
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def get_nvr(nvr):
     """ Return the [ name, version, release ] a given name-ver-rel. """
     x = map(unicode, nvr.split('-'))
@@ -116,6 +142,23 @@ def mkmetadatadir(path):
     subprocess.check_call(['createrepo_c', '--xz', '--database', '--quiet', path])
 
 
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, falling back to copying it if the two are on different filesystems or
+    the filesystem does not support hardlinks. An existing dst is replaced.
+
+    Args:
+        src (basestring): The path of the file to link.
+        dst (basestring): The path to link it to.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def get_age(date):
     age = datetime.utcnow() - date
     if age.days == 0:
@@ -162,6 +205,34 @@ def build_evr(build):
     return tuple(map(str, (build['epoch'], build['version'], build['release'])))
 
 
+def get_latest_build(package, evr, tags, koji_session=None):
+    """
+    Return the NVR of the latest build of the given package that is tagged with one of the tags.
+
+    The tags are searched in order, and the first one that has a build of the package which compares
+    newer than evr wins.
+
+    Args:
+        package (basestring): The name of the package.
+        evr (tuple): The (epoch, version, release) to compare the tagged builds to.
+        tags (list): The names of the koji tags to search.
+        koji_session (koji.ClientSession or None): The koji session to use, or None to get one.
+    Returns:
+        basestring or None: The NVR of the build that was found, or None.
+    """
+    if not koji_session:
+        koji_session = buildsys.get_session()
+    for tag in tags:
+        builds = koji_session.getLatestBuilds(tag, package=package)
+
+        # Find the first build that is older than us
+        for build in builds:
+            new_evr = build_evr(build)
+            if rpm.labelCompare(evr, new_evr) < 0:
+                return build['nvr']
+    return None
+
+
 def link(href, text):
     return '<a href="%s">%s</a>' % (href, text)
 
@@ -221,6 +292,31 @@ class Singleton(object):
         return cls._instance
 
 
+def gzip_contains(path, needle, chunk_size=1024 * 1024):
+    """
+    Return whether the given gzipped file contains the given string, decompressing it a chunk at a
+    time rather than all at once.
+
+    Args:
+        path (basestring): The path of the gzipped file.
+        needle (str): The string to look for.
+        chunk_size (int): How many decompressed bytes to search at a time.
+    Returns:
+        bool: True if the file contains needle, False otherwise.
+    """
+    tail = ''
+    with gzip.open(path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            # Keep the end of what was read before, in case the needle spans several chunks
+            window = tail + chunk
+            if needle in window:
+                return True
+            tail = window[max(0, len(window) - len(needle) + 1):]
+
+
 def sanity_check_repodata(myurl):
     """
     Sanity check the repodata for a given repository.
@@ -229,7 +325,8 @@ def sanity_check_repodata(myurl):
     import librepo
     h = librepo.Handle()
     h.setopt(librepo.LRO_REPOTYPE, librepo.LR_YUMREPO)
-    h.setopt(librepo.LRO_DESTDIR, tempfile.mkdtemp())
+    destdir = tempfile.mkdtemp()
+    h.setopt(librepo.LRO_DESTDIR, destdir)
 
     if myurl[-1] != '/':
         myurl += '/'
@@ -244,12 +341,12 @@ def sanity_check_repodata(myurl):
     except librepo.LibrepoException as e:
         rc, msg, general_msg = e
         raise RepodataException(msg)
+    finally:
+        shutil.rmtree(destdir, ignore_errors=True)
 
     updateinfo = os.path.join(myurl, 'updateinfo.xml.gz')
-    if os.path.exists(updateinfo):
-        ret = subprocess.call(['zgrep', '<id/>', updateinfo])
-        if not ret:
-            raise RepodataException('updateinfo.xml.gz contains empty ID tags')
+    if os.path.exists(updateinfo) and gzip_contains(updateinfo, '<id/>'):
+        raise RepodataException('updateinfo.xml.gz contains empty ID tags')
 
 
 def age(context, date, nuke_ago=False):
@@ -552,9 +649,14 @@ def testcase_link(context, test, short=False):
 
 
 def sorted_builds(builds):
-    return sorted(builds,
-                  cmp=lambda x, y: rpm.labelCompare(get_nvr(x), get_nvr(y)),
-                  reverse=True)
+    """
+    Return the given build NVRs sorted from the highest version to the lowest.
+
+    Each NVR is parsed only once, rather than on every comparison.
+    """
+    evr_key = functools.cmp_to_key(rpm.labelCompare)
+    keys = dict((build, evr_key(get_nvr(build))) for build in builds)
+    return sorted(builds, key=keys.__getitem__, reverse=True)
 
 
 def sorted_updates(updates):
@@ -565,10 +667,13 @@ def sorted_updates(updates):
     Returns 2 lists, the first being builds that should be tagged synchronously
     in a specific order, where as the second batch can be done asynchronously
     in koji with a multicall.
+
+    The batches are kept in ordered dictionaries, which are used as ordered sets, so that
+    planning the batches takes roughly linear time in the number of builds.
     """
     builds = defaultdict(set)
     build_to_update = {}
-    sync, async = [], []
+    sync, async = collections.OrderedDict(), collections.OrderedDict()
     for update in updates:
         for build in update.builds:
             n, v, r = get_nvr(build.nvr)
@@ -580,14 +685,14 @@ def sorted_updates(updates):
             log.debug(builds[package])
             for build in sorted_builds(builds[package])[::-1]:
                 update = build_to_update[build]
-                if update not in sync:
-                    sync.append(update)
-                if update in async:
-                    async.remove(update)
+                # An update that is already in the batch keeps its place
+                sync[update] = None
+                async.pop(update, None)
         else:
             update = build_to_update[builds[package].pop()]
-            if update not in async and update not in sync:
-                async.append(update)
+            if update not in sync:
+                async[update] = None
+    sync, async = list(sync), list(async)
     log.info('sync = %s' % ([up.title for up in sync],))
     log.info('async = %s' % ([up.title for up in async],))
     return sync, async
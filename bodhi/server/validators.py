@@ -18,10 +18,10 @@ from pyramid.exceptions import HTTPNotFound, HTTPBadRequest
 from pyramid.httpexceptions import HTTPFound
 from sqlalchemy.sql import or_, and_
 import colander
-import koji
 import pyramid.threadlocal
 import rpm
 
+from . import buildsys
 from . import captcha
 from . import log
 from .models import (Release, RpmPackage, Build, Update, UpdateStatus,
@@ -139,16 +139,17 @@ def validate_build_tags(request):
     else:
         valid_tags = tag_types['candidate']
 
-    for build in request.validated.get('builds', []):
+    builds = request.validated.get('builds', [])
+    # Look up the tags of all of the builds at once. Invalid builds are left out.
+    chunk_size = int(request.registry.settings.get('koji_multicall_chunk_size', 500))
+    build_tags = buildsys.get_tags(builds, request.koji, chunk_size=chunk_size, strict=False)
+    for build in builds:
         valid = False
-        try:
-            tags = request.buildinfo[build]['tags'] = [
-                tag['name'] for tag in request.koji.listTags(build)
-            ]
-        except koji.GenericError:
+        if build not in build_tags:
             request.errors.add('body', 'builds',
                                'Invalid koji build: %s' % build)
             return
+        tags = request.buildinfo[build]['tags'] = build_tags[build]
 
         # Disallow adding builds for a different release
         if edited:
@@ -757,9 +758,12 @@ def validate_override_builds(request):
                            'with editing a buildroot override.')
         return
 
+    # Look up the tags of all of the builds at once
+    chunk_size = int(request.registry.settings.get('koji_multicall_chunk_size', 500))
+    build_tags = buildsys.get_tags(nvrs, request.koji, chunk_size=chunk_size, strict=False)
     builds = []
     for nvr in nvrs:
-        result = _validate_override_build(request, nvr, db)
+        result = _validate_override_build(request, nvr, db, build_tags)
         if not result:
             # Then there was some error.
             return
@@ -768,8 +772,14 @@ def validate_override_builds(request):
     request.validated['builds'] = builds
 
 
-def _validate_override_build(request, nvr, db):
-    """ Workhorse function for validate_override_builds """
+def _validate_override_build(request, nvr, db, build_tags=None):
+    """
+    Workhorse function for validate_override_builds
+
+    build_tags is an optional dictionary mapping NVRs to the koji tags that were already fetched.
+    """
+    if build_tags is None:
+        build_tags = {}
     build = Build.get(nvr, db)
     if build is not None:
         if not build.release:
@@ -778,8 +788,8 @@ def _validate_override_build(request, nvr, db):
             tag_types, tag_rels = Release.get_tags(request.db)
             valid_tags = tag_types['candidate'] + tag_types['testing']
 
-            tags = [tag['name'] for tag in request.koji.listTags(nvr)
-                    if tag['name'] in valid_tags]
+            tags = [tag for tag in build.get_tags(request.koji, build_tags)
+                    if tag in valid_tags]
 
             release = Release.from_tags(tags, db)
 
@@ -790,7 +800,7 @@ def _validate_override_build(request, nvr, db):
 
             build.release = release
 
-        for tag in build.get_tags():
+        for tag in build.get_tags(request.koji, build_tags):
             if tag in (build.release.candidate_tag, build.release.testing_tag):
                 # The build is tagged as a candidate or testing
                 break
@@ -807,8 +817,8 @@ def _validate_override_build(request, nvr, db):
         valid_tags = tag_types['candidate'] + tag_types['testing']
 
         try:
-            tags = [tag['name'] for tag in request.koji.listTags(nvr)
-                    if tag['name'] in valid_tags]
+            tags = [tag for tag in buildsys.get_tags([nvr], request.koji, build_tags)[nvr]
+                    if tag in valid_tags]
         except Exception as e:
             request.errors.add('body', 'nvr', "Couldn't determine koji tags "
                                "for %s, %r" % (nvr, str(e)))
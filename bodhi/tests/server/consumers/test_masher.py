@@ -11,15 +11,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-from cStringIO import StringIO
 import datetime
+import hashlib
 import json
 import os
 import shutil
 import tempfile
+import threading
 import time
 import unittest
-import urllib2
 import urlparse
 
 from sqlalchemy import create_engine
@@ -27,9 +27,11 @@ import mock
 
 from bodhi.server import buildsys, log
 from bodhi.server.config import config
-from bodhi.server.consumers.masher import Masher, MasherThread
-from bodhi.server.models import (Base, Build, BuildrootOverride, Release, ReleaseState, Update,
-                                 UpdateRequest, UpdateStatus, UpdateType, User)
+from bodhi.server.consumers.masher import (CompsUpdater, Masher, MasherThread, MashStep,
+                                           PushJournal)
+from bodhi.server.models import (Base, Build, BuildrootOverride, OutboundMail, Release,
+                                 ReleaseState, Update, UpdateRequest, UpdateStatus, UpdateType,
+                                 User)
 from bodhi.server.util import mkmetadatadir, transactional_session_maker
 from bodhi.tests.server import base, populate
 
@@ -186,6 +188,72 @@ class TestMasher(unittest.TestCase):
         self.masher.consume(msg)
         self.assertEquals(len(publish.call_args_list), 1)
 
+    @mock.patch.dict(config, {'masher_max_concurrent_mashes': 2})
+    def test_run_threads(self):
+        """
+        The repos should be started in priority order, with no more than
+        masher_max_concurrent_mashes of them running at once.
+        """
+        started = []
+        running = set()
+        concurrency = []
+
+        class FakeMasherThread(threading.Thread):
+            def __init__(self, release, request, updates, agent, log, db_factory, mash_dir,
+                         resume=False, sync_watcher=None, finished=None, comps_updater=None):
+                super(FakeMasherThread, self).__init__()
+                self.id = '%s-%s' % (release, request)
+                self.finished = finished
+                started.append(self.id)
+                running.add(self.id)
+                concurrency.append(len(running))
+
+            def run(self):
+                # Let the stable repo of the security batch take longer than the others
+                time.sleep(0.2 if self.id == 'F17-stable' else 0.01)
+                running.discard(self.id)
+                self.finished.put(self)
+
+            def results(self):
+                yield self.id
+
+        batches = ([(u'F17', 'testing', [u'a']), (u'F17', 'stable', [u'b'])],
+                   [(u'F18', 'testing', [u'c']), (u'F18', 'stable', [u'd']),
+                    (u'F19', 'stable', [u'e'])])
+
+        with mock.patch('bodhi.server.consumers.masher.MasherThread', FakeMasherThread):
+            results = self.masher.run_threads(batches, u'bowlofeggs', False, None)
+
+        self.assertEqual(started,
+                         ['F17-stable', 'F17-testing', 'F18-stable', 'F19-stable', 'F18-testing'])
+        self.assertEqual(max(concurrency), 2)
+        self.assertEqual(sorted(results), sorted(started))
+        # The other repos should not have waited for the slow one
+        self.assertEqual(results[-1], 'F17-stable')
+
+    @mock.patch.dict(config, {'masher_max_concurrent_mashes': 0})
+    def test_run_threads_no_concurrency(self):
+        """The repos should still be run one at a time if masher_max_concurrent_mashes is 0."""
+        class FakeMasherThread(threading.Thread):
+            def __init__(self, release, request, updates, agent, log, db_factory, mash_dir,
+                         resume=False, sync_watcher=None, finished=None, comps_updater=None):
+                super(FakeMasherThread, self).__init__()
+                self.id = '%s-%s' % (release, request)
+                self.finished = finished
+
+            def run(self):
+                self.finished.put(self)
+
+            def results(self):
+                yield self.id
+
+        batches = ([(u'F17', 'testing', [u'a']), (u'F17', 'stable', [u'b'])],)
+
+        with mock.patch('bodhi.server.consumers.masher.MasherThread', FakeMasherThread):
+            results = self.masher.run_threads(batches, u'bowlofeggs', False, None)
+
+        self.assertEqual(sorted(results), ['F17-stable', 'F17-testing'])
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.server.consumers.masher.MasherThread.update_comps')
     @mock.patch('bodhi.server.consumers.masher.MashThread.run')
@@ -209,7 +277,7 @@ class TestMasher(unittest.TestCase):
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
-            msg=dict(success=False, repo='f17-updates-testing', agent='lmacken'),
+            msg=dict(success=False, repo='f17-updates-testing', agent='lmacken', profile=mock.ANY),
             force=True)
 
         with self.db_factory() as session:
@@ -254,7 +322,7 @@ class TestMasher(unittest.TestCase):
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
-            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken'),
+            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken', profile=mock.ANY),
             force=True)
 
         # Ensure our single update was moved
@@ -330,7 +398,7 @@ class TestMasher(unittest.TestCase):
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
-            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken'),
+            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken', profile=mock.ANY),
             force=True)
 
         # Ensure our two updates were moved
@@ -445,6 +513,45 @@ References:
         except RepodataException:
             pass
 
+    @mock.patch('bodhi.server.consumers.masher.sanity_check_repodata')
+    def test_sanity_check_arches(self, sanity_check_repodata):
+        """Every arch should be checked and reported on, even after another one failed."""
+        from bodhi.server.exceptions import RepodataException
+
+        def check(repodata):
+            if '/i386/' in repodata:
+                raise RepodataException('busted')
+        sanity_check_repodata.side_effect = check
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         'ralph', mock.MagicMock(), self.db_factory, self.tempdir)
+        t.id = 'f17-updates-testing'
+        t.init_path()
+        for arch in ('i386', 'x86_64', 'armhfp'):
+            os.makedirs(os.path.join(t.path, t.id, arch, 'repodata'))
+
+        with self.assertRaises(RepodataException):
+            t.sanity_check_repo()
+
+        self.assertEqual(sanity_check_repodata.call_count, 3)
+        reports = dict((c[1][1], c[1][3]) for c in t.log.info.mock_calls
+                       if c[1][0].startswith('Checked the'))
+        self.assertEqual(reports, {'i386': 'failed', 'x86_64': 'ok', 'armhfp': 'ok'})
+
+    def test_sanity_check_symlinks(self):
+        """A repo whose packages are symlinks should fail the sanity check."""
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         'ralph', log, self.db_factory, self.tempdir)
+        t.id = 'f17-updates-testing'
+        t.init_path()
+        repo = os.path.join(t.path, t.id, 'x86_64')
+        mkmetadatadir(repo)
+        os.symlink('/dev/null', os.path.join(repo, 'bodhi-2.0-1.fc17.noarch.rpm'))
+
+        with self.assertRaises(Exception) as exc:
+            t.sanity_check_repo()
+
+        self.assertEqual(str(exc.exception), 'Mashed repository full of symlinks!')
+
     def test_stage(self):
         t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
                          'ralph', log, self.db_factory, self.tempdir)
@@ -520,7 +627,8 @@ References:
             topic='mashtask.mashing'))
         self.assertEquals(calls[4], mock.call(
             force=True,
-            msg={'success': True, 'repo': 'f18-updates', 'agent': 'lmacken'},
+            msg={'success': True, 'repo': 'f18-updates', 'agent': 'lmacken',
+                 'profile': mock.ANY},
             topic='mashtask.complete'))
         self.assertEquals(calls[5], mock.call(
             force=True,
@@ -532,7 +640,8 @@ References:
             force=True,
             msg={'success': True,
                  'repo': 'f17-updates-testing',
-                 'agent': 'lmacken'},
+                 'agent': 'lmacken',
+                 'profile': mock.ANY},
             topic='mashtask.complete'))
 
     @mock.patch(**mock_taskotron_results)
@@ -594,7 +703,8 @@ References:
         self.assertEquals(calls[3], mock.call(
             msg={'success': True,
                  'repo': 'f17-updates-testing',
-                 'agent': 'lmacken'},
+                 'agent': 'lmacken',
+                 'profile': mock.ANY},
             force=True,
             topic='mashtask.complete'))
         self.assertEquals(calls[4], mock.call(
@@ -604,7 +714,8 @@ References:
             force=True,
             topic='mashtask.mashing'))
         self.assertEquals(calls[-1], mock.call(
-            msg={'success': True, 'repo': 'f18-updates', 'agent': 'lmacken'},
+            msg={'success': True, 'repo': 'f18-updates', 'agent': 'lmacken',
+                 'profile': mock.ANY},
             force=True,
             topic='mashtask.complete'))
 
@@ -718,7 +829,8 @@ References:
                                    force=True,
                                    msg=dict(success=True,
                                             repo='f17-updates',
-                                            agent='ralph'))
+                                            agent='ralph',
+                                            profile=mock.ANY))
         publish.assert_any_call(topic='update.complete.stable',
                                 force=True,
                                 msg=mock.ANY)
@@ -752,7 +864,8 @@ References:
                                    force=True,
                                    msg=dict(success=True,
                                             repo='f17-updates',
-                                            agent='ralph'))
+                                            agent='ralph',
+                                            profile=mock.ANY))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
         self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
@@ -784,7 +897,8 @@ References:
                                    force=True,
                                    msg=dict(success=True,
                                             repo='f17-updates',
-                                            agent='ralph'))
+                                            agent='ralph',
+                                            profile=mock.ANY))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
         self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
@@ -1064,7 +1178,7 @@ References:
         publish.assert_called_with(
             topic="mashtask.complete",
             force=True,
-            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken'))
+            msg=dict(success=True, repo='f17-updates-testing', agent='lmacken', profile=mock.ANY))
 
         self.koji.clear()
 
@@ -1257,6 +1371,230 @@ class TestMasherThread__perform_tag_actions(MasherThreadBaseTestCase):
         self.assertEqual(buildsys.DevBuildsys.__moved__,
                          [('f26-updates-candidate', 'f26-updates-testing', 'bodhi-2.3.2-1.fc26')])
 
+    @mock.patch.dict('bodhi.server.consumers.masher.config',
+                     {'koji_multicall_chunk_size': '2', 'masher_tag_threads': '3'})
+    @mock.patch('bodhi.server.consumers.masher.buildsys.wait_for_tasks', return_value=[])
+    @mock.patch('bodhi.server.consumers.masher.buildsys.multicall')
+    def test_rounds(self, multicall, wait_for_tasks):
+        """
+        Assert that independent packages are tagged together, and that the builds of a package are
+        tagged one round at a time in the order they were given.
+        """
+        multicall.side_effect = lambda method, args_list, **kw: [
+            '%s-%s' % (method, args[-2]) for args in args_list]
+        manager = mock.MagicMock()
+        manager.attach_mock(multicall, 'multicall')
+        manager.attach_mock(wait_for_tasks, 'wait_for_tasks')
+        t = MasherThread(u'F26', u'stable', [u'bodhi-2.3.2-1.fc26'],
+                         'bowlofeggs', log, self.Session, self.tempdir)
+        t.move_tags_sync.extend([
+            (u'f26-updates-candidate', u'f26-updates-testing', u'bodhi-2.3.1-1.fc26'),
+            (u'f26-updates-candidate', u'f26-updates-testing', u'bodhi-2.3.2-1.fc26')])
+        t.add_tags_async.append((u'f26-updates', u'nethack-3.4.3-1.fc26'))
+        t.move_tags_async.append(
+            (u'f26-updates-candidate', u'f26-updates-testing', u'python-2.7.13-1.fc26'))
+
+        t._perform_tag_actions()
+
+        kwargs = {'chunk_size': 2, 'threads': 3}
+        self.assertEqual(
+            manager.mock_calls,
+            [mock.call.multicall('tagBuild', [(u'f26-updates', u'nethack-3.4.3-1.fc26', True)],
+                                 **kwargs),
+             mock.call.multicall(
+                 'moveBuild',
+                 [(u'f26-updates-candidate', u'f26-updates-testing', u'bodhi-2.3.1-1.fc26', True),
+                  (u'f26-updates-candidate', u'f26-updates-testing', u'python-2.7.13-1.fc26',
+                   True)],
+                 **kwargs),
+             mock.call.wait_for_tasks(
+                 ['tagBuild-nethack-3.4.3-1.fc26', 'moveBuild-bodhi-2.3.1-1.fc26',
+                  'moveBuild-python-2.7.13-1.fc26'], mock.ANY, sleep=15),
+             mock.call.multicall(
+                 'moveBuild',
+                 [(u'f26-updates-candidate', u'f26-updates-testing', u'bodhi-2.3.2-1.fc26', True)],
+                 **kwargs),
+             mock.call.wait_for_tasks(['moveBuild-bodhi-2.3.2-1.fc26'], mock.ANY, sleep=15)])
+
+    @mock.patch('bodhi.server.consumers.masher.buildsys.wait_for_tasks',
+                return_value=['moveBuild-python-2.7.13-1.fc26'])
+    @mock.patch('bodhi.server.consumers.masher.buildsys.multicall')
+    def test_journal(self, multicall, wait_for_tasks):
+        """Assert that only the tag actions whose tasks succeeded are journaled."""
+        multicall.side_effect = lambda method, args_list, **kw: [
+            '%s-%s' % (method, args[-2]) for args in args_list]
+        t = MasherThread(u'F26', u'stable', [u'bodhi-2.3.2-1.fc26'],
+                         'bowlofeggs', log, self.Session, self.tempdir)
+        t.add_tags_async.append((u'f26-updates', u'nethack-3.4.3-1.fc26'))
+        t.move_tags_async.append(
+            (u'f26-updates-candidate', u'f26-updates-testing', u'python-2.7.13-1.fc26'))
+
+        with self.assertRaises(Exception):
+            t._perform_tag_actions()
+
+        self.assertEqual(t.journal.entries,
+                         set([('tag', u'nethack-3.4.3-1.fc26', u'f26-updates')]))
+
+
+class TestPushJournal(unittest.TestCase):
+    """This test class contains tests for the PushJournal class."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'JOURNAL-f26-updates')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_load(self):
+        """The recorded entries should be loaded by another journal on the same file."""
+        PushJournal(self.path).record(('modify_bugs', u'bodhi-2.3.2-1.fc26'),
+                                      ('tag', u'bodhi-2.3.2-1.fc26', u'f26-updates'))
+        # A crash may cut the last entry short
+        with open(self.path, 'a') as f:
+            f.write('["announce", "bodhi-2.')
+
+        journal = PushJournal(self.path)
+        journal.load()
+
+        self.assertIn(('modify_bugs', u'bodhi-2.3.2-1.fc26'), journal)
+        self.assertIn(['tag', u'bodhi-2.3.2-1.fc26', u'f26-updates'], journal)
+        self.assertNotIn(('announce', u'bodhi-2.3.2-1.fc26'), journal)
+
+    def test_remove(self):
+        """Removing the journal should delete its file and forget its entries."""
+        journal = PushJournal(self.path)
+        journal.record(('modify_bugs', u'bodhi-2.3.2-1.fc26'))
+
+        journal.remove()
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertNotIn(('modify_bugs', u'bodhi-2.3.2-1.fc26'), journal)
+
+    def test_in_memory(self):
+        """A journal without a path should only keep its entries in memory."""
+        journal = PushJournal(None)
+        journal.record(('modify_bugs', u'bodhi-2.3.2-1.fc26'))
+        journal.load()
+        journal.remove()
+
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+
+class TestMasherThread_resume(MasherThreadBaseTestCase):
+    """This test class contains tests for resuming a push from its journal."""
+
+    def _make_thread(self):
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         'bowlofeggs', log, self.Session, self.tempdir, resume=True)
+        t.id = u'f17-updates-testing'
+        t.init_state()
+        t.state = {'updates': [u'bodhi-2.0-1.fc17'], 'completed_repos': []}
+        t.db = self.db
+        t.updates = [self.db.query(Update).one()]
+        return t
+
+    def test_modify_bugs(self):
+        """Updates whose bugs were already modified should be skipped."""
+        t = self._make_thread()
+        t.journal.record(('modify_bugs', u'bodhi-2.0-1.fc17'))
+
+        with mock.patch('bodhi.server.models.Update.modify_bugs') as modify_bugs:
+            t.modify_bugs()
+
+        self.assertEqual(modify_bugs.call_count, 0)
+
+    def test_modify_bugs_failure(self):
+        """An update should only be journaled once the changes to all of its bugs were made."""
+        t = self._make_thread()
+        t.updates[0].status = UpdateStatus.testing
+
+        with mock.patch('bodhi.server.bugs.bugtracker.on_qa',
+                        side_effect=IOError('Bugzilla is down')):
+            with self.assertRaises(Exception) as exc:
+                t.modify_bugs()
+
+        self.assertEqual(str(exc.exception), 'Unable to modify bugs #12345 of bodhi-2.0-1.fc17')
+        self.assertNotIn(('modify_bugs', u'bodhi-2.0-1.fc17'), t.journal)
+
+        with mock.patch('bodhi.server.bugs.bugtracker.on_qa') as on_qa:
+            t.modify_bugs()
+
+        on_qa.assert_called_once_with(12345, mock.ANY)
+        self.assertIn(('modify_bugs', u'bodhi-2.0-1.fc17'), t.journal)
+
+    def test_journal_replayed(self):
+        """A resumed push should load the journal its failed predecessor left behind."""
+        t = self._make_thread()
+        with mock.patch('bodhi.server.models.Update.modify_bugs') as modify_bugs:
+            t.modify_bugs()
+        self.assertEqual(modify_bugs.call_count, 1)
+
+        t = self._make_thread()
+        t.journal.load()
+
+        self.assertIn(('modify_bugs', u'bodhi-2.0-1.fc17'), t.journal)
+
+    def test_fresh_push(self):
+        """A fresh push should not replay a journal that was left behind."""
+        t = self._make_thread()
+        t.journal.record(('modify_bugs', u'bodhi-2.0-1.fc17'))
+        t.resume = False
+        t.init_state()
+
+        self.assertNotIn(('modify_bugs', u'bodhi-2.0-1.fc17'), t.journal)
+        self.assertFalse(os.path.exists(t.journal.path))
+
+    @mock.patch.dict(config, {'mail_outbox': 'True',
+                              'fedora_announce_list': 'package-announce@example.com'})
+    @mock.patch('bodhi.server.outbox.wake')
+    @mock.patch('bodhi.server.mail._send_mail')
+    def test_send_stable_announcements(self, _send_mail, wake):
+        """Announcements should still have been sent if the push fails after announcing them."""
+        db_factory = base.TransactionalSessionMaker(self.Session)
+        t = self._make_thread()
+        t.resume = False
+        with db_factory() as session:
+            session.query(Update).one().status = UpdateStatus.stable
+
+        try:
+            with db_factory() as session:
+                t.db = session
+                t.updates = [session.query(Update).one()]
+                t.send_stable_announcements()
+                raise Exception('A later step of the push failed')
+        except Exception:
+            pass
+
+        self.assertEqual(self.db.query(OutboundMail).count(), 0)
+        self.assertEqual(_send_mail.call_count, 1)
+        self.assertEqual(_send_mail.call_args[0][1], 'package-announce@example.com')
+
+        t = self._make_thread()
+        t.journal.load()
+        with db_factory() as session:
+            t.db = session
+            t.updates = [session.query(Update).one()]
+            t.send_stable_announcements()
+
+        # The resumed push should not announce the update a second time
+        self.assertEqual(_send_mail.call_count, 1)
+        self.assertEqual(self.db.query(OutboundMail).count(), 0)
+
+    @mock.patch('bodhi.server.consumers.masher.Build.get_tags_for')
+    def test_determine_tag_actions(self, get_tags_for):
+        """Builds that were already tagged should not be tagged again, nor ejected."""
+        t = self._make_thread()
+        t.journal.record(('tag', u'bodhi-2.0-1.fc17', u'f17-updates-testing'))
+        t.skip_mash = False
+
+        with mock.patch.object(t, 'eject_from_mash') as eject_from_mash:
+            t._determine_tag_actions()
+
+        self.assertEqual(eject_from_mash.call_count, 0)
+        self.assertEqual(t.move_tags_sync + t.move_tags_async + t.add_tags_sync +
+                         t.add_tags_async, [])
+
 
 class TestMasherThread_eject_from_mash(MasherThreadBaseTestCase):
     """This test class contains tests for the MasherThread.eject_from_mash() method."""
@@ -1296,70 +1634,150 @@ class TestMasherThread_update_comps(unittest.TestCase):
     def setUp(self):
         self.masher_thread = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'],
                                           u'bowlofeggs', mock.Mock(), mock.Mock(), mock.Mock())
+        self.tempdir = tempfile.mkdtemp()
+        self.comps_dir = os.path.join(self.tempdir, 'comps')
+        self.config = mock.patch('bodhi.server.consumers.masher.config',
+                                 {'comps_dir': self.comps_dir,
+                                  'comps_url': 'https://example.com/'})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        shutil.rmtree(self.tempdir)
+
+    def _cmd(self, head='abc123', make_returncode=0):
+        """Return a fake util.cmd() that clones comps_dir, and exits make with the given code."""
+        def cmd(cmd, cwd=None):
+            if cmd[:2] == ['git', 'clone']:
+                os.makedirs(os.path.join(self.comps_dir, '.git'))
+            elif cmd == ['git', 'rev-parse', 'HEAD']:
+                return head + '\n', '', 0
+            elif cmd == ['make']:
+                return '', '', make_returncode
+            return '', '', 0
+        return cmd
 
-    @mock.patch('bodhi.server.consumers.masher.os.path.exists')
-    @mock.patch('bodhi.server.consumers.masher.config', {'comps_dir': '/some/path',
-                                                         'comps_url': 'https://example.com/'})
     @mock.patch('bodhi.server.consumers.masher.util.cmd')
-    def test_comps_no_dir(self, mock_cmd, mock_exists):
-        mock_exists.return_value = False
+    def test_comps_no_dir(self, mock_cmd):
+        mock_cmd.side_effect = self._cmd()
         calls = [
-            mock.call(['git', 'clone', 'https://example.com/', '/some/path'], '/some'),
-            mock.call(['git', 'pull'], '/some/path'),
-            mock.call(['make'], '/some/path'),
+            mock.call(['git', 'clone', 'https://example.com/', self.comps_dir], self.tempdir),
+            mock.call(['git', 'pull'], self.comps_dir),
+            mock.call(['git', 'rev-parse', 'HEAD'], self.comps_dir),
+            mock.call(['make'], self.comps_dir),
         ]
         self.masher_thread.update_comps()
         self.assertEqual(calls, mock_cmd.call_args_list)
-        mock_exists.assert_called_once_with('/some/path')
 
-    @mock.patch('bodhi.server.consumers.masher.os.path.exists')
-    @mock.patch('bodhi.server.consumers.masher.config', {'comps_dir': '/some/path',
-                                                         'comps_url': 'https://example.com/'})
     @mock.patch('bodhi.server.consumers.masher.util.cmd')
-    def test_comps_existing_dir(self, mock_cmd, mock_exists):
-        mock_exists.return_value = True
+    def test_comps_existing_dir(self, mock_cmd):
+        os.makedirs(os.path.join(self.comps_dir, '.git'))
+        mock_cmd.side_effect = self._cmd()
         calls = [
-            mock.call(['git', 'pull'], '/some/path'),
-            mock.call(['make'], '/some/path'),
+            mock.call(['git', 'pull'], self.comps_dir),
+            mock.call(['git', 'rev-parse', 'HEAD'], self.comps_dir),
+            mock.call(['make'], self.comps_dir),
         ]
         self.masher_thread.update_comps()
         self.assertEqual(calls, mock_cmd.call_args_list)
-        mock_exists.assert_called_once_with('/some/path')
 
-    @mock.patch('bodhi.server.consumers.masher.config', {'comps_dir': '/some/path',
-                                                         'comps_url': 'http://example.com/'})
     @mock.patch('bodhi.server.consumers.masher.util.cmd')
-    def test_comps_unsafe_http_url(self, mock_cmd):
+    def test_comps_unchanged_head(self, mock_cmd):
+        """make should be skipped on the next push if the HEAD has not moved since it was built."""
+        mock_cmd.side_effect = self._cmd()
         self.masher_thread.update_comps()
+        mock_cmd.reset_mock()
+
+        MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'], u'bowlofeggs', mock.Mock(),
+                     mock.Mock(), mock.Mock()).update_comps()
+
+        self.assertEqual(mock_cmd.call_args_list,
+                         [mock.call(['git', 'pull'], self.comps_dir),
+                          mock.call(['git', 'rev-parse', 'HEAD'], self.comps_dir)])
+
+    @mock.patch('bodhi.server.consumers.masher.util.cmd')
+    def test_comps_failed_make(self, mock_cmd):
+        """make should be run again on the next push if it failed."""
+        mock_cmd.side_effect = self._cmd(make_returncode=2)
+        self.masher_thread.update_comps()
+        mock_cmd.reset_mock()
+        mock_cmd.side_effect = self._cmd()
+
+        MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'], u'bowlofeggs', mock.Mock(),
+                     mock.Mock(), mock.Mock()).update_comps()
+
+        self.assertIn(mock.call(['make'], self.comps_dir), mock_cmd.call_args_list)
+
+    @mock.patch('bodhi.server.consumers.masher.util.cmd')
+    def test_comps_failed_make_same_push(self, mock_cmd):
+        """A failed make should be logged, and run again by the next repo of the same push."""
+        mock_cmd.side_effect = self._cmd(make_returncode=2)
+        comps_updater = CompsUpdater()
+        thread_log = mock.Mock()
+
+        MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'], u'bowlofeggs', thread_log,
+                     mock.Mock(), mock.Mock(), comps_updater=comps_updater).update_comps()
+
+        self.assertFalse(comps_updater.updated)
+        thread_log.error.assert_called_once_with('Unable to build comps: make returned %s', 2)
+
+        mock_cmd.reset_mock()
+        mock_cmd.side_effect = self._cmd()
+        MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'], u'bowlofeggs', mock.Mock(),
+                     mock.Mock(), mock.Mock(), comps_updater=comps_updater).update_comps()
+
+        self.assertIn(mock.call(['make'], self.comps_dir), mock_cmd.call_args_list)
+        self.assertTrue(comps_updater.updated)
+
+    @mock.patch('bodhi.server.consumers.masher.util.cmd')
+    def test_comps_once_per_push(self, mock_cmd):
+        """The threads of a push that share a CompsUpdater should only update comps once."""
+        mock_cmd.side_effect = self._cmd()
+        comps_updater = CompsUpdater()
+        for request in (u'stable', u'testing'):
+            MasherThread(u'F17', request, [u'bodhi-2.0-1.fc17'], u'bowlofeggs', mock.Mock(),
+                         mock.Mock(), mock.Mock(), comps_updater=comps_updater).update_comps()
+
+        self.assertEqual(mock_cmd.call_count, 4)
+
+    @mock.patch('bodhi.server.consumers.masher.util.cmd')
+    def test_comps_unsafe_http_url(self, mock_cmd):
+        with mock.patch.dict('bodhi.server.consumers.masher.config',
+                             {'comps_url': 'http://example.com/'}):
+            self.masher_thread.update_comps()
         self.assertEqual(0, mock_cmd.call_count)
         self.masher_thread.log.error.assert_called_once_with('comps_url must start with https://')
 
 
 class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
     """This test class contains tests for the MasherThread.wait_for_sync() method."""
+
+    def _make_thread(self, arches=('aarch64', 'x86_64'), repomd='---\nyaml: rules'):
+        release = self.db.query(Release).filter_by(name=u'F17').one()
+        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
+                         'bowlofeggs', log, self.Session, self.tempdir,
+                         sync_watcher=mock.Mock())
+        t.id = 'f26-updates-testing'
+        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
+        for arch in arches:
+            repodata = os.path.join(t.path, t.id, arch, 'repodata')
+            os.makedirs(repodata)
+            if repomd is not None:
+                with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+                    f.write(repomd)
+        return t
+
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd':
             'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                return_value=StringIO('---\nyaml: rules'))
-    def test_checksum_match_immediately(self, urlopen, publish):
+    def test_checksum_match(self, publish):
         """
-        Assert correct operation when the repomd checksum matches immediately.
+        Assert that the master repomd.xml is watched for with the local checksum.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread(arches=['x86_64'])
+        t.sync_watcher.watch.return_value.wait.return_value = True
 
         t.wait_for_sync()
 
@@ -1368,113 +1786,58 @@ class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
                       force=True),
             mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
                       force=True)]
-        publish.assert_has_calls(expected_calls)
-        urlopen.assert_called_once_with(
-            'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml')
+        self.assertEqual(publish.mock_calls, expected_calls)
+        t.sync_watcher.watch.assert_called_once_with(
+            'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml',
+            hashlib.sha1('---\nyaml: rules').hexdigest())
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd':
             'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[StringIO('wrong'), StringIO('nope'), StringIO('---\nyaml: rules')])
-    def test_checksum_match_third_try(self, urlopen, sleep, publish):
+    def test_timeout(self, publish):
         """
-        Assert correct operation when the repomd checksum matches on the third try.
+        Assert that an Exception is raised if the watcher gives up on the master mirror.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
+        t.sync_watcher.watch.return_value.wait.return_value = False
 
-        t.wait_for_sync()
+        with self.assertRaises(Exception) as exc:
+            t.wait_for_sync()
 
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        expected_calls = [
-            mock.call(
-                'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml')
-            for i in range(3)]
-        urlopen.assert_has_calls(expected_calls)
-        sleep.assert_has_calls([mock.call(200), mock.call(200)])
+        self.assertEqual(unicode(exc.exception),
+                         'Timed out waiting for f26-updates-testing to hit the master mirror')
+        publish.assert_called_once_with(topic='mashtask.sync.wait',
+                                        msg={'repo': t.id, 'agent': 'bowlofeggs'}, force=True)
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd':
             'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
+    @mock.patch('bodhi.server.consumers.masher.SyncWatcher.from_config')
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[urllib2.HTTPError('url', 404, 'Not found', {}, None),
-                     StringIO('---\nyaml: rules')])
-    def test_httperror(self, urlopen, sleep, publish):
+    def test_default_watcher(self, publish, from_config):
         """
-        Assert that an HTTPError is properly caught and logged, and that the algorithm continues.
+        Assert that a watcher is created from the config if the thread was not given one.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
+        t.sync_watcher = None
 
         t.wait_for_sync()
 
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        expected_calls = [
-            mock.call(
-                'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml')
-            for i in range(2)]
-        urlopen.assert_has_calls(expected_calls)
-        t.log.exception.assert_called_once_with('Error fetching repomd.xml')
-        sleep.assert_called_once_with(200)
+        from_config.return_value.watch.return_value.wait.assert_called_once_with()
+        self.assertEqual(publish.call_count, 2)
 
     @mock.patch.dict(
         'bodhi.server.consumers.masher.config',
         {'fedora_testing_master_repomd': None})
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                mock.MagicMock(side_effect=Exception('urlopen should not be called')))
     def test_missing_config_key(self, publish):
         """
         Assert that a ValueError is raised when the needed *_master_repomd config is missing.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
+        t = self._make_thread()
 
         with self.assertRaises(ValueError) as exc:
             t.wait_for_sync()
@@ -1483,70 +1846,165 @@ class TestMasherThread_wait_for_sync(MasherThreadBaseTestCase):
                          'Could not find fedora_testing_master_repomd in the config file')
         publish.assert_called_once_with(topic='mashtask.sync.wait',
                                         msg={'repo': t.id, 'agent': 'bowlofeggs'}, force=True)
+        self.assertEqual(t.sync_watcher.watch.call_count, 0)
 
     @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep',
-                mock.MagicMock(side_effect=Exception('This should not happen during this test.')))
-    @mock.patch('bodhi.server.consumers.masher.urllib2.urlopen',
-                mock.MagicMock(side_effect=Exception('urlopen should not be called')))
     def test_missing_repomd(self, publish):
         """
         Assert that an error is logged when the local repomd is missing.
         """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
+        t = self._make_thread(arches=['x86_64'], repomd=None)
         t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        repodata = os.path.join(t.path, t.id, 'x86_64', 'repodata')
-        os.makedirs(repodata)
 
         t.wait_for_sync()
 
         publish.assert_called_once_with(topic='mashtask.sync.wait',
                                         msg={'repo': t.id, 'agent': 'bowlofeggs'}, force=True)
         t.log.error.assert_called_once_with(
-            'Cannot find local repomd: %s', os.path.join(repodata, 'repomd.xml'))
+            'Cannot find local repomd: %s',
+            os.path.join(t.path, t.id, 'x86_64', 'repodata', 'repomd.xml'))
+        self.assertEqual(t.sync_watcher.watch.call_count, 0)
 
-    @mock.patch.dict(
-        'bodhi.server.consumers.masher.config',
-        {'fedora_testing_master_repomd':
-            'http://example.com/pub/fedora/linux/updates/testing/%s/%s/repodata.repomd.xml'})
-    @mock.patch('bodhi.server.consumers.masher.notifications.publish')
-    @mock.patch('bodhi.server.consumers.masher.time.sleep')
-    @mock.patch(
-        'bodhi.server.consumers.masher.urllib2.urlopen',
-        side_effect=[urllib2.URLError('it broke'),
-                     StringIO('---\nyaml: rules')])
-    def test_urlerror(self, urlopen, sleep, publish):
-        """
-        Assert that a URLError is properly caught and logged, and that the algorithm continues.
-        """
-        release = self.db.query(Release).filter_by(name=u'F17').one()
-        t = MasherThread(release, u'testing', [u'bodhi-2.4.0-1.fc26'],
-                         'bowlofeggs', log, self.Session, self.tempdir)
-        t.id = 'f26-updates-testing'
-        t.log = mock.MagicMock()
-        t.path = os.path.join(self.tempdir, t.id + '-' + time.strftime("%y%m%d.%H%M"))
-        for arch in ['aarch64', 'x86_64']:
-            repodata = os.path.join(t.path, t.id, arch, 'repodata')
-            os.makedirs(repodata)
-            with open(os.path.join(repodata, 'repomd.xml'), 'w') as repomd:
-                repomd.write('---\nyaml: rules')
 
-        t.wait_for_sync()
+class TestMasherThread_run_steps(unittest.TestCase):
+    """This test class contains tests for the MasherThread.run_steps() method."""
 
-        expected_calls = [
-            mock.call(topic='mashtask.sync.wait', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True),
-            mock.call(topic='mashtask.sync.done', msg={'repo': t.id, 'agent': 'bowlofeggs'},
-                      force=True)]
-        publish.assert_has_calls(expected_calls)
-        expected_calls = [
-            mock.call(
-                'http://example.com/pub/fedora/linux/updates/testing/17/x86_64/repodata.repomd.xml')
-            for i in range(2)]
-        urlopen.assert_has_calls(expected_calls)
-        t.log.exception.assert_called_once_with('Error fetching repomd.xml')
-        sleep.assert_called_once_with(200)
+    def setUp(self):
+        self.masher_thread = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'],
+                                          u'bowlofeggs', mock.Mock(), mock.Mock(), mock.Mock())
+        self.calls = []
+
+    def _step(self, name, exception=None):
+        def func():
+            self.calls.append((name, threading.current_thread().name))
+            if exception:
+                raise exception
+        return func
+
+    def test_dependencies(self):
+        """Steps should start after their requirements, and only database steps on this thread."""
+        self.masher_thread.run_steps([
+            MashStep('a', self._step('a')),
+            MashStep('b', self._step('b'), requires=['a', 'c']),
+            MashStep('c', self._step('c'), requires=['a'], db=False),
+            MashStep('d', self._step('d'), requires=['not_a_step']),
+        ])
+
+        names = [name for name, thread in self.calls]
+        self.assertEqual(sorted(names), ['a', 'b', 'c', 'd'])
+        self.assertTrue(names.index('a') < names.index('c') < names.index('b'))
+        threads = dict(self.calls)
+        main = threading.current_thread().name
+        self.assertEqual([threads[n] == main for n in 'abcd'], [True, True, False, True])
+        self.assertEqual(sorted(self.masher_thread.step_times), ['a', 'b', 'c', 'd'])
+
+    def test_failure(self):
+        """No steps should start after one fails, and its exception should be raised."""
+        with self.assertRaises(IOError):
+            self.masher_thread.run_steps([
+                MashStep('a', self._step('a', IOError('oops')), db=False),
+                MashStep('b', self._step('b'), requires=['a']),
+            ])
+
+        self.assertEqual([name for name, thread in self.calls], ['a'])
+
+    def test_cycle(self):
+        """Steps whose requirements can never be met should raise a ValueError."""
+        with self.assertRaises(ValueError):
+            self.masher_thread.run_steps([
+                MashStep('a', self._step('a'), requires=['b']),
+                MashStep('b', self._step('b'), requires=['a']),
+            ])
+
+        self.assertEqual(self.calls, [])
+
+    def test_skip_mash(self):
+        """When the mash is skipped, none of the repository steps should be run."""
+        self.masher_thread.skip_mash = True
+
+        names = [step.name for step in self.masher_thread.get_steps()]
+
+        for name in ('mash', 'wait_for_mash', 'generate_updateinfo', 'wait_for_sync'):
+            self.assertNotIn(name, names)
+        self.assertEqual(names[-1], 'send_testing_digest')
+
+
+class TestMasherThread_profile(unittest.TestCase):
+    """This test class contains tests for the profiling of the MasherThread's steps."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.masher_thread = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                                          u'bowlofeggs', mock.Mock(), mock.Mock(), self.tempdir)
+        self.masher_thread.id = u'f17-updates-testing'
+        self.masher_thread.path = self.tempdir
+        self.masher_thread.start_time = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_run_step(self):
+        """run_step() should record the step's timing and the number of items it handled."""
+        self.masher_thread.run_step(MashStep('a', lambda: None, items=lambda: 3))
+
+        record = self.masher_thread.step_times['a']
+        self.assertEqual(record['items'], 3)
+        self.assertTrue(record['success'])
+        self.assertEqual(record['duration'], record['end'] - record['start'])
+
+    def test_run_step_failure(self):
+        """run_step() should record failed steps, and re-raise their exception."""
+        def fail():
+            raise IOError('oops')
+
+        with self.assertRaises(IOError):
+            self.masher_thread.run_step(MashStep('a', fail, items=lambda: 3))
+
+        record = self.masher_thread.step_times['a']
+        self.assertIsNone(record['items'])
+        self.assertFalse(record['success'])
+
+    @mock.patch('bodhi.server.consumers.masher.notifications.publish')
+    def test_finish(self, publish):
+        """finish() should write the profile to the mash dir and summarize it in the fedmsg."""
+        self.masher_thread.run_step(MashStep('b', lambda: None))
+        self.masher_thread.run_step(MashStep('a', lambda: None, items=lambda: 1))
+
+        self.masher_thread.finish(True)
+
+        with open(os.path.join(self.tempdir, 'profile.json')) as f:
+            profile = json.load(f)
+        self.assertEqual(profile['repo'], 'f17-updates-testing')
+        self.assertEqual(profile['request'], 'testing')
+        self.assertEqual(profile['updates'], 1)
+        self.assertTrue(profile['success'])
+        self.assertEqual([s['name'] for s in profile['steps']], ['b', 'a'])
+        self.assertEqual([s['items'] for s in profile['steps']], [None, 1])
+        msg = publish.mock_calls[0][2]['msg']
+        self.assertEqual(sorted(msg['profile']['steps']), ['a', 'b'])
+        self.assertEqual(msg['profile']['duration'], round(profile['duration'], 2))
+
+    @mock.patch.dict('bodhi.server.consumers.masher.config',
+                     {'masher_cprofile_repos': 'f17-updates f17-updates-testing'})
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.finish')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.get_steps')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.init_path')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.load_updates')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.verify_updates')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.remove_state')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.unlock_updates')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.check_all_karma_thresholds')
+    @mock.patch('bodhi.server.consumers.masher.MasherThread.obsolete_older_updates')
+    @mock.patch('bodhi.server.consumers.masher.notifications.publish')
+    def test_cprofile(self, publish, *args):
+        """Pushes of the repos listed in masher_cprofile_repos should be run under cProfile."""
+        get_steps = args[-2]
+        get_steps.return_value = [MashStep('a', lambda: None)]
+        self.masher_thread.db = mock.Mock()
+        self.masher_thread.db.query.return_value.filter_by.return_value.one.return_value = \
+            mock.Mock(testing_tag=u'f17-updates-testing')
+
+        self.masher_thread.work()
+
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, 'profile.pstats')))
+        self.assertTrue(self.masher_thread.step_times['a']['success'])
@@ -16,11 +16,15 @@
 """This test suite contains tests for the bodhi.server.consumers.signed module."""
 from __future__ import absolute_import, unicode_literals
 
+import threading
+import time
 import unittest
 
 import mock
 
 from bodhi.server.consumers import signed
+from bodhi.server.models import Build, Release
+from bodhi.tests.server import base
 
 
 class TestSignedHandler___init__(unittest.TestCase):
@@ -46,11 +50,20 @@ class TestSignedHandler___init__(unittest.TestCase):
         __init__.assert_called_once_with(hub)
 
 
-class TestSignedHandlerConsume(unittest.TestCase):
+class TestSignedHandlerConsume(base.BaseTestCase):
     """Test class for the :func:`SignedHandler.consume` method."""
 
     def setUp(self):
-        self.sample_message = {
+        super(TestSignedHandlerConsume, self).setUp()
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment', 'topic_prefix': 'topic_prefix'}
+        self.handler = signed.SignedHandler(hub)
+        self.handler.db_factory = base.TransactionalSessionMaker(self.Session)
+        self.handler.batch_window = 0.01
+
+    def message(self, nvr, tag='f17-updates-testing-pending'):
+        name, version, release = nvr.rsplit('-', 2)
+        return {
             'body': {
                 'i': 628,
                 'timestamp': 1484692585,
@@ -60,57 +73,95 @@ class TestSignedHandlerConsume(unittest.TestCase):
                 'signature': '100% real please trust me',
                 'msg': {
                     'build_id': 442562,
-                    'name': 'colord',
+                    'name': name,
                     'tag_id': 214,
                     'instance': 's390',
-                    'tag': 'f26-updates-testing-pending',
+                    'tag': tag,
                     'user': 'sharkcz',
-                    'version': '1.3.4',
+                    'version': version,
                     'owner': 'sharkcz',
-                    'release': '1.fc26'
+                    'release': release
                 },
             },
         }
-        hub = mock.MagicMock()
-        hub.config = {'environment': 'environment', 'topic_prefix': 'topic_prefix'}
-        self.handler = signed.SignedHandler(hub)
 
-    @mock.patch('bodhi.server.consumers.signed.Build')
-    def test_consume(self, mock_build_model):
-        """Assert that messages marking the build as signed updates the database"""
-        build = mock_build_model.get.return_value
-        build.release.pending_testing_tag = self.sample_message['body']['msg']['tag']
+    def test_consume(self):
+        """Assert that builds tagged into a pending_testing tag are queued to be marked signed."""
+        with mock.patch.object(self.handler, 'mark_signed') as mark_signed:
+            done = threading.Event()
+            mark_signed.side_effect = lambda builds: done.set()
 
-        self.handler.consume(self.sample_message)
-        self.assertTrue(build.signed is True)
+            self.handler.consume(self.message('bodhi-2.0-1.fc17'))
+            done.wait(10)
 
-    @mock.patch('bodhi.server.consumers.signed.Build')
-    def test_consume_not_pending_testing_tag(self, mock_build_model):
-        """
-        Assert that messages whose tag don't match the pending testing tag don't update the DB
-        """
-        build = mock_build_model.get.return_value
-        build.release.pending_testing_tag = "some tag that isn't pending testing"
-
-        self.handler.consume(self.sample_message)
-        self.assertFalse(build.signed is True)
+        mark_signed.assert_called_once_with([('bodhi-2.0-1.fc17', 'f17-updates-testing-pending')])
 
-    @mock.patch('bodhi.server.consumers.signed.Build')
-    def test_consume_no_release(self, mock_build_model):
+    def test_consume_not_pending_testing_tag(self):
         """
-        Assert that messages about builds that haven't been assigned a release don't update the DB
+        Assert that messages whose tag isn't a pending_testing tag are dropped, without querying the
+        DB again.
         """
-        build = mock_build_model.get.return_value
-        build.release = None
-
-        self.handler.consume(self.sample_message)
-        self.assertFalse(build.signed is True)
-
-    @mock.patch('bodhi.server.consumers.signed.log')
-    @mock.patch('bodhi.server.consumers.signed.Build')
-    def test_consume_no_build(self, mock_build_model, mock_log):
-        """Assert that messages referencing builds Bodhi doesn't know about don't update the DB"""
-        mock_build_model.get.return_value = None
-
-        self.handler.consume(self.sample_message)
-        mock_log.info.assert_called_with('Build was not submitted, skipping')
+        self.handler.get_pending_testing_tags()
+
+        with mock.patch.object(self.handler, 'db_factory') as db_factory:
+            self.handler.consume(self.message('bodhi-2.0-1.fc17', tag='f17-updates-candidate'))
+
+        self.assertEqual(db_factory.call_count, 0)
+        self.assertTrue(self.handler.incoming_builds.empty())
+        self.assertIsNone(self.handler.batch_thread)
+
+    def test_get_pending_testing_tags(self):
+        """The pending_testing tags should be cached for tag_cache_ttl seconds."""
+        with mock.patch('bodhi.server.consumers.signed.time.time', return_value=100.0):
+            self.assertEqual(self.handler.get_pending_testing_tags(),
+                             {'f17-updates-testing-pending': [self.db.query(Release).one().id]})
+
+        with mock.patch.object(self.handler, 'db_factory') as db_factory:
+            with mock.patch('bodhi.server.consumers.signed.time.time', return_value=150.0):
+                self.handler.get_pending_testing_tags()
+            self.assertEqual(db_factory.call_count, 0)
+
+            with mock.patch('bodhi.server.consumers.signed.time.time', return_value=161.0):
+                self.handler.get_pending_testing_tags()
+            self.assertEqual(db_factory.call_count, 1)
+
+    def test_next_batch(self):
+        """A batch should have the builds that are waiting, up to batch_size of them."""
+        self.handler.batch_size = 2
+        for i in range(3):
+            self.handler.incoming_builds.put(
+                ('bodhi-2.0-%d.fc17' % i, 'f17-updates-testing-pending'))
+
+        self.assertEqual([nvr for nvr, tag in self.handler.next_batch()],
+                         ['bodhi-2.0-0.fc17', 'bodhi-2.0-1.fc17'])
+        self.assertEqual([nvr for nvr, tag in self.handler.next_batch()], ['bodhi-2.0-2.fc17'])
+
+    def test_mark_signed(self):
+        """Assert that the builds Bodhi knows about are marked signed, with one UPDATE."""
+        count = self.handler.mark_signed([
+            ('bodhi-2.0-1.fc17', 'f17-updates-testing-pending'),
+            ('colord-1.3.4-1.fc26', 'f17-updates-testing-pending')])
+
+        self.assertEqual(count, 1)
+        self.assertTrue(self.db.query(Build).filter_by(nvr='bodhi-2.0-1.fc17').one().signed)
+
+    def test_mark_signed_not_pending_testing_tag(self):
+        """Assert that builds tagged into another release's tag don't update the DB."""
+        # A release other than F17 uses the tag
+        self.handler.pending_testing_tags = {
+            'f26-updates-testing-pending': [self.db.query(Release).one().id + 1]}
+        self.handler.pending_testing_tags_loaded = time.time()
+
+        count = self.handler.mark_signed([('bodhi-2.0-1.fc17', 'f26-updates-testing-pending')])
+
+        self.assertEqual(count, 0)
+        self.assertFalse(self.db.query(Build).filter_by(nvr='bodhi-2.0-1.fc17').one().signed)
+
+    def test_mark_signed_already_signed(self):
+        """Assert that builds that are already signed aren't counted again."""
+        self.db.query(Build).filter_by(nvr='bodhi-2.0-1.fc17').one().signed = True
+        self.db.flush()
+
+        count = self.handler.mark_signed([('bodhi-2.0-1.fc17', 'f17-updates-testing-pending')])
+
+        self.assertEqual(count, 0)
@@ -16,6 +16,7 @@
 """This test suite contains tests for the bodhi.server.consumers.updates module."""
 
 import copy
+import threading
 import unittest
 
 import mock
@@ -26,8 +27,8 @@ from bodhi.server.consumers import updates
 from bodhi.tests.server import base
 
 
-class TestUpdatesHandlerConsume(base.BaseTestCase):
-    """This test class contains tests for the UpdatesHandler.consume() method."""
+class TestUpdatesHandlerHandle(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.handle() method."""
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.work_on_bugs')
     def test_edited_update_bug_not_in_update(self, work_on_bugs, fetch_test_cases):
@@ -45,7 +46,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345', '123456']}}}
 
-        self.assertRaises(AssertionError, h.consume, message)
+        self.assertRaises(AssertionError, h.handle, message)
 
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
@@ -72,7 +73,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345']}}}
 
-        h.consume(message)
+        h.handle(message)
 
         self.assertEqual(work_on_bugs.call_count, 1)
         self.assertTrue(isinstance(work_on_bugs.mock_calls[0][1][1],
@@ -105,7 +106,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['this isnt a real bug lol']}}}
 
-        h.consume(message)
+        h.handle(message)
 
         self.assertEqual(work_on_bugs.call_count, 1)
         self.assertTrue(isinstance(work_on_bugs.mock_calls[0][1][1],
@@ -134,14 +135,15 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'},
                              'new_bugs': ['12345']}}}
 
-        self.assertRaises(NotImplementedError, h.consume, message)
+        self.assertRaises(NotImplementedError, h.handle, message)
 
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
 
+    @mock.patch('bodhi.server.consumers.updates.time.sleep')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.work_on_bugs')
-    def test_update_not_found(self, work_on_bugs, fetch_test_cases):
+    def test_update_not_found(self, work_on_bugs, fetch_test_cases, sleep):
         """
         If the message references an update that isn't found, assert that an Exception is raised.
         """
@@ -156,11 +158,40 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {'alias': u'hurd-1.0-1.fc26'}}}}
 
         with self.assertRaises(exceptions.BodhiException) as exc:
-            h.consume(message)
+            h.handle(message)
 
         self.assertEqual(str(exc.exception), "Couldn't find alias u'hurd-1.0-1.fc26' in DB")
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
+        # The update should have been looked for again, with a growing delay
+        self.assertEqual(sleep.mock_calls,
+                         [mock.call(0.5), mock.call(1.0), mock.call(2.0), mock.call(4.0),
+                          mock.call(8.0)])
+
+    @mock.patch('bodhi.server.consumers.updates.time.sleep')
+    @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
+    @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.work_on_bugs')
+    def test_update_found_later(self, work_on_bugs, fetch_test_cases, sleep):
+        """
+        An update that is not in the database yet should be handled once it gets there.
+        """
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        h.db_factory = base.TransactionalSessionMaker(self.Session)
+        message = {
+            'topic': 'bodhi.update.request.testing',
+            'body': {'msg': {'update': {'alias': u'bodhi-2.0-1.fc17'}}}}
+        update = self.db.query(updates.Update).one()
+
+        with mock.patch('bodhi.server.consumers.updates.Update.get',
+                        side_effect=[None, None, update]):
+            h.handle(message)
+
+        self.assertEqual(sleep.mock_calls, [mock.call(0.5), mock.call(1.0)])
+        self.assertEqual(work_on_bugs.call_count, 1)
+        self.assertEqual(fetch_test_cases.call_count, 1)
 
     @mock.patch('bodhi.server.consumers.updates.log.error')
     @mock.patch('bodhi.server.consumers.updates.UpdatesHandler.fetch_test_cases')
@@ -179,7 +210,7 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             'body': {'msg': {'update': {},
                              'new_bugs': ['12345']}}}
 
-        h.consume(message)
+        h.handle(message)
 
         self.assertEqual(work_on_bugs.call_count, 0)
         self.assertEqual(fetch_test_cases.call_count, 0)
@@ -187,6 +218,137 @@ class TestUpdatesHandlerConsume(base.BaseTestCase):
             "Update Handler got update with no alias {'new_bugs': ['12345'], 'update': {}}.")
 
 
+class TestUpdatesHandlerWorkOnBugs(base.BaseTestCase):
+    """This test class contains tests for the UpdatesHandler.work_on_bugs() method."""
+    @mock.patch('bodhi.server.consumers.updates.bug_module.bugtracker')
+    def test_bugs_fetched_once(self, bugtracker):
+        """The bugs should be fetched together, and then commented on and modified."""
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        h.handle_bugs = True
+        update = self.db.query(updates.Update).one()
+        bugtracker.getbugs.return_value = {12345: 'bug 12345'}
+
+        h.work_on_bugs(self.db, update, update.bugs)
+
+        bugtracker.getbugs.assert_called_once_with([12345])
+        self.assertEqual(bugtracker.getbug.call_count, 0)
+        bugtracker.update_details.assert_called_once_with('bug 12345', update.bugs[0])
+        bugtracker.cached_bugs.assert_called_once_with({12345: 'bug 12345'})
+        bugtracker.comment.assert_called_once_with(
+            12345, updates.config['initial_bug_msg'] % (
+                update.title, update.release.long_name, update.abs_url()))
+        bugtracker.modified.assert_called_once_with(12345)
+
+    @mock.patch('bodhi.server.consumers.updates.bug_module.bugtracker')
+    def test_bugzilla_errors(self, bugtracker):
+        """Failures to fetch or modify the bugs should be logged, and not stop the handler."""
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        h = updates.UpdatesHandler(hub)
+        h.handle_bugs = True
+        update = self.db.query(updates.Update).one()
+        bugtracker.getbugs.side_effect = IOError('Bugzilla is down')
+        bugtracker.getbug.return_value = 'bug 12345'
+        bugtracker.comment.side_effect = IOError('Bugzilla is down')
+
+        with mock.patch('bodhi.server.consumers.updates.log.warning') as warning:
+            with mock.patch('bodhi.server.bugs.log.exception') as exception:
+                h.work_on_bugs(self.db, update, update.bugs)
+
+        bugtracker.getbug.assert_called_once_with(12345)
+        bugtracker.update_details.assert_called_once_with('bug 12345', update.bugs[0])
+        self.assertEqual([c[0][0] for c in warning.call_args_list],
+                         ['Error occured during fetching the bugs'])
+        exception.assert_called_once_with('Unable to make the changes to bug #12345')
+
+
+class TestUpdatesHandlerBatches(unittest.TestCase):
+    """This test class contains tests for the batching of the UpdatesHandler's messages."""
+    def setUp(self):
+        hub = mock.MagicMock()
+        hub.config = {'environment': 'environment',
+                      'topic_prefix': 'topic_prefix'}
+        self.handler = updates.UpdatesHandler(hub)
+
+    def message(self, alias, timestamp=None):
+        message = {'topic': 'bodhi.update.request.testing',
+                   'body': {'msg': {'update': {'alias': alias}}}}
+        if timestamp is not None:
+            message['body']['timestamp'] = timestamp
+        return message
+
+    def test_consume(self):
+        """Consumed messages should be handled by the batch thread."""
+        handled = []
+        done = threading.Event()
+
+        def handle(message):
+            handled.append(message)
+            if len(handled) == 2:
+                done.set()
+
+        self.handler.batch_window = 0.01
+        with mock.patch.object(self.handler, 'handle', side_effect=handle):
+            self.handler.consume(self.message(u'FEDORA-2017-1'))
+            self.handler.consume(self.message(u'FEDORA-2017-2'))
+            done.wait(10)
+
+        self.assertEqual(sorted(m['body']['msg']['update']['alias'] for m in handled),
+                         [u'FEDORA-2017-1', u'FEDORA-2017-2'])
+
+    def test_next_batch(self):
+        """A batch should have the messages that are waiting, up to batch_size of them."""
+        self.handler.batch_size = 2
+        self.handler.batch_window = 0.01
+        for i in range(3):
+            self.handler.incoming_messages.put((i, self.message(u'FEDORA-2017-%d' % i)))
+
+        self.assertEqual([arrived for arrived, m in self.handler.next_batch()], [0, 1])
+        self.assertEqual([arrived for arrived, m in self.handler.next_batch()], [2])
+
+    @mock.patch('bodhi.server.consumers.updates.time.time', return_value=100.0)
+    def test_handle_batch(self, time):
+        """
+        The messages should all be handled, the ones about the same update in order, and their lag
+        should be counted.
+        """
+        batch = [(99.0, self.message(u'FEDORA-2017-1', timestamp=90.0)),
+                 (98.0, self.message(u'FEDORA-2017-2')),
+                 (99.5, self.message(u'FEDORA-2017-1'))]
+        handled = []
+        with mock.patch.object(self.handler, 'handle', side_effect=handled.append):
+            self.handler.handle_batch(batch)
+
+        self.assertEqual(len(handled), 3)
+        self.assertEqual([m for m in handled if m['body']['msg']['update']['alias'] ==
+                          u'FEDORA-2017-1'], [batch[0][1], batch[2][1]])
+        self.assertEqual(self.handler.lag,
+                         {'batches': 1, 'messages': 3, 'total_seconds': 12.5,
+                          'max_seconds': 10.0})
+
+    @mock.patch('bodhi.server.consumers.updates.log.exception')
+    def test_handle_batch_failure(self, exception):
+        """A message that fails should not keep the others from being handled."""
+        handled = []
+
+        def handle(message):
+            if message['body']['msg']['update']['alias'] == u'FEDORA-2017-1':
+                raise exceptions.BodhiException('Nope')
+            handled.append(message)
+
+        with mock.patch.object(self.handler, 'handle', side_effect=handle):
+            self.handler.handle_batch([(1, self.message(u'FEDORA-2017-1')),
+                                       (1, self.message(u'FEDORA-2017-2'))])
+
+        self.assertEqual([m['body']['msg']['update']['alias'] for m in handled],
+                         [u'FEDORA-2017-2'])
+        exception.assert_called_once_with('Unable to handle bodhi.update.request.testing')
+
+
 class TestUpdatesHandlerInit(unittest.TestCase):
     """This test class contains tests for the UpdatesHandler.__init__() method."""
     def test_handle_bugs_bodhi_email_falsy(self):
@@ -199,6 +199,172 @@ class TestBugzilla(unittest.TestCase):
         bz._bz.getbug.return_value.setstatus.assert_called_once_with('ON_QA', comment='A message.')
         self.assertEqual(exception.call_count, 0)
 
+    @mock.patch.dict('bodhi.server.bugs.config', {'bz_products': 'Fedora'})
+    def test_cached_bug_status(self):
+        """Changes to a prefetched bug should see the status that the previous changes set."""
+        bz = bugs.Bugzilla()
+        bz._bz = mock.MagicMock()
+        bug = mock.MagicMock(product='Fedora', bug_status='NEW')
+
+        with bz.cached_bugs({1411188: bug}):
+            bz.modified(1411188)
+            bz.modified(1411188)
+            bz.on_qa(1411188, 'A message.')
+            bz.modified(1411188)
+
+        self.assertEqual(bug.setstatus.mock_calls,
+                         [mock.call('MODIFIED'), mock.call('ON_QA', comment='A message.'),
+                          mock.call('MODIFIED')])
+        self.assertEqual(bug.bug_status, 'MODIFIED')
+        self.assertEqual(bz._bz.getbug.call_count, 0)
+
+    @mock.patch.dict('bodhi.server.bugs.config', {'bugzilla_chunk_size': '2'})
+    @mock.patch('bodhi.server.bugs.log.exception')
+    def test_getbugs(self, exception):
+        """getbugs() should fetch the bugs in chunks, and leave out the ones it could not fetch."""
+        bz = bugs.Bugzilla()
+        bz._bz = mock.MagicMock()
+        bz._bz.getbugs.side_effect = [['bug 1', None], IOError('Bugzilla is down'), ['bug 5']]
+
+        fetched = bz.getbugs([1, 2, 3, 4, 5])
+
+        self.assertEqual(fetched, {1: 'bug 1', 5: 'bug 5'})
+        self.assertEqual(bz._bz.getbugs.mock_calls,
+                         [mock.call([1, 2]), mock.call([3, 4]), mock.call([5])])
+        exception.assert_called_once_with('Unable to fetch bugs [3, 4]')
+
+    def test_cached_bugs(self):
+        """The bugs given to cached_bugs() should be used instead of fetching them again."""
+        bz = bugs.Bugzilla()
+        bz._bz = mock.MagicMock()
+        bug = mock.MagicMock()
+
+        with bz.cached_bugs({1411188: bug}):
+            bz.on_qa(1411188, 'A message.')
+            bz.on_qa(1411189, 'A message.')
+        bz.on_qa(1411188, 'A message.')
+
+        bug.setstatus.assert_called_once_with('ON_QA', comment='A message.')
+        self.assertEqual(bz._bz.getbug.mock_calls,
+                         [mock.call(1411189), mock.call().setstatus('ON_QA', comment='A message.'),
+                          mock.call(1411188), mock.call().setstatus('ON_QA', comment='A message.')])
+
+    @mock.patch.dict('bodhi.server.bugs.config', {'bugzilla_retries': '2'})
+    @mock.patch('bodhi.server.bugs.time.sleep')
+    def test__retry(self, sleep):
+        """Calls that cannot reach Bugzilla should be tried again with a growing delay."""
+        bz = bugs.Bugzilla()
+        func = mock.MagicMock(side_effect=[IOError('timed out'), IOError('timed out'), 'done'])
+
+        self.assertEqual(bz._retry(func, 1, comment='A message.'), 'done')
+
+        self.assertEqual(func.mock_calls, [mock.call(1, comment='A message.')] * 3)
+        self.assertEqual(sleep.mock_calls, [mock.call(1), mock.call(2)])
+
+    @mock.patch.dict('bodhi.server.bugs.config', {'bugzilla_retries': '1'})
+    @mock.patch('bodhi.server.bugs.time.sleep')
+    def test__retry_gives_up(self, sleep):
+        """The last error should be raised once the retries are used up."""
+        bz = bugs.Bugzilla()
+        func = mock.MagicMock(side_effect=IOError('timed out'))
+
+        self.assertRaises(IOError, bz._retry, func)
+
+        self.assertEqual(func.call_count, 2)
+        sleep.assert_called_once_with(1)
+
+
+class TestBugSync(unittest.TestCase):
+    """This test class contains tests for the BugSync class."""
+    def test_apply(self):
+        """The queued changes should be made with the prefetched bugs, in order for each bug."""
+        tracker = mock.MagicMock()
+        tracker.getbugs.return_value = {1: 'bug 1', 2: 'bug 2'}
+        sync = bugs.BugSync(tracker)
+
+        sync.comment(1, 'A comment.')
+        sync.on_qa(2, 'On QA.')
+        sync.modified(1)
+        sync.close(2, versions={'bodhi': 'bodhi-2.0-1.fc17'}, comment='Closed.')
+        self.assertEqual(tracker.mock_calls, [])
+
+        with mock.patch.dict('bodhi.server.bugs.config', {'bugzilla_rate_limit': '0'}):
+            sync.apply()
+
+        tracker.getbugs.assert_called_once_with([1, 2])
+        self.assertEqual(tracker.cached_bugs.mock_calls.count(mock.call({1: 'bug 1', 2: 'bug 2'})),
+                         2)
+        calls = [c for c in tracker.mock_calls if c[0] in ('comment', 'on_qa', 'modified', 'close')]
+        self.assertEqual(
+            [c for c in calls if c[1][0] == 1],
+            [mock.call.comment(1, 'A comment.'), mock.call.modified(1)])
+        self.assertEqual(
+            [c for c in calls if c[1][0] == 2],
+            [mock.call.on_qa(2, 'On QA.'),
+             mock.call.close(2, versions={'bodhi': 'bodhi-2.0-1.fc17'}, comment='Closed.')])
+        self.assertEqual(sync.changes, {})
+
+    def test_apply_with_bugs(self):
+        """Bugs that were already fetched should not be fetched again."""
+        tracker = mock.MagicMock()
+        sync = bugs.BugSync(tracker)
+        sync.modified(1)
+
+        sync.apply({1: 'bug 1'})
+
+        self.assertEqual(tracker.getbugs.call_count, 0)
+        tracker.cached_bugs.assert_called_once_with({1: 'bug 1'})
+        tracker.modified.assert_called_once_with(1)
+
+    def test_apply_errors(self):
+        """A failing bug should be reported, without stopping the changes to the other bugs."""
+        tracker = mock.MagicMock()
+        tracker.comment.side_effect = [IOError('Bugzilla is down'), None]
+        sync = bugs.BugSync(tracker)
+        for bug_id in (1, 2):
+            sync.comment(bug_id, 'A comment.')
+            sync.modified(bug_id)
+        done = []
+
+        with mock.patch.dict('bodhi.server.bugs.config', {'bugzilla_threads': '1'}):
+            self.assertEqual(sync.apply({}, done=done.append), [1])
+
+        self.assertEqual(done, [2])
+        tracker.modified.assert_called_once_with(2)
+        self.assertEqual(sync.changes, {})
+
+    def test_apply_nothing(self):
+        """Nothing should be fetched when no changes were queued."""
+        tracker = mock.MagicMock()
+
+        bugs.BugSync(tracker).apply()
+
+        self.assertEqual(tracker.mock_calls, [])
+
+
+class TestRateLimiter(unittest.TestCase):
+    """This test class contains tests for the RateLimiter class."""
+    @mock.patch('bodhi.server.bugs.time.sleep')
+    @mock.patch('bodhi.server.bugs.time.time', return_value=100.0)
+    def test_wait(self, time, sleep):
+        """Calls beyond the rate should be spaced out."""
+        limiter = bugs.RateLimiter(4)
+
+        for i in range(3):
+            limiter.wait()
+
+        self.assertEqual(sleep.mock_calls, [mock.call(0.25), mock.call(0.5)])
+
+    @mock.patch('bodhi.server.bugs.time.sleep')
+    def test_no_limit(self, sleep):
+        """A rate of 0 should not limit anything."""
+        limiter = bugs.RateLimiter(0)
+
+        for i in range(3):
+            limiter.wait()
+
+        self.assertEqual(sleep.call_count, 0)
+
 
 class TestFakeBugTracker(unittest.TestCase):
     """This test class contains tests for the FakeBugTracker class."""
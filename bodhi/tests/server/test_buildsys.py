@@ -151,6 +151,7 @@ class TestGetSession(unittest.TestCase):
         """Assert calls to get_session raise RuntimeError when uninitialized"""
         self.assertRaises(RuntimeError, buildsys.get_session)
 
+    @mock.patch('bodhi.server.buildsys._session_pool', None)
     @mock.patch('bodhi.server.buildsys._buildsystem')
     @mock.patch('bodhi.server.buildsys._buildsystem_login_lock', wraps=Lock())
     def test_buildsys_lock(self, mock_lock, mock_buildsystem):
@@ -160,6 +161,17 @@ class TestGetSession(unittest.TestCase):
         mock_lock.__exit__.assert_called_once()
         mock_buildsystem.assert_called_once_with()
 
+    @mock.patch('bodhi.server.buildsys._session_pool')
+    @mock.patch('bodhi.server.buildsys._buildsystem')
+    @mock.patch('bodhi.server.buildsys._buildsystem_login_lock', wraps=Lock())
+    def test_pool_without_lock(self, mock_lock, mock_buildsystem, mock_pool):
+        """Assert that pooled sessions are checked out without the buildsystem lock"""
+        session = buildsys.get_session()
+
+        self.assertEqual(session, mock_pool.checkout.return_value)
+        self.assertEqual(mock_lock.__enter__.call_count, 0)
+        self.assertEqual(mock_buildsystem.call_count, 0)
+
 
 class TestSetupBuildsystem(unittest.TestCase):
     """Tests :func:`bodhi.server.buildsys.setup_buildsystem` function"""
@@ -195,3 +207,348 @@ class TestSetupBuildsystem(unittest.TestCase):
         self.assertTrue(buildsys._buildsystem is None)
         self.assertRaises(ValueError, buildsys.setup_buildsystem,
                           {'buildsystem': 'Something unsupported'})
+
+
+class TestKojiSessionPool(unittest.TestCase):
+    """This test class contains tests for the KojiSessionPool class."""
+    def setUp(self):
+        self.factory = mock.MagicMock(side_effect=lambda: mock.MagicMock(multicall=False))
+        self.login = mock.MagicMock()
+        self.pool = buildsys.KojiSessionPool(self.factory, self.login, size=2, max_idle_age=900,
+                                             health_check_interval=60)
+
+    def test_checkin_reuses_session(self):
+        """Assert that a session that was checked in is handed out again."""
+        session = self.pool.checkout()
+        wrapped = session._session
+        del session
+
+        session = self.pool.checkout()
+
+        self.assertTrue(session._session is wrapped)
+        self.assertEqual(self.factory.call_count, 1)
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 1, 'misses': 1, 'relogins': 0, 'discarded': 0, 'idle': 0})
+
+    def test_concurrent_checkouts_get_different_sessions(self):
+        """Sessions that are in use must not be handed out twice."""
+        first = self.pool.checkout()
+        second = self.pool.checkout()
+
+        self.assertFalse(first._session is second._session)
+        self.assertEqual(self.pool.misses, 2)
+
+    def test_checkin_resets_multicall(self):
+        """A session should not go back into the pool with multicall enabled."""
+        session = self.pool.checkout()
+        session.multicall = True
+        wrapped = session._session
+
+        session.checkin()
+
+        self.assertEqual(wrapped.multicall, False)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_checkin_full_pool(self):
+        """Sessions beyond the pool size are logged out."""
+        sessions = [self.pool.checkout() for i in range(3)]
+        wrapped = [s._session for s in sessions]
+
+        for session in sessions:
+            session.checkin()
+
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        self.assertEqual(self.pool.discarded, 1)
+        wrapped[2].logout.assert_called_once_with()
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_idle_session_expired(self, time):
+        """Sessions that have been idle for too long are discarded."""
+        time.return_value = 1000
+        self.pool.checkout().checkin()
+        time.return_value = 2000
+
+        self.pool.checkout()
+
+        self.assertEqual(self.factory.call_count, 2)
+        self.assertEqual(self.pool.discarded, 1)
+        self.assertEqual(self.pool.hits, 0)
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_health_check_relogin(self, time):
+        """An idle session whose ticket expired is logged in again before it is reused."""
+        time.return_value = 1000
+        session = self.pool.checkout()
+        wrapped = session._session
+        wrapped.getLoggedInUser.side_effect = koji.AuthExpired
+        session.checkin()
+        time.return_value = 1100
+
+        session = self.pool.checkout()
+
+        self.assertTrue(session._session is wrapped)
+        self.login.assert_called_once_with(wrapped)
+        self.assertEqual(self.pool.relogins, 1)
+        self.assertEqual(self.pool.hits, 1)
+
+    @mock.patch('bodhi.server.buildsys.time.time')
+    def test_health_check_failed_relogin(self, time):
+        """An idle session that cannot log in again is replaced with a new one."""
+        time.return_value = 1000
+        self.pool.checkout().checkin()
+        self.pool._idle[0][0].getLoggedInUser.return_value = None
+        self.login.side_effect = koji.AuthError
+        time.return_value = 1100
+
+        self.pool.checkout()
+
+        self.assertEqual(self.factory.call_count, 2)
+        self.assertEqual(self.pool.discarded, 1)
+
+    def test_call_retried_after_expiry(self):
+        """A call that fails because the session expired is retried after logging in again."""
+        session = self.pool.checkout()
+        session._session.listTags.side_effect = [koji.AuthExpired, ['f26']]
+
+        self.assertEqual(session.listTags('bodhi-2.0-1.fc26'), ['f26'])
+
+        self.login.assert_called_once_with(session._session)
+        self.assertEqual(session._session.listTags.call_count, 2)
+
+    def test_clear(self):
+        """clear() logs out all of the idle sessions."""
+        self.pool.checkout().checkin()
+
+        self.pool.clear()
+
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertEqual(self.pool.discarded, 1)
+
+
+class TestGetPoolStats(unittest.TestCase):
+    """Tests :func:`bodhi.server.buildsys.get_pool_stats` function"""
+
+    @mock.patch('bodhi.server.buildsys._session_pool', None)
+    def test_no_pool(self):
+        """Assert that None is returned when sessions aren't pooled."""
+        self.assertEqual(buildsys.get_pool_stats(), None)
+
+    @mock.patch('bodhi.server.buildsys._buildsystem', None)
+    @mock.patch('bodhi.server.buildsys._session_pool', None)
+    @mock.patch('bodhi.server.buildsys.koji_login')
+    def test_koji_pool(self, koji_login):
+        """Assert that get_session() goes through the pool for the koji buildsystem."""
+        buildsys.setup_buildsystem({'buildsystem': 'koji', 'koji_session_pool_size': '3'})
+
+        session = buildsys.get_session()
+        session.checkin()
+        session = buildsys.get_session()
+
+        self.assertEqual(koji_login.call_count, 1)
+        self.assertEqual(buildsys.get_pool_stats(),
+                         {'hits': 1, 'misses': 1, 'relogins': 0, 'discarded': 0, 'idle': 0})
+        self.assertEqual(buildsys._session_pool.size, 3)
+
+
+class TestDevBuildsysMulticall(unittest.TestCase):
+    """Tests for the multicall emulation of the DevBuildsys."""
+    def tearDown(self):
+        buildsys.DevBuildsys.clear()
+
+    def test_multicall_collects_results(self):
+        """Calls made in multicall mode should have their results returned by multiCall()."""
+        koji_session = buildsys.DevBuildsys()
+        koji_session.multicall = True
+
+        self.assertEqual(koji_session.getBuild('bodhi-2.0-1.fc17'), None)
+        koji_session.tagBuild('f17-updates-testing', 'bodhi-2.0-1.fc17')
+
+        results = koji_session.multiCall()
+
+        self.assertEqual(results[0][0]['nvr'], 'bodhi-2.0-1.fc17')
+        self.assertEqual(results[1], [None])
+        self.assertEqual(buildsys.DevBuildsys.__added__,
+                         [('f17-updates-testing', 'bodhi-2.0-1.fc17')])
+        self.assertEqual(koji_session.multicall, False)
+        self.assertEqual(koji_session.multiCall(), [])
+
+    def test_no_multicall(self):
+        """Calls made outside of multicall mode should return their results directly."""
+        koji_session = buildsys.DevBuildsys()
+
+        self.assertEqual(koji_session.getBuild('bodhi-2.0-1.fc17')['nvr'], 'bodhi-2.0-1.fc17')
+        self.assertEqual(koji_session.multiCall(), [])
+
+
+class TestMulticall(unittest.TestCase):
+    """Tests :func:`bodhi.server.buildsys.multicall` function"""
+    def setUp(self):
+        buildsys.setup_buildsystem({'buildsystem': 'dev'})
+
+    def tearDown(self):
+        buildsys.teardown_buildsystem()
+
+    @mock.patch('bodhi.server.buildsys.get_session')
+    def test_chunks(self, get_session):
+        """Assert that the calls are split into chunks, and that results keep their order."""
+        sessions = []
+
+        def new_session():
+            session = buildsys.DevBuildsys()
+            sessions.append(session)
+            return session
+        get_session.side_effect = new_session
+        nvrs = ['bodhi-2.0-%d.fc17' % i for i in range(5)]
+
+        builds = buildsys.multicall('getBuild', [(nvr,) for nvr in nvrs], chunk_size=2)
+
+        self.assertEqual([b['nvr'] for b in builds], nvrs)
+        self.assertEqual(len(sessions), 3)
+
+    def test_threads(self):
+        """Assert that the chunks can be sent from several threads."""
+        nvrs = ['bodhi-2.0-%d.fc17' % i for i in range(10)]
+
+        builds = buildsys.multicall('getBuild', [(nvr,) for nvr in nvrs], chunk_size=3, threads=4)
+
+        self.assertEqual([b['nvr'] for b in builds], nvrs)
+
+    def test_no_calls(self):
+        """Assert that nothing is sent to koji when there is nothing to do."""
+        self.assertEqual(buildsys.multicall('getBuild', []), [])
+
+    @mock.patch('bodhi.server.buildsys.get_session')
+    def test_fault(self, get_session):
+        """Assert that a fault from koji is raised."""
+        get_session.return_value.multiCall.return_value = [
+            [{'id': 1}], {'faultCode': 1000, 'faultString': 'No such build'}]
+
+        with self.assertRaises(koji.GenericError) as exc:
+            buildsys.multicall('getBuild', [('a-1-1',), ('b-1-1',)])
+
+        self.assertEqual(str(exc.exception), 'getBuild failed: No such build')
+
+
+class TestWaitForTasks(unittest.TestCase):
+    """Tests :func:`bodhi.server.buildsys.wait_for_tasks` function"""
+    def _session(self, finished, states=None):
+        """
+        Return a mock koji session whose taskFinished multicalls return the given polls in turn.
+
+        Each item of finished is a list of the results of one poll's taskFinished calls.
+        """
+        states = states or {}
+        session = mock.MagicMock()
+        polls = iter(finished)
+        queued = []
+        session.taskFinished.side_effect = lambda task: queued.append(('taskFinished', task))
+        session.getTaskInfo.side_effect = lambda task: queued.append(('getTaskInfo', task))
+
+        def multiCall():
+            calls = list(queued)
+            del queued[:]
+            if calls[0][0] == 'getTaskInfo':
+                return [[{'state': koji.TASK_STATES[states.get(task, 'CLOSED')]}]
+                        for method, task in calls]
+            return [[result] for result in next(polls)]
+        session.multiCall.side_effect = multiCall
+        return session
+
+    @mock.patch('bodhi.server.buildsys.time.sleep')
+    def test_batched_polls(self, sleep):
+        """All of the unfinished tasks should be checked with one multicall per poll."""
+        session = self._session([[False, True, False], [False, True], [True]])
+
+        failed_tasks = buildsys.wait_for_tasks([1, 2, None, 3], session, sleep=15)
+
+        self.assertEqual(failed_tasks, [])
+        self.assertEqual(session.multiCall.call_count, 6)
+        self.assertEqual(session.taskFinished.mock_calls,
+                         [mock.call(1), mock.call(2), mock.call(3),
+                          mock.call(1), mock.call(3), mock.call(1)])
+        self.assertEqual(session.getTaskInfo.mock_calls,
+                         [mock.call(2), mock.call(3), mock.call(1)])
+        self.assertEqual(sleep.mock_calls, [mock.call(1), mock.call(2)])
+
+    @mock.patch('bodhi.server.buildsys.time.sleep')
+    def test_backoff(self, sleep):
+        """The delay between polls should double after every poll, up to sleep seconds."""
+        session = self._session([[False]] * 6 + [[True]])
+
+        buildsys.wait_for_tasks([1], session, sleep=15)
+
+        self.assertEqual(sleep.mock_calls,
+                         [mock.call(d) for d in (1, 2, 4, 8, 15, 15)])
+
+    @mock.patch('bodhi.server.buildsys.time.sleep',
+                mock.MagicMock(side_effect=Exception('There should be no need to sleep')))
+    def test_failed_tasks(self):
+        """The tasks that did not close should be returned."""
+        session = self._session([[True, True, True]], {2: 'FAILED', 3: 'CANCELED'})
+
+        failed_tasks = buildsys.wait_for_tasks([1, 2, 3], session)
+
+        self.assertEqual(failed_tasks, [2, 3])
+
+    def test_no_tasks(self):
+        """Nothing should be sent to koji when there are no tasks to wait for."""
+        session = mock.MagicMock()
+
+        self.assertEqual(buildsys.wait_for_tasks([None], session), [])
+
+        self.assertEqual(session.multiCall.call_count, 0)
+
+
+class TestGetTags(unittest.TestCase):
+    """Tests :func:`bodhi.server.buildsys.get_tags` function"""
+    def setUp(self):
+        buildsys.setup_buildsystem({'buildsystem': 'dev'})
+
+    def tearDown(self):
+        buildsys.teardown_buildsystem()
+
+    def test_chunks(self):
+        """The tags should be fetched with one listTags multicall per chunk."""
+        session = buildsys.DevBuildsys()
+        nvrs = ['bodhi-2.0-%d.fc17' % i for i in range(5)] + ['bodhi-2.0-1.el5']
+
+        with mock.patch.object(session, 'multiCall', wraps=session.multiCall) as multiCall:
+            tags = buildsys.get_tags(nvrs, session, chunk_size=4)
+
+        self.assertEqual(multiCall.call_count, 2)
+        self.assertEqual(sorted(tags), sorted(nvrs))
+        self.assertEqual(tags['bodhi-2.0-0.fc17'],
+                         ['f17-updates-candidate', 'f17', 'f17-updates-testing'])
+        self.assertEqual(tags['bodhi-2.0-1.el5'][-1], 'dist-5E-epel')
+
+    def test_cache(self):
+        """Builds in the cache should not be looked up again, and new ones should be cached."""
+        session = mock.MagicMock()
+        session.multiCall.return_value = [[[{'name': 'f17'}]]]
+        cache = {'bodhi-2.0-1.fc17': ['f17-updates']}
+
+        tags = buildsys.get_tags(['bodhi-2.0-1.fc17', 'bodhi-2.0-2.fc17', 'bodhi-2.0-1.fc17'],
+                                 session, cache)
+
+        self.assertEqual(tags, {'bodhi-2.0-1.fc17': ['f17-updates'], 'bodhi-2.0-2.fc17': ['f17']})
+        self.assertEqual(cache, tags)
+        session.listTags.assert_called_once_with('bodhi-2.0-2.fc17')
+
+        buildsys.get_tags(['bodhi-2.0-2.fc17'], session, cache)
+
+        self.assertEqual(session.multiCall.call_count, 1)
+
+    def test_fault(self):
+        """A fault should be raised, unless strict is False."""
+        session = mock.MagicMock()
+        session.multiCall.return_value = [
+            [[{'name': 'f17'}]], {'faultCode': 1000, 'faultString': 'No such build'}]
+
+        with self.assertRaises(koji.GenericError) as exc:
+            buildsys.get_tags(['a-1-1', 'b-1-1'], session)
+
+        self.assertEqual(str(exc.exception), 'Unable to get the tags of b-1-1: No such build')
+
+        tags = buildsys.get_tags(['a-1-1', 'b-1-1'], session, strict=False)
+
+        self.assertEqual(tags, {'a-1-1': ['f17']})
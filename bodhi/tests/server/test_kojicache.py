@@ -0,0 +1,180 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test module contains tests for bodhi.server.kojicache."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from bodhi.server import kojicache
+
+
+class TestKojiCache(unittest.TestCase):
+    """This test class contains tests for the KojiCache class."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = kojicache.KojiCache(os.path.join(self.tempdir, 'koji.sqlite'),
+                                         max_entries=3, eviction_interval=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_set(self):
+        """A stored response should be returned for the same call only."""
+        self.cache.set('getBuild', 'bodhi-2.0-1.fc17', value={'nvr': 'bodhi-2.0-1.fc17'})
+
+        self.assertEqual(self.cache.get('getBuild', 'bodhi-2.0-1.fc17'),
+                         {'nvr': 'bodhi-2.0-1.fc17'})
+        self.assertIsNone(self.cache.get('getBuild', 'bodhi-2.0-2.fc17'))
+        self.assertIsNone(self.cache.get('getRPMHeaders', 'bodhi-2.0-1.fc17'))
+
+    def test_shared(self):
+        """Another KojiCache on the same file should see the same entries."""
+        self.cache.set('getBuild', 'bodhi-2.0-1.fc17', value={'nvr': 'bodhi-2.0-1.fc17'})
+
+        other = kojicache.KojiCache(self.cache.path)
+
+        self.assertEqual(other.get('getBuild', 'bodhi-2.0-1.fc17'), {'nvr': 'bodhi-2.0-1.fc17'})
+
+    @mock.patch('bodhi.server.kojicache.time.time')
+    def test_eviction(self, time):
+        """The oldest entries should be evicted beyond max_entries, even if they were read."""
+        for i in range(3):
+            time.return_value = i
+            self.cache.set('getBuild', 'bodhi-2.0-%d.fc17' % i, value=i)
+        self.assertEqual(self.cache.get('getBuild', 'bodhi-2.0-0.fc17'), 0)
+
+        time.return_value = 4
+        self.cache.set('getBuild', 'bodhi-2.0-3.fc17', value=3)
+
+        self.assertIsNone(self.cache.get('getBuild', 'bodhi-2.0-0.fc17'))
+        for i in (1, 2, 3):
+            self.assertEqual(self.cache.get('getBuild', 'bodhi-2.0-%d.fc17' % i), i)
+
+    def _count(self):
+        with kojicache.sqlite3.connect(self.cache.path) as connection:
+            return connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def test_eviction_interval(self):
+        """Entries should only be evicted every eviction_interval writes."""
+        self.cache.eviction_interval = 4
+        for i in range(4):
+            self.cache.set('getBuild', 'bodhi-2.0-%d.fc17' % i, value=i)
+        self.assertEqual(self._count(), 4)
+
+        self.cache.set('getBuild', 'bodhi-2.0-4.fc17', value=4)
+
+        self.assertEqual(self._count(), 3)
+
+    def test_schema_created_once(self):
+        """The responses table should only be created by the first connection to a file."""
+        self.cache.set('getBuild', 'bodhi-2.0-1.fc17', value=1)
+        with kojicache.sqlite3.connect(self.cache.path) as connection:
+            connection.execute('DROP TABLE responses')
+
+        with mock.patch('bodhi.server.kojicache.log') as log:
+            self.assertIsNone(self.cache.get('getBuild', 'bodhi-2.0-1.fc17'))
+
+        log.exception.assert_called_once_with('Unable to read the koji cache %s' % self.cache.path)
+
+    def test_tampered(self):
+        """Data that isn't valid marshal data should be treated as a cache miss."""
+        self.cache.set('getBuild', 'bodhi-2.0-1.fc17', value=1)
+        with kojicache.sqlite3.connect(self.cache.path) as connection:
+            connection.execute('UPDATE responses SET value = ?',
+                               (kojicache.sqlite3.Binary('cos\nsystem\n(S\'true\'\ntR.'),))
+
+        with mock.patch('bodhi.server.kojicache.log') as log:
+            self.assertIsNone(self.cache.get('getBuild', 'bodhi-2.0-1.fc17'))
+
+        self.assertEqual(log.exception.call_count, 1)
+
+    def test_types(self):
+        """Cached responses should have the same types as the ones koji returned."""
+        header = {'name': 'bodhi', 'changelogname': ['Jos\xe9 <jose@example.com>'],
+                  'description': u'Caf\xe9'}
+        self.cache.set('getRPMHeaders', 'bodhi-2.0-1.fc17', value=header)
+
+        cached = self.cache.get('getRPMHeaders', 'bodhi-2.0-1.fc17')
+
+        self.assertEqual(cached, header)
+        self.assertIs(type(cached['name']), str)
+        self.assertIs(type(cached['changelogname'][0]), str)
+        self.assertIs(type(cached['description']), unicode)
+
+    def test_unserializable(self):
+        """A response that can't be serialized should just not be cached."""
+        with mock.patch('bodhi.server.kojicache.log') as log:
+            self.cache.set('getBuild', 'bodhi-2.0-1.fc17', value={'lock': threading.Lock()})
+
+        self.assertIsNone(self.cache.get('getBuild', 'bodhi-2.0-1.fc17'))
+        self.assertEqual(log.exception.call_count, 1)
+
+    def test_disabled(self):
+        """A KojiCache without a path should not store anything."""
+        cache = kojicache.KojiCache(None)
+
+        cache.set('getBuild', 'bodhi-2.0-1.fc17', value={'nvr': 'bodhi-2.0-1.fc17'})
+
+        self.assertIsNone(cache.get('getBuild', 'bodhi-2.0-1.fc17'))
+
+    def test_unreadable(self):
+        """Errors from sqlite should be logged, and treated as cache misses."""
+        cache = kojicache.KojiCache(self.tempdir)
+
+        with mock.patch('bodhi.server.kojicache.log') as log:
+            cache.set('getBuild', 'bodhi-2.0-1.fc17', value={})
+            self.assertIsNone(cache.get('getBuild', 'bodhi-2.0-1.fc17'))
+
+        self.assertEqual(log.exception.call_count, 2)
+
+
+class TestGetBuild(unittest.TestCase):
+    """This test class contains tests for the get_build() function."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.config = mock.patch.dict(
+            'bodhi.server.kojicache.config',
+            {'koji_cache_file': os.path.join(self.tempdir, 'koji.sqlite')})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_cached(self):
+        """The build should only be fetched from koji once."""
+        session = mock.MagicMock()
+        session.getBuild.return_value = {'nvr': 'bodhi-2.0-1.fc17', 'epoch': None}
+
+        for i in range(2):
+            self.assertEqual(kojicache.get_build('bodhi-2.0-1.fc17', session),
+                             {'nvr': 'bodhi-2.0-1.fc17', 'epoch': None})
+
+        session.getBuild.assert_called_once_with('bodhi-2.0-1.fc17')
+
+    def test_unknown_build(self):
+        """Builds that koji does not know should not be cached."""
+        session = mock.MagicMock()
+        session.getBuild.return_value = None
+
+        for i in range(2):
+            self.assertIsNone(kojicache.get_build('bodhi-2.0-1.fc17', session))
+
+        self.assertEqual(session.getBuild.call_count, 2)
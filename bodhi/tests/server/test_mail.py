@@ -0,0 +1,64 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test module contains tests for bodhi.server.mail."""
+import mock
+
+from bodhi.server import buildsys, mail
+from bodhi.server.models import Update
+from bodhi.server.util import get_rpm_header
+from bodhi.tests.server import base
+
+
+class TestPrefetchTemplateData(base.BaseTestCase):
+    """This test class contains tests for the prefetch_template_data() function."""
+
+    def setUp(self):
+        super(TestPrefetchTemplateData, self).setUp()
+        buildsys.setup_buildsystem({'buildsystem': 'dev'})
+
+    def tearDown(self):
+        buildsys.teardown_buildsystem()
+        super(TestPrefetchTemplateData, self).tearDown()
+
+    @mock.patch.dict('bodhi.server.mail.config', {'mail_koji_threads': '2'})
+    def test_prefetch(self):
+        """The prefetched data should match what get_template() would look up for each build."""
+        update = self.db.query(Update).one()
+        build = update.builds[0]
+        latest = build.get_latest()
+
+        template_data = mail.prefetch_template_data([update])
+
+        self.assertEqual(
+            template_data,
+            {build.nvr: {'header': get_rpm_header(build.nvr), 'latest': latest,
+                         'latest_header': latest and get_rpm_header(latest) or None}})
+
+    def test_no_updates(self):
+        """Nothing should be fetched when there are no updates."""
+        self.assertEqual(mail.prefetch_template_data([]), {})
+
+    def test_get_template(self):
+        """get_template() should render the same notice from the prefetched data, without koji."""
+        update = self.db.query(Update).one()
+        expected = mail.get_template(update)
+        template_data = mail.prefetch_template_data([update])
+
+        with mock.patch('bodhi.server.mail.get_rpm_header',
+                        side_effect=Exception('koji should not be used')):
+            with mock.patch('bodhi.server.models.Build.get_latest',
+                            side_effect=Exception('koji should not be used')):
+                templates = mail.get_template(update, template_data=template_data)
+
+        self.assertEqual(templates, expected)
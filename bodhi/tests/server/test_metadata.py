@@ -25,8 +25,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from zope.sqlalchemy import ZopeTransactionExtension
 import createrepo_c
+import mock
 
-from bodhi.server import log
+from bodhi.server import buildsys, log
 from bodhi.server.buildsys import (setup_buildsystem, teardown_buildsystem,
                                    get_session, DevBuildsys)
 from bodhi.server.config import config
@@ -118,6 +119,83 @@ class TestAddUpdate(base.BaseTestCase):
         self.assertEquals(pkg.arch, 'noarch')
         self.assertEquals(pkg.filename, 'TurboGears-1.0.2.2-2.fc7.noarch.rpm')
 
+    @mock.patch.dict(config, {'koji_multicall_chunk_size': '1'})
+    def test_rpms_fetched_in_bulk(self):
+        """
+        Assert that the builds and their RPMs are fetched with chunked koji multicalls before the
+        notices are generated.
+        """
+        update = self.db.query(Update).one()
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+
+        with mock.patch('bodhi.server.metadata.buildsys.multicall',
+                        wraps=buildsys.multicall) as multicall:
+            md._fetch_rpms([update])
+
+        nvr = update.builds[0].nvr
+        self.assertEqual(
+            multicall.mock_calls,
+            [mock.call('getBuild', [(nvr,)], chunk_size=1, threads=1),
+             mock.call('listBuildRPMs', [(md.builds[nvr]['id'],)], chunk_size=1, threads=1)])
+        self.assertEqual([rpm['arch'] for rpm in md.rpms[nvr]], ['src', 'noarch'])
+
+        # add_update() should use the RPMs we already have rather than asking koji again
+        with mock.patch('bodhi.server.metadata.buildsys.multicall') as multicall:
+            md.add_update(update)
+
+        self.assertEqual(multicall.call_count, 0)
+        self.assertEqual(len(md.uinfo.updates[-1].collections[0].packages), 2)
+
+
+class TestFetchUpdates(base.BaseTestCase):
+    """
+    This class contains tests for the ExtendedMetadata._fetch_updates() method.
+    """
+    def setUp(self):
+        """
+        Initialize our temporary repo.
+        """
+        super(TestFetchUpdates, self).setUp()
+        setup_buildsystem({'buildsystem': 'dev'})
+        self.tempdir = tempfile.mkdtemp('bodhi')
+        self.temprepo = join(self.tempdir, 'f17-updates-testing')
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'i386'))
+
+    def tearDown(self):
+        """
+        Clean up the tempdir.
+        """
+        super(TestFetchUpdates, self).tearDown()
+        teardown_buildsystem()
+        shutil.rmtree(self.tempdir)
+
+    @mock.patch.dict(config, {'updateinfo_db_chunk_size': '1'})
+    @mock.patch('bodhi.server.metadata.log')
+    def test_bulk_lookup(self, log):
+        """
+        Assert that tagged builds are resolved to their updates, and that builds without an update
+        or unknown to bodhi are logged.
+        """
+        update = self.db.query(Update).one()
+        orphan = Build(nvr=u'TurboGears-1.0.2.2-2.fc7', package=update.builds[0].package,
+                       release=update.release)
+        self.db.add(orphan)
+        self.db.flush()
+        tagged = {update.builds[0].nvr: [update.release.testing_tag]}
+
+        with mock.patch.dict(DevBuildsys.__tagged__, tagged):
+            md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+
+        self.assertEqual(md.updates, set([update]))
+        self.assertEqual(
+            sorted(md.builds.keys()),
+            [update.builds[0].nvr, u'TurboGears-1.0.2.2-2.fc7', u'TurboGears-1.0.2.2-3.fc7'])
+        log.warn.assert_called_once_with(
+            'TurboGears-1.0.2.2-2.fc7 does not have a corresponding update')
+        log.warning.assert_called_once_with(
+            "Couldn't find the following koji builds tagged as f17-updates-testing in bodhi: "
+            "['TurboGears-1.0.2.2-3.fc7']")
+
 
 class TestExtendedMetadata(unittest.TestCase):
 
@@ -283,6 +361,124 @@ class TestExtendedMetadata(unittest.TestCase):
         self.assertEquals(pkg.arch, 'src')
         self.assertEquals(pkg.filename, 'TurboGears-1.0.2.2-2.fc7.src.rpm')
 
+    def test_dump_updateinfo(self):
+        """
+        Assert that the streamed updateinfo matches the document createrepo_c would serialize.
+        """
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        updateinfo = join(self.tempdir, 'updateinfo.xml')
+
+        with open(updateinfo, 'w') as f:
+            md.dump_updateinfo(f)
+
+        uinfo = createrepo_c.UpdateInfo(updateinfo)
+        self.assertEqual([n.title for n in uinfo.updates], [update.title])
+        self.assertEqual(uinfo.xml_dump(), md.uinfo.xml_dump())
+
+    def test_insert_updateinfo_multiple_arches(self):
+        """
+        Assert that the updateinfo is compressed once and the same file is linked into the
+        repodata of every arch.
+        """
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'x86_64'))
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        compress_and_fill = createrepo_c.RepomdRecord.compress_and_fill
+
+        with mock.patch('bodhi.server.metadata.cr.RepomdRecord.compress_and_fill',
+                        autospec=True, side_effect=compress_and_fill) as compress:
+            md.insert_updateinfo()
+
+        self.assertEqual(compress.call_count, 1)
+        i386 = self._verify_updateinfo(self.repodata)
+        x86_64 = self._verify_updateinfo(
+            join(self.temprepo, 'f17-updates-testing', 'x86_64', 'repodata'))
+        self.assertEqual(basename(i386), basename(x86_64))
+        self.assertTrue(os.path.samefile(i386, x86_64))
+        for arch in ('i386', 'x86_64'):
+            repomd = createrepo_c.Repomd(
+                join(self.temprepo, 'f17-updates-testing', arch, 'repodata', 'repomd.xml'))
+            records = [r for r in repomd.records if r.type == 'updateinfo']
+            self.assertEqual([r.location_href for r in records], ['repodata/' + basename(i386)])
+        # The scratch directory should have been cleaned up
+        self.assertEqual(sorted(os.listdir(self.temprepo)), ['f17-updates-testing'])
+
+    def _cache_repodata(self):
+        """Generate the updateinfo of the test update, cache it, and return the cached repodata."""
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        md.insert_updateinfo()
+        md.cache_repodata()
+        return join(self.tempdir, 'f17-updates-testing.repocache', 'repodata')
+
+    def test_cache_repodata_hardlinks(self):
+        """The repodata should be hardlinked into the cache, replacing the previous cache."""
+        old_cache = join(self.tempdir, 'f17-updates-testing.repocache', 'repodata')
+        os.makedirs(old_cache)
+        with open(join(old_cache, 'stale.xml'), 'w') as f:
+            f.write('stale')
+
+        cache = self._cache_repodata()
+
+        self.assertEqual(sorted(os.listdir(cache)), sorted(os.listdir(self.repodata)))
+        for filename in os.listdir(cache):
+            self.assertTrue(os.path.samefile(join(cache, filename), join(self.repodata, filename)))
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['f17-updates-testing', 'f17-updates-testing.repocache'])
+
+    def test_cache_repodata_leftovers(self):
+        """The directories left over by an interrupted run should be removed."""
+        for suffix in ('.new', '.old'):
+            os.makedirs(join(self.tempdir, 'f17-updates-testing.repocache' + suffix, 'repodata'))
+
+        cache = self._cache_repodata()
+
+        self.assertEqual(sorted(os.listdir(cache)), sorted(os.listdir(self.repodata)))
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['f17-updates-testing', 'f17-updates-testing.repocache'])
+
+    def test_cache_repodata_rename_fails(self):
+        """The previous cache should be put back if the new one can't be renamed into place."""
+        old_cache = join(self.tempdir, 'f17-updates-testing.repocache', 'repodata')
+        os.makedirs(old_cache)
+        with open(join(old_cache, 'repomd.xml'), 'w') as f:
+            f.write('previous')
+        rename = os.rename
+
+        def fail_new(src, dst):
+            if src.endswith('.repocache.new'):
+                raise OSError('No space left on device')
+            rename(src, dst)
+
+        with mock.patch('bodhi.server.metadata.os.rename', side_effect=fail_new):
+            self.assertRaises(OSError, self._cache_repodata)
+
+        self.assertEqual(os.listdir(old_cache), ['repomd.xml'])
+        self.assertFalse(os.path.exists(old_cache.replace('.repocache', '.repocache.old')))
+
+    @mock.patch('bodhi.server.metadata.os.link', side_effect=OSError('Invalid cross-device link'))
+    def test_cache_repodata_copy(self, link):
+        """Only the files the next push reads should be copied if they can't be hardlinked."""
+        cache = self._cache_repodata()
+
+        updateinfo = self._verify_updateinfo(self.repodata)
+        self.assertEqual(sorted(os.listdir(cache)), sorted(['repomd.xml', basename(updateinfo)]))
+        self.assertFalse(os.path.samefile(join(cache, 'repomd.xml'),
+                                          join(self.repodata, 'repomd.xml')))
+
     def test_extended_metadata_updating(self):
         update = self.db.query(Update).one()
 
@@ -333,6 +529,8 @@ class TestExtendedMetadata(unittest.TestCase):
         mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'i386'))
 
         md = ExtendedMetadata(update.release, update.request, self.db, self.temprepo)
+        self.assertEqual(md.notices_reused, 1)
+        self.assertEqual(md.notices_regenerated, 0)
         md.insert_updateinfo()
         updateinfo = self._verify_updateinfo(self.repodata)
 
@@ -404,6 +602,8 @@ class TestExtendedMetadata(unittest.TestCase):
         self.assertEquals(notice.description, u'x')
         self.assertEquals(notice.updated_date.strftime('%Y-%m-%d %H:%M:%S'),
                           update.date_modified.strftime('%Y-%m-%d %H:%M:%S'))
+        self.assertEqual(md.notices_reused, 0)
+        self.assertEqual(md.notices_regenerated, 1)
 
     def test_metadata_updating_with_old_stable_security(self):
         update = self.db.query(Update).one()
@@ -224,6 +224,28 @@ class TestBuild(ModelTest):
     def test_url(self):
         eq_(self.obj.get_url(), u'/TurboGears-1.0.8-3.fc11')
 
+    def test_get_tags(self):
+        """The build's tags should be fetched from koji, and stored in the given cache."""
+        cache = {}
+
+        tags = self.obj.get_tags(cache=cache)
+
+        eq_(tags, [u'f11-updates-candidate', u'f11', u'f11-updates-testing'])
+        eq_(cache, {u'TurboGears-1.0.8-3.fc11': tags})
+
+    @mock.patch.dict(config, {'koji_multicall_chunk_size': '1'})
+    def test_get_tags_for_cache(self):
+        """Only the builds that are not in the cache should be looked up in koji."""
+        koji = mock.MagicMock()
+        koji.multiCall.return_value = [[[{'name': u'f11-updates'}]]]
+        other = model.Build(nvr=u'TurboGears-1.0.8-4.fc11')
+        cache = {self.obj.nvr: [u'f11']}
+
+        tags = model.Build.get_tags_for([self.obj, other], koji, cache)
+
+        eq_(tags, {self.obj.nvr: [u'f11'], other.nvr: [u'f11-updates']})
+        koji.listTags.assert_called_once_with(other.nvr)
+
 
 class TestUpdate(ModelTest):
     """Unit test case for the ``Update`` model."""
@@ -940,7 +962,7 @@ class TestUpdate(ModelTest):
 
         update.send_update_notice()
 
-        get_template.assert_called_with(update, u'fedora_errata_template')
+        get_template.assert_called_with(update, u'fedora_errata_template', None)
 
     @mock.patch('bodhi.server.mail.get_template')
     def test_send_update_notice_message_template_el7(self, get_template):
@@ -958,7 +980,7 @@ class TestUpdate(ModelTest):
 
         update.send_update_notice()
 
-        get_template.assert_called_with(update, u'fedora_epel_legacy_errata_template')
+        get_template.assert_called_with(update, u'fedora_epel_legacy_errata_template', None)
 
     @mock.patch('bodhi.server.mail.get_template')
     def test_send_update_notice_message_template_el8(self, get_template):
@@ -976,7 +998,36 @@ class TestUpdate(ModelTest):
 
         update.send_update_notice()
 
-        get_template.assert_called_with(update, u'fedora_epel_errata_template')
+        get_template.assert_called_with(update, u'fedora_epel_errata_template', None)
+
+    @mock.patch.dict(config, {'updateinfo_db_chunk_size': 1})
+    def test_get_by_titles(self):
+        """The updates should be returned in the order of the titles, without the unknown ones."""
+        update = self.get_update(name=u'TurboGears-1.0.8-4.fc11')
+        self.db.add(update)
+        self.db.flush()
+
+        updates = model.Update.get_by_titles(
+            [u'TurboGears-1.0.8-4.fc11', u'unknown-1.0-1.fc11', self.obj.title], self.db)
+
+        eq_(updates, [update, self.obj])
+
+    @mock.patch.dict(config, {'updateinfo_db_chunk_size': 1})
+    def test_lock_all(self):
+        """The updates should be locked in the database as well as in the session."""
+        update = self.get_update(name=u'TurboGears-1.0.8-4.fc11')
+        self.db.add(update)
+        self.db.flush()
+
+        model.Update.lock_all([self.obj, update], self.db)
+
+        for u in (self.obj, update):
+            eq_(u.locked, True)
+            assert u.date_locked <= datetime.utcnow()
+        self.db.expire_all()
+        for u in self.db.query(model.Update).all():
+            eq_(u.locked, True)
+            assert u.date_locked <= datetime.utcnow()
 
 
 class TestUser(ModelTest):
@@ -18,6 +18,7 @@
 import unittest
 
 import mock
+import transaction
 
 from bodhi.server import notifications
 
@@ -81,3 +82,127 @@ class TestInit(unittest.TestCase):
         init_config = init.mock_calls[0][2]
         self.assertEqual(init_config['cert_prefix'], 'This is a real cert trust me.')
         info.assert_called_once_with('fedmsg initialized')
+
+
+class Serializable(object):
+    """An object with a __json__() method, that counts how many times it was serialized."""
+    def __init__(self, title):
+        self.title = title
+        self.calls = 0
+
+    def __json__(self):
+        self.calls += 1
+        return {'title': self.title}
+
+
+class TestEncode(unittest.TestCase):
+    """This test class contains tests for the encode() function."""
+    def test_memoized(self):
+        """Objects included in several messages should only be serialized once."""
+        update = Serializable(u'bodhi-2.0-1.fc17')
+        other = Serializable(u'bodhi-2.0-2.fc17')
+
+        encoded = notifications.encode([
+            ('update.comment', {'update': update, 'agent': u'bowlofeggs'}),
+            ('update.request.stable', {'update': update, 'other': other, 'count': 2})])
+
+        self.assertEqual(encoded, [
+            ('update.comment', {'update': {'title': u'bodhi-2.0-1.fc17'}, 'agent': u'bowlofeggs'}),
+            ('update.request.stable', {'update': {'title': u'bodhi-2.0-1.fc17'},
+                                       'other': {'title': u'bodhi-2.0-2.fc17'}, 'count': 2})])
+        self.assertEqual(update.calls, 1)
+        self.assertEqual(other.calls, 1)
+
+
+class TestPublish(unittest.TestCase):
+    """This test class contains tests for the publish() function."""
+    @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
+    @mock.patch('bodhi.server.notifications.get_publisher')
+    def test_force(self, get_publisher):
+        """Forced messages should be serialized, and handed to the publisher right away."""
+        notifications.publish('mashtask.start', {'update': Serializable(u'bodhi-2.0-1.fc17')},
+                              force=True)
+
+        get_publisher.return_value.enqueue.assert_called_once_with(
+            [('mashtask.start', {'update': {'title': u'bodhi-2.0-1.fc17'}})])
+
+    @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
+    @mock.patch('bodhi.server.notifications.get_publisher')
+    def test_transaction(self, get_publisher):
+        """Messages should only be handed to the publisher once the transaction commits."""
+        update = Serializable(u'bodhi-2.0-1.fc17')
+        transaction.begin()
+        notifications.publish('update.comment', {'update': update})
+        notifications.publish('update.karma.threshold.reach', {'update': update})
+
+        self.assertEqual(get_publisher.call_count, 0)
+
+        transaction.commit()
+
+        get_publisher.return_value.enqueue.assert_called_once_with(
+            [('update.comment', {'update': {'title': u'bodhi-2.0-1.fc17'}}),
+             ('update.karma.threshold.reach', {'update': {'title': u'bodhi-2.0-1.fc17'}})])
+        self.assertEqual(update.calls, 1)
+
+    @mock.patch.dict('bodhi.server.config.config', {'fedmsg_enabled': True})
+    @mock.patch('bodhi.server.notifications.get_publisher')
+    def test_abort(self, get_publisher):
+        """Nothing should be published if the transaction is aborted."""
+        transaction.begin()
+        notifications.publish('update.comment', {'update': Serializable(u'bodhi-2.0-1.fc17')})
+
+        transaction.abort()
+
+        self.assertEqual(get_publisher.call_count, 0)
+
+
+class TestFedmsgPublisher(unittest.TestCase):
+    """This test class contains tests for the FedmsgPublisher class."""
+    def setUp(self):
+        notifications.stats.reset()
+
+    @mock.patch('bodhi.server.notifications.fedmsg_is_initialized', return_value=True)
+    @mock.patch('bodhi.server.notifications.fedmsg.publish')
+    def test_publish(self, publish, fedmsg_is_initialized):
+        """The messages should be published in order, and counted."""
+        publisher = notifications.FedmsgPublisher()
+        publish.side_effect = [None, Exception('The bus is gone'), None]
+
+        with mock.patch('bodhi.server.notifications.time.time', return_value=110.0):
+            publisher.publish([(100.0, [('a', {'n': 1}), ('b', {'n': 2})]),
+                               (105.0, [('c', {'n': 3})])])
+
+        self.assertEqual(publish.mock_calls,
+                         [mock.call(topic='a', msg={'n': 1}), mock.call(topic='b', msg={'n': 2}),
+                          mock.call(topic='c', msg={'n': 3})])
+        stats = notifications.stats.as_dict()
+        self.assertEqual((stats['published'], stats['failed'], stats['batches']), (2, 1, 1))
+        self.assertEqual(stats['latency_seconds'], 25.0)
+        self.assertEqual(stats['max_latency_seconds'], 10.0)
+
+    @mock.patch('bodhi.server.notifications.fedmsg_is_initialized', return_value=True)
+    @mock.patch('bodhi.server.notifications.fedmsg.publish')
+    def test_thread(self, publish, fedmsg_is_initialized):
+        """The thread should publish everything it is given."""
+        publisher = notifications.FedmsgPublisher()
+        publisher.start()
+
+        publisher.enqueue([('a', {'n': 1})])
+        publisher.enqueue([('b', {'n': 2})])
+        publisher.flush()
+
+        self.assertEqual(publish.mock_calls,
+                         [mock.call(topic='a', msg={'n': 1}), mock.call(topic='b', msg={'n': 2})])
+
+    @mock.patch('bodhi.server.notifications.bodhi.server.log.error')
+    def test_flush_timeout(self, error):
+        """Messages that are still queued after the timeout should be dropped and logged."""
+        publisher = notifications.FedmsgPublisher()
+        publisher.enqueue([('mashtask.complete', {'success': True})])
+
+        self.assertEqual(publisher.flush(timeout=0.01), 1)
+
+        error.assert_called_once_with(
+            "Dropping fedmsg message 'mashtask.complete', which was not published in time: "
+            '{"success": true}')
+        self.assertEqual(publisher.queue.unfinished_tasks, 0)
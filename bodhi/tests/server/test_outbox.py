@@ -0,0 +1,205 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test module contains tests for bodhi.server.outbox."""
+from datetime import datetime, timedelta
+import asyncore
+import smtpd
+import smtplib
+import socket
+import threading
+
+import mock
+import transaction
+
+from bodhi.server import mail, outbox
+from bodhi.server.models import OutboundMail, Update
+from bodhi.tests.server import base
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """A local SMTP server that keeps the messages it receives, and counts its connections."""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.address = '127.0.0.1:%d' % self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+@mock.patch('bodhi.server.outbox.wake')
+class TestQueue(base.BaseTestCase):
+    """This test class contains tests for queueing mail in the outbox."""
+    @mock.patch('bodhi.server.mail._send_mail')
+    def test_queue(self, _send_mail, wake):
+        """Mail sent with a session should be added to the outbox instead of being sent."""
+        with mock.patch.dict('bodhi.server.mail.config', {'mail_outbox': 'True'}):
+            mail.send_mail(u'bodhi@fedoraproject.org', u'bowlofeggs@fedoraproject.org',
+                           u'Subject', u'Body', db=self.db)
+            mail.send_mail(u'bodhi@fedoraproject.org', u'guest@fedoraproject.org',
+                           u'Subject', u'Body', db=self.db)
+
+        messages = self.db.query(OutboundMail).order_by(OutboundMail.id).all()
+        self.assertEqual([m.to_addr for m in messages],
+                         [u'bowlofeggs@fedoraproject.org', u'guest@fedoraproject.org'])
+        self.assertEqual(messages[0].from_addr, u'bodhi@fedoraproject.org')
+        self.assertIn(u'\r\nSubject: Subject\r\n\r\nBody', messages[0].message)
+        self.assertEqual(_send_mail.call_count, 0)
+        # The worker is only woken up once, after the transaction commits
+        self.assertEqual([hook[0] for hook in transaction.get().getAfterCommitHooks()],
+                         [outbox._committed])
+        self.assertEqual(wake.call_count, 0)
+
+    @mock.patch('bodhi.server.mail._send_mail')
+    def test_outbox_disabled(self, _send_mail, wake):
+        """Mail should be sent right away when mail_outbox is not enabled."""
+        with mock.patch.dict('bodhi.server.mail.config', {'mail_outbox': 'False'}):
+            mail.send_mail(u'bodhi@fedoraproject.org', u'bowlofeggs@fedoraproject.org',
+                           u'Subject', u'Body', db=self.db)
+
+        self.assertEqual(self.db.query(OutboundMail).count(), 0)
+        _send_mail.assert_called_once_with('bodhi@fedoraproject.org',
+                                           'bowlofeggs@fedoraproject.org', mock.ANY)
+
+    def test_rollback(self, wake):
+        """Nothing should be left in the outbox, or delivered, if the transaction rolls back."""
+        outbox.queue(self.db, u'bodhi@fedoraproject.org', u'bowlofeggs@fedoraproject.org',
+                     u'Message')
+
+        transaction.abort()
+
+        self.assertEqual(self.db.query(OutboundMail).count(), 0)
+        self.assertEqual(wake.call_count, 0)
+
+    def test_commit(self, wake):
+        """The worker should be woken up once the transaction commits."""
+        db_factory = base.TransactionalSessionMaker(self.Session)
+
+        with db_factory() as db:
+            outbox.queue(db, u'bodhi@fedoraproject.org', u'bowlofeggs@fedoraproject.org',
+                         u'Message')
+
+        wake.assert_called_once_with(self.db.get_bind())
+        self.assertEqual(self.db.query(OutboundMail).count(), 1)
+
+    @mock.patch('bodhi.server.mail._send_mail')
+    def test_comment(self, _send_mail, wake):
+        """The notifications of a comment should go through the outbox."""
+        update = self.db.query(Update).one()
+
+        with mock.patch.dict('bodhi.server.mail.config', {'mail_outbox': 'True'}):
+            update.comment(self.db, u'Works for me.', author=u'bowlofeggs')
+
+        self.assertEqual(_send_mail.call_count, 0)
+        self.assertEqual(sorted(m.to_addr for m in self.db.query(OutboundMail)),
+                         [u'bowlofeggs', u'guest'])
+
+
+@mock.patch('bodhi.server.outbox.wake')
+class TestDeliver(base.BaseTestCase):
+    """This test class contains tests for the deliver() function."""
+    def setUp(self):
+        super(TestDeliver, self).setUp()
+        self.db_factory = base.TransactionalSessionMaker(self.Session)
+        self.sink = SMTPSink()
+        self.config = mock.patch.dict('bodhi.server.outbox.config',
+                                      {'smtp_server': self.sink.address})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        self.sink.stop()
+        super(TestDeliver, self).tearDown()
+
+    def queue(self, count):
+        with self.db_factory() as db:
+            for i in range(count):
+                outbox.queue(db, u'bodhi@fedoraproject.org', u'user%d@fedoraproject.org' % i,
+                             u'Subject: Message %d\r\n\r\nBody' % i)
+
+    def test_deliver(self, wake):
+        """All of the messages should be delivered over one connection, and removed."""
+        self.queue(5)
+
+        with mock.patch.dict('bodhi.server.outbox.config', {'mail_outbox_batch_size': '2'}):
+            self.assertEqual(outbox.deliver(self.db_factory), 5)
+
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual([m[1] for m in self.sink.messages],
+                         [['user%d@fedoraproject.org' % i] for i in range(5)])
+        self.assertEqual(self.sink.messages[0][0], 'bodhi@fedoraproject.org')
+        self.assertIn('Subject: Message 0', self.sink.messages[0][2])
+        self.assertEqual(self.db.query(OutboundMail).count(), 0)
+
+    def test_empty(self, wake):
+        """The SMTP server should not be contacted when the outbox is empty."""
+        self.assertEqual(outbox.deliver(self.db_factory), 0)
+
+        self.assertEqual(self.sink.connections, 0)
+
+    def test_claimed(self, wake):
+        """Messages claimed by another worker should be left alone, unless the claim is stale."""
+        self.queue(2)
+        with self.db_factory() as db:
+            messages = db.query(OutboundMail).order_by(OutboundMail.id).all()
+            messages[0].date_claimed = datetime.utcnow()
+            messages[1].date_claimed = datetime.utcnow() - timedelta(hours=1)
+
+        self.assertEqual(outbox.deliver(self.db_factory), 1)
+
+        self.assertEqual([m[1] for m in self.sink.messages], [['user1@fedoraproject.org']])
+        self.assertEqual([m.to_addr for m in self.db.query(OutboundMail)],
+                         [u'user0@fedoraproject.org'])
+
+    @mock.patch('bodhi.server.outbox.smtplib.SMTP')
+    def test_failures(self, SMTP, wake):
+        """Refused messages should be dropped, and the others tried again with a new connection."""
+        self.queue(3)
+        SMTP.return_value.sendmail.side_effect = [
+            smtplib.SMTPRecipientsRefused({'user0@fedoraproject.org': (550, 'No such user')}),
+            socket.error('Connection reset by peer'),
+            {}]
+
+        self.assertEqual(outbox.deliver(self.db_factory), 1)
+
+        self.assertEqual(SMTP.call_count, 2)
+        messages = self.db.query(OutboundMail).all()
+        self.assertEqual([(m.to_addr, m.date_claimed) for m in messages],
+                         [(u'user1@fedoraproject.org', None)])
+
+    def test_no_smtp_server(self, wake):
+        """Nothing should be delivered without an smtp_server."""
+        self.queue(1)
+
+        with mock.patch.dict('bodhi.server.outbox.config', {'smtp_server': ''}):
+            self.assertEqual(outbox.deliver(self.db_factory), 0)
+
+        self.assertEqual(self.db.query(OutboundMail).count(), 1)
@@ -0,0 +1,211 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""This test module contains tests for bodhi.server.sync."""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import socket
+import threading
+import unittest
+import urllib2
+
+import mock
+
+from bodhi.server import sync
+
+
+class MirrorStub(HTTPServer):
+    """
+    A local stand-in for the master mirror, which serves a repomd.xml for any path.
+
+    The repomd.xml is served with an ETag, and a 304 is returned to requests that already have it.
+    Every request's path and conditional headers are recorded in self.requests.
+    """
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MirrorStubHandler)
+        self.repomd = {}
+        self.status = None
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MirrorStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.getheader('If-None-Match')))
+        body = server.repomd.get(self.path, 'old')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+        if server.status:
+            self.send_response(server.status)
+            server.status = None
+        elif self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSyncWatcher(unittest.TestCase):
+    """This test class contains tests for the SyncWatcher class."""
+
+    def setUp(self):
+        self.mirror = MirrorStub()
+        self.watcher = sync.SyncWatcher(initial_delay=0.01, max_delay=0.04)
+        self.checksum = hashlib.sha1('new').hexdigest()
+
+    def tearDown(self):
+        self.mirror.stop()
+
+    def _wait(self, request):
+        """Wait for the request, failing the test instead of hanging if it never finishes."""
+        request.done.wait(10)
+        self.assertTrue(request.done.is_set())
+        return request.wait()
+
+    def test_match_immediately(self):
+        """A repomd.xml that is already on the mirror should be found with a single GET."""
+        self.mirror.repomd['/repomd.xml'] = 'new'
+
+        request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+
+        self.assertTrue(self._wait(request))
+        self.assertEqual(request.polls, 1)
+        self.assertEqual(self.mirror.requests, [('/repomd.xml', None)])
+
+    def test_conditional_get(self):
+        """Once the mirror has sent an ETag, it should be sent back with each later poll."""
+        request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+        while len(self.mirror.requests) < 3:
+            request.done.wait(0.01)
+        self.mirror.repomd['/repomd.xml'] = 'new'
+
+        self.assertTrue(self._wait(request))
+        etag = '"%s"' % hashlib.sha1('old').hexdigest()
+        self.assertEqual(self.mirror.requests[0], ('/repomd.xml', None))
+        self.assertEqual(set(self.mirror.requests[1:]), set([('/repomd.xml', etag)]))
+        self.assertEqual(request.etag, '"%s"' % self.checksum)
+
+    def test_backoff(self):
+        """The delay between polls should double after each poll, up to max_delay."""
+        request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+        while request.polls < 4:
+            request.done.wait(0.01)
+
+        self.assertEqual(request.delay, 0.04)
+        self.mirror.repomd['/repomd.xml'] = 'new'
+        self.assertTrue(self._wait(request))
+
+    def test_error(self):
+        """Errors from the mirror should be logged, and the repomd.xml polled again."""
+        self.mirror.repomd['/repomd.xml'] = 'new'
+        self.mirror.status = 500
+
+        with mock.patch('bodhi.server.sync.log') as log:
+            request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+            self.assertTrue(self._wait(request))
+
+        log.exception.assert_called_once_with('Error fetching repomd.xml')
+        self.assertEqual(request.polls, 2)
+
+    def test_timeout(self):
+        """The watcher should give up on a repomd.xml once its timeout has passed."""
+        self.watcher.timeout = 0.1
+
+        with mock.patch('bodhi.server.sync.log') as log:
+            request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+            self.assertFalse(self._wait(request))
+
+        self.assertFalse(request.synced)
+        self.assertEqual(log.error.call_count, 1)
+
+    def test_request_timeout(self):
+        """A mirror that doesn't answer in time should be polled again, like after an error."""
+        self.mirror.repomd['/repomd.xml'] = 'new'
+        self.watcher.request_timeout = 5
+        urlopen = urllib2.urlopen
+        timeouts = []
+
+        def hung_once(request, timeout):
+            timeouts.append(timeout)
+            if len(timeouts) == 1:
+                raise socket.timeout('timed out')
+            return urlopen(request, timeout=timeout)
+
+        with mock.patch('bodhi.server.sync.log') as log:
+            with mock.patch('bodhi.server.sync.urllib2.urlopen', side_effect=hung_once):
+                request = self.watcher.watch(self.mirror.url('/repomd.xml'), self.checksum)
+                self.assertTrue(self._wait(request))
+
+        self.assertEqual(timeouts, [5, 5])
+        log.exception.assert_called_once_with('Error fetching repomd.xml')
+
+    def test_shared_thread(self):
+        """All of the repos should be polled from one thread, which exits when they are done."""
+        requests = [self.watcher.watch(self.mirror.url('/%d/repomd.xml' % i), self.checksum)
+                    for i in range(3)]
+        thread = self.watcher.thread
+        for i in range(3):
+            self.mirror.repomd['/%d/repomd.xml' % i] = 'new'
+
+        for request in requests:
+            self.assertTrue(self._wait(request))
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.watcher.thread)
+
+        # Watching another repo starts a new thread
+        request = self.watcher.watch(self.mirror.url('/0/repomd.xml'), self.checksum)
+        self.assertTrue(self._wait(request))
+
+
+class TestSyncWatcherFromConfig(unittest.TestCase):
+    """This test class contains tests for the SyncWatcher.from_config() method."""
+
+    @mock.patch.dict('bodhi.server.sync.config',
+                     {'sync_initial_delay': '2', 'sync_max_delay': '60', 'sync_timeout': '3600',
+                      'sync_request_timeout': '10'})
+    def test_settings(self):
+        watcher = sync.SyncWatcher.from_config()
+
+        self.assertEqual(watcher.initial_delay, 2)
+        self.assertEqual(watcher.max_delay, 60)
+        self.assertEqual(watcher.timeout, 3600)
+        self.assertEqual(watcher.request_timeout, 10)
+
+    def test_defaults(self):
+        watcher = sync.SyncWatcher.from_config()
+
+        self.assertEqual(watcher.initial_delay, 5)
+        self.assertEqual(watcher.max_delay, 200)
+        self.assertIsNone(watcher.timeout)
+        self.assertEqual(watcher.request_timeout, 30)
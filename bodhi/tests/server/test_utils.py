@@ -12,10 +12,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import gzip
+import os
+import shutil
+import tempfile
+
+import mock
+
 from bodhi.server.buildsys import setup_buildsystem, teardown_buildsystem
 from bodhi.server.config import config
-from bodhi.server.util import (get_critpath_pkgs, get_nvr, markup,
-                               get_rpm_header, cmd, sorted_builds)
+from bodhi.server.util import (chunks, get_critpath_pkgs, get_nvr, gzip_contains, link_or_copy,
+                               markup, get_rpm_header, cmd, sorted_builds, sorted_updates)
 
 
 class TestUtils(object):
@@ -30,6 +37,47 @@ class TestUtils(object):
         assert config.get('sqlalchemy.url'), config
         assert config['sqlalchemy.url'], config
 
+    def test_chunks(self):
+        """Assert that chunks() splits the items into lists of at most the given size."""
+        assert list(chunks(xrange(5), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(chunks([1, 2], 2)) == [[1, 2]]
+        assert list(chunks([], 2)) == []
+
+    def test_link_or_copy(self):
+        """Assert that link_or_copy() hardlinks the file, replacing any existing one."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tempdir, 'src')
+            dst = os.path.join(tempdir, 'dst')
+            with open(src, 'w') as f:
+                f.write('new')
+            with open(dst, 'w') as f:
+                f.write('old')
+
+            link_or_copy(src, dst)
+
+            assert os.path.samefile(src, dst)
+            assert open(dst).read() == 'new'
+        finally:
+            shutil.rmtree(tempdir)
+
+    @mock.patch('bodhi.server.util.os.link', side_effect=OSError(18, 'Invalid cross-device link'))
+    def test_link_or_copy_falls_back_to_copy(self, link):
+        """Assert that link_or_copy() copies the file when it cannot be hardlinked."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tempdir, 'src')
+            dst = os.path.join(tempdir, 'dst')
+            with open(src, 'w') as f:
+                f.write('data')
+
+            link_or_copy(src, dst)
+
+            assert not os.path.samefile(src, dst)
+            assert open(dst).read() == 'data'
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_get_critpath_pkgs(self):
         """Ensure the pkgdb's critpath API works"""
         pkgs = get_critpath_pkgs()
@@ -57,6 +105,22 @@ class TestUtils(object):
         h = get_rpm_header('')
         assert h['name'] == 'libseccomp', h
 
+    def test_rpm_header_cached(self):
+        """The headers of a build should only be fetched from koji once."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict('bodhi.server.kojicache.config',
+                                 {'koji_cache_file': os.path.join(tempdir, 'koji.sqlite')}):
+                with mock.patch('bodhi.server.buildsys.DevBuildsys.getRPMHeaders',
+                                return_value={'name': 'libseccomp'}) as getRPMHeaders:
+                    assert get_rpm_header('libseccomp-2.1.0-1.fc20') == {'name': 'libseccomp'}
+                    assert get_rpm_header('libseccomp-2.1.0-1.fc20') == {'name': 'libseccomp'}
+        finally:
+            shutil.rmtree(tempdir)
+
+        getRPMHeaders.assert_called_once_with(
+            rpmID='libseccomp-2.1.0-1.fc20.src', headers=mock.ANY)
+
     def test_cmd_failure(self):
         try:
             cmd('false')
@@ -70,3 +134,32 @@ class TestUtils(object):
         b1, b2 = sorted_builds([new, old])
         assert b1 == new, b1
         assert b2 == old, b2
+
+    def test_sorted_updates(self):
+        """Updates with several builds of a package should be tagged in order, the rest together."""
+        def update(*nvrs):
+            return mock.Mock(title=','.join(nvrs), builds=[mock.Mock(nvr=nvr) for nvr in nvrs])
+        newest = update('bodhi-2.0-2.fc24')
+        newer = update('bodhi-2.0-1.fc24')
+        python = update('python-2.7.13-1.fc24')
+        older = update('nethack-3.4.3-1.fc24', 'bodhi-1.5-4.fc24')
+
+        sync, async = sorted_updates([newest, python, older, newer])
+
+        assert sync == [older, newer, newest], sync
+        assert async == [python], async
+
+    def test_gzip_contains(self):
+        """gzip_contains() should find strings anywhere in the file, even across two chunks."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'updateinfo.xml.gz')
+            f = gzip.open(path, 'wb')
+            f.write('<update><id>FEDORA-2017-1</id></update><update><id/></update>')
+            f.close()
+
+            for chunk_size in (1, 4, 5, 1024):
+                assert gzip_contains(path, '<id/>', chunk_size), chunk_size
+                assert not gzip_contains(path, '<id>FEDORA-2017-2', chunk_size), chunk_size
+        finally:
+            shutil.rmtree(tempdir)
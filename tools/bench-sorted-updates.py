@@ -0,0 +1,83 @@
+""" bench-sorted-updates.py
+
+Time bodhi.server.util.sorted_updates() on a synthetic push, and compare it to the
+list-based implementation it replaced.
+
+Usage: python tools/bench-sorted-updates.py [number of updates]
+"""
+
+from collections import defaultdict
+import sys
+import time
+
+from bodhi.server.util import get_nvr, sorted_builds, sorted_updates
+
+
+class Build(object):
+    def __init__(self, nvr):
+        self.nvr = nvr
+
+
+class Update(object):
+    def __init__(self, title, builds):
+        self.title = title
+        self.builds = builds
+
+
+def make_updates(count):
+    """
+    Return count synthetic updates of one build each. Every tenth update is one of three builds of
+    the same package, so that the synchronous batch isn't empty.
+    """
+    updates = []
+    for i in range(count):
+        if i % 10 == 0:
+            nvr = 'multi%d-1.%d-1.fc26' % (i // 30, (i // 10) % 3)
+        else:
+            nvr = 'package%d-1.0-1.fc26' % i
+        updates.append(Update(nvr, [Build(nvr)]))
+    return updates
+
+
+def list_sorted_updates(updates):
+    """The list-based implementation of sorted_updates(), for comparison."""
+    builds = defaultdict(set)
+    build_to_update = {}
+    sync, async = [], []
+    for update in updates:
+        for build in update.builds:
+            n, v, r = get_nvr(build.nvr)
+            builds[n].add(build.nvr)
+            build_to_update[build.nvr] = update
+    for package in builds:
+        if len(builds[package]) > 1:
+            for build in sorted_builds(builds[package])[::-1]:
+                update = build_to_update[build]
+                if update not in sync:
+                    sync.append(update)
+                if update in async:
+                    async.remove(update)
+        else:
+            update = build_to_update[builds[package].pop()]
+            if update not in async and update not in sync:
+                async.append(update)
+    return sync, async
+
+
+def clock(func, updates):
+    start = time.time()
+    result = func(updates)
+    return time.time() - start, result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    updates = make_updates(count)
+
+    old_duration, old_result = clock(list_sorted_updates, updates)
+    new_duration, new_result = clock(sorted_updates, updates)
+
+    assert old_result == new_result, 'The batches differ'
+    print '%d updates: %d sync, %d async' % (count, len(new_result[0]), len(new_result[1]))
+    print 'list-based sorted_updates: %.3fs' % old_duration
+    print 'sorted_updates:            %.3fs' % new_duration